@@ -1,5 +1,4 @@
 # P2P_init.py
-import math
 import os
 
 # Global configuration variables
@@ -10,6 +9,38 @@ FILE_NAME = ""
 FILE_SIZE = 0
 PIECE_SIZE = 0
 NUM_PIECES = 0  #derived
+REQUEST_TIMEOUT = 30  # optional, seconds before an unanswered request is released
+TRACKER_URL = ""      # optional, e.g. http://localhost:6969/announce ("" = PeerInfo.cfg only)
+ANNOUNCE_INTERVAL = 30
+NUM_WANT = 30         # how many peers to ask the tracker for
+MAX_CONNECTIONS = 0   # cap on open neighbor connections (0 = no cap)
+PEX_INTERVAL = 0      # seconds between peer exchange rounds (0 = PEX off)
+SUPER_SEEDING = False # seeders reveal pieces one at a time via HAVE
+STREAMING_WINDOW = 0  # pieces ahead of the read cursor fetched in order (0 = off)
+STREAMING_DEADLINE = 2.0  # seconds allowed per piece in the streaming window
+DISK_IO_THREADS = 0   # piece read/write worker threads (0 = on the socket threads)
+DISK_QUEUE_SIZE = 64  # queued disk jobs before socket threads block
+KEEP_ALIVE_INTERVAL = 30  # seconds between keep-alives to each neighbor (0 = off)
+IDLE_TIMEOUT = 120    # drop a neighbor silent for this long (0 = never)
+TRANSPORT = "tcp"     # tcp, or udp for the LEDBAT transport in udp_transport.py
+METRICS_INTERVAL = 0  # seconds between timing histogram dumps (0 = off)
+TRACE_FRAMES = False  # record every frame header to trace_peer_<id>.bin
+WEB_SEED_URL = ""     # optional HTTP URL of the whole file, used when peers can't serve a piece
+DELTA_MANIFEST = ""   # delta sync manifest path or URL ("" = off), see delta_sync.py
+DELTA_WORKERS = 0     # processes scanning an old copy (0 = one per core)
+WORKERS = 0           # processes serving this peer on one port (0 or 1 = just this one)
+PIECE_CHUNK_SIZE = 0  # pieces above this many bytes are streamed socket <-> disk in chunks (0 = off)
+ADAPTIVE_UPLOAD_SLOTS = False  # retune the number of preferred neighbors from the upload rate
+MIN_UPLOAD_SLOTS = 1  # bounds for the adaptive number of preferred neighbors
+MAX_UPLOAD_SLOTS = 10
+PROXIMITY_WEIGHT = 0.0  # how much nearby neighbors (RTT, same host/subnet) are preferred (0 = not at all)
+PIECE_STORE = ""      # host-wide piece store directory ("" = off), see piece_store.py
+PIECE_STORE_BUDGET = 0  # bytes the piece store may hold before old pieces are deleted (0 = no limit)
+TCP_NODELAY = True    # send control frames at once and cork PIECE frames (tcp only)
+SOCKET_BUFFER_MAX = 0 # grow socket buffers to the measured bandwidth-delay product, up to this (0 = kernel decides)
+
+MAX_FRAME_PAYLOAD = 2**32 - 1   # frame lengths are 32-bit
+MAX_PIECES = 2**31 - 1          # piece indices fit a signed 32-bit field (frame traces)
 
 # Global peer info: {peer_id: (host, port, has_file_bool)}
 peer_info = {}
@@ -26,6 +57,35 @@ def init_Common():
     global FILE_SIZE
     global PIECE_SIZE
     global NUM_PIECES
+    global REQUEST_TIMEOUT
+    global TRACKER_URL
+    global ANNOUNCE_INTERVAL
+    global NUM_WANT
+    global MAX_CONNECTIONS
+    global PEX_INTERVAL
+    global SUPER_SEEDING
+    global STREAMING_WINDOW
+    global STREAMING_DEADLINE
+    global DISK_IO_THREADS
+    global DISK_QUEUE_SIZE
+    global KEEP_ALIVE_INTERVAL
+    global IDLE_TIMEOUT
+    global TRANSPORT
+    global METRICS_INTERVAL
+    global TRACE_FRAMES
+    global WEB_SEED_URL
+    global DELTA_MANIFEST
+    global DELTA_WORKERS
+    global WORKERS
+    global PIECE_CHUNK_SIZE
+    global ADAPTIVE_UPLOAD_SLOTS
+    global MIN_UPLOAD_SLOTS
+    global MAX_UPLOAD_SLOTS
+    global PROXIMITY_WEIGHT
+    global PIECE_STORE
+    global PIECE_STORE_BUDGET
+    global TCP_NODELAY
+    global SOCKET_BUFFER_MAX
 
     with open('Common.cfg', 'r') as file:
         for line in file:
@@ -44,8 +104,73 @@ def init_Common():
                 FILE_SIZE = int(line.split()[1])
             elif line.startswith('PieceSize'):
                 PIECE_SIZE = int(line.split()[1])
+            elif line.startswith('RequestTimeout'):
+                REQUEST_TIMEOUT = float(line.split()[1])
+            elif line.startswith('TrackerURL'):
+                TRACKER_URL = line.split()[1]
+            elif line.startswith('AnnounceInterval'):
+                ANNOUNCE_INTERVAL = int(line.split()[1])
+            elif line.startswith('NumWant'):
+                NUM_WANT = int(line.split()[1])
+            elif line.startswith('MaxConnections'):
+                MAX_CONNECTIONS = int(line.split()[1])
+            elif line.startswith('PexInterval'):
+                PEX_INTERVAL = int(line.split()[1])
+            elif line.startswith('SuperSeeding'):
+                SUPER_SEEDING = line.split()[1] == '1'
+            elif line.startswith('StreamingWindow'):
+                STREAMING_WINDOW = int(line.split()[1])
+            elif line.startswith('StreamingDeadline'):
+                STREAMING_DEADLINE = float(line.split()[1])
+            elif line.startswith('DiskIOThreads'):
+                DISK_IO_THREADS = int(line.split()[1])
+            elif line.startswith('DiskQueueSize'):
+                DISK_QUEUE_SIZE = int(line.split()[1])
+            elif line.startswith('KeepAliveInterval'):
+                KEEP_ALIVE_INTERVAL = int(line.split()[1])
+            elif line.startswith('IdleTimeout'):
+                IDLE_TIMEOUT = int(line.split()[1])
+            elif line.startswith('Transport'):
+                TRANSPORT = line.split()[1].lower()
+            elif line.startswith('MetricsInterval'):
+                METRICS_INTERVAL = int(line.split()[1])
+            elif line.startswith('TraceFrames'):
+                TRACE_FRAMES = line.split()[1] == '1'
+            elif line.startswith('WebSeedURL'):
+                WEB_SEED_URL = line.split()[1]
+            elif line.startswith('DeltaManifest'):
+                DELTA_MANIFEST = line.split()[1]
+            elif line.startswith('DeltaWorkers'):
+                DELTA_WORKERS = int(line.split()[1])
+            elif line.startswith('Workers'):
+                WORKERS = int(line.split()[1])
+            elif line.startswith('PieceChunkSize'):
+                PIECE_CHUNK_SIZE = int(line.split()[1])
+            elif line.startswith('AdaptiveUploadSlots'):
+                ADAPTIVE_UPLOAD_SLOTS = line.split()[1] == '1'
+            elif line.startswith('MinUploadSlots'):
+                MIN_UPLOAD_SLOTS = int(line.split()[1])
+            elif line.startswith('MaxUploadSlots'):
+                MAX_UPLOAD_SLOTS = int(line.split()[1])
+            elif line.startswith('ProximityWeight'):
+                PROXIMITY_WEIGHT = float(line.split()[1])
+            elif line.startswith('PieceStoreBudget'):
+                PIECE_STORE_BUDGET = int(line.split()[1])
+            elif line.startswith('PieceStore'):
+                PIECE_STORE = line.split()[1]
+            elif line.startswith('TcpNoDelay'):
+                TCP_NODELAY = line.split()[1] == '1'
+            elif line.startswith('SocketBufferMax'):
+                SOCKET_BUFFER_MAX = int(line.split()[1])
 
-    NUM_PIECES = math.ceil(FILE_SIZE / PIECE_SIZE) # to update the number of pieces
+    # Python ints don't overflow, but the wire format does: a PIECE frame
+    # carries a 4-byte index plus the piece under a 32-bit length
+    if PIECE_SIZE <= 0 or PIECE_SIZE + 4 > MAX_FRAME_PAYLOAD:
+        raise ValueError(f"PieceSize must be between 1 and {MAX_FRAME_PAYLOAD - 4} bytes")
+    # Integer ceiling: float division loses precision on very large files
+    NUM_PIECES = -(-FILE_SIZE // PIECE_SIZE) # to update the number of pieces
+    if FILE_SIZE <= 0 or NUM_PIECES > MAX_PIECES:
+        raise ValueError(f"FileSize must be positive and at most {MAX_PIECES} pieces")
     print("Common info initialization: ",
           NUMBER_OF_PREFERRED_NEIGHBORS, 
           UNCHOKING_INTERVAL, 
@@ -54,11 +179,11 @@ def init_Common():
           FILE_SIZE,
           PIECE_SIZE)
 
-def handshake(peer_id):
+def handshake(peer_id, features=0):
     # Create handshake message
     pstr = "P2PFILESHARINGPROJ" #handshake header / 18 bytes
     pstrlen = len(pstr)
-    zero_bits = bytes(10)        # 10 bytes of zeros
+    zero_bits = bytes(9) + bytes([features])  # 10 reserved bytes, the last one holds feature flags
     peer_id_bytes = peer_id.to_bytes(4, byteorder='big', signed=False)
     handshake_msg = pstr.encode('utf-8') + zero_bits + peer_id_bytes  # total 32 bytes
     return handshake_msg
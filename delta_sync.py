@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+"""
+Delta sync between versions of the shared file
+The seeder publishes a manifest with a weak (Adler-32) and a strong
+(SHA-1) checksum of every piece of the new version. A peer that still has
+an older copy scans it before downloading: first each piece at its own
+offset, then, for pieces still missing, every byte offset of the old copy
+with a rolling Adler-32 (like rsync), so content that moved because bytes
+were inserted or removed earlier in the file is found too. The scan is
+split over worker processes. Matching blocks are copied into place and
+only the remaining pieces are downloaded.
+
+    python delta_sync.py build peer_1001/thefile thefile.manifest --piece-size 16384
+    python delta_sync.py scan peer_1002/thefile thefile.manifest
+"""
+
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import urllib.request
+import zlib
+
+MANIFEST_VERSION = 1
+ADLER_MOD = 65521
+SCAN_CHUNK = 4 * 1024 * 1024   # old-file bytes per rolling-scan task
+
+
+def weak_checksum(data):
+    return zlib.adler32(data)
+
+
+def strong_checksum(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+def build_manifest(path, piece_size):
+    """Checksums of every piece of the file at path."""
+    weak, strong = [], []
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(piece_size)
+            if not block:
+                break
+            weak.append(weak_checksum(block))
+            strong.append(strong_checksum(block))
+    return {'version': MANIFEST_VERSION, 'file_size': os.path.getsize(path),
+            'piece_size': piece_size, 'weak': weak, 'strong': strong}
+
+
+def write_manifest(manifest, path):
+    """Write atomically, so a peer starting meanwhile never reads half a manifest."""
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp, path)
+
+
+def load_manifest(source, timeout=10):
+    """Manifest from a local path or an http(s) URL. Raises OSError or ValueError."""
+    if source.startswith(('http://', 'https://')):
+        with urllib.request.urlopen(source, timeout=timeout) as resp:
+            manifest = json.loads(resp.read().decode())
+    else:
+        with open(source) as f:
+            manifest = json.load(f)
+    if manifest.get('version') != MANIFEST_VERSION:
+        raise ValueError(f"unsupported manifest version {manifest.get('version')}")
+    return manifest
+
+
+def piece_length(manifest, piece_index):
+    return min(manifest['piece_size'], manifest['file_size'] - piece_index * manifest['piece_size'])
+
+
+# Worker-process state, set once per worker by _init_worker
+_old_path = None
+_manifest = None
+_table = None
+
+
+def _init_worker(old_path, manifest, table):
+    global _old_path, _manifest, _table
+    _old_path, _manifest, _table = old_path, manifest, table
+
+
+def _check_aligned(pieces):
+    """Pieces whose bytes sit unchanged at their own offset in the old copy."""
+    found = {}
+    ps = _manifest['piece_size']
+    with open(_old_path, 'rb') as f:
+        for i in pieces:
+            length = piece_length(_manifest, i)
+            f.seek(i * ps)
+            block = f.read(length)
+            if len(block) == length and strong_checksum(block) == _manifest['strong'][i]:
+                found[i] = i * ps
+    return found
+
+
+def _scan_segment(bounds):
+    """
+    Roll a piece-sized Adler-32 window over old-file offsets [start, stop)
+    and confirm weak hits with SHA-1. Returns {piece: old offset}.
+    """
+    start, stop = bounds
+    ps = _manifest['piece_size']
+    strong = _manifest['strong']
+    with open(_old_path, 'rb') as f:
+        f.seek(start)
+        data = f.read(stop - start + ps - 1)
+    last = len(data) - ps
+    found = {}
+    lookup = _table.get   # hot loop: one dict probe and two modular updates per byte
+    k = 0
+    while k <= last:
+        adler = zlib.adler32(data[k:k + ps])
+        a, b = adler & 0xffff, adler >> 16
+        while True:
+            candidates = lookup((b << 16) | a)
+            if candidates:
+                digest = strong_checksum(data[k:k + ps])
+                hits = [i for i in candidates if strong[i] == digest]
+                if hits:
+                    for i in hits:
+                        found.setdefault(i, start + k)
+                    # Blocks don't overlap in practice; restart the window after this one
+                    k += ps
+                    break
+            if k >= last:
+                k += 1
+                break
+            old = data[k]
+            a = (a - old + data[k + ps]) % ADLER_MOD
+            b = (b - ps * old + a - 1) % ADLER_MOD
+            k += 1
+    return found
+
+
+def find_matches(old_path, manifest, workers=None):
+    """
+    {new piece index: offset in old_path holding exactly that piece}.
+    workers: processes to use (None = one per core, 1 = scan in this process).
+    """
+    workers = workers or os.cpu_count() or 1
+    ps = manifest['piece_size']
+    num_pieces = len(manifest['strong'])
+    old_size = os.path.getsize(old_path)
+
+    def run(fn, tasks, table=None):
+        if workers == 1 or len(tasks) == 1:
+            _init_worker(old_path, manifest, table)
+            return [fn(t) for t in tasks]
+        with multiprocessing.Pool(min(workers, len(tasks)), _init_worker,
+                                  (old_path, manifest, table)) as pool:
+            return pool.map(fn, tasks)
+
+    matches = {}
+    step = max(1, -(-num_pieces // (workers * 4)))
+    for found in run(_check_aligned, [range(i, min(i + step, num_pieces))
+                                      for i in range(0, num_pieces, step)]):
+        matches.update(found)
+
+    # Full-size pieces not at their own offset: look for them anywhere
+    table = {}
+    for i in range(num_pieces):
+        if i not in matches and piece_length(manifest, i) == ps:
+            table.setdefault(manifest['weak'][i], []).append(i)
+    if table and old_size >= ps:
+        # Windows lying inside a block matched in place can't hold a missing
+        # piece we'd want to take from there; scan only the rest
+        end = old_size - ps + 1
+        gaps, pos = [], 0
+        for offset in sorted(matches.values()):
+            if offset > pos:
+                gaps.append((pos, offset))
+            pos = max(pos, offset + ps)
+        if pos < old_size:
+            gaps.append((pos, old_size))
+        # Window start offsets whose window overlaps a gap
+        spans = [(max(0, a - ps + 1), min(b, end)) for a, b in gaps]
+        spans = [(a, b) for a, b in spans if a < b]
+        total = sum(b - a for a, b in spans)
+        chunk = max(ps, min(SCAN_CHUNK, -(-total // workers)))
+        bounds = [(s, min(s + chunk, b)) for a, b in spans for s in range(a, b, chunk)]
+        for found in run(_scan_segment, bounds, table):
+            for i, offset in found.items():
+                matches.setdefault(i, offset)
+
+    # A short last piece may have moved to the end of the old copy
+    last = num_pieces - 1
+    if num_pieces and last not in matches:
+        length = piece_length(manifest, last)
+        if 0 < length < ps and old_size >= length:
+            with open(old_path, 'rb') as f:
+                f.seek(old_size - length)
+                if strong_checksum(f.read(length)) == manifest['strong'][last]:
+                    matches[last] = old_size - length
+    return matches
+
+
+def rebuild(path, manifest, matches):
+    """
+    Replace the old copy at path with a sparse file of the new size that
+    holds the matched pieces in their new places. Returns bytes reused.
+    """
+    tmp = path + '.delta'
+    reused = 0
+    ps = manifest['piece_size']
+    with open(path, 'rb') as old, open(tmp, 'wb') as new:
+        new.truncate(manifest['file_size'])
+        for piece_index, offset in sorted(matches.items()):
+            length = piece_length(manifest, piece_index)
+            old.seek(offset)
+            new.seek(piece_index * ps)
+            new.write(old.read(length))
+            reused += length
+    os.replace(tmp, path)
+    return reused
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build a delta-sync manifest or check an old copy against one.")
+    sub = parser.add_subparsers(dest='command', required=True)
+    build = sub.add_parser('build', help="write the manifest of a file")
+    build.add_argument('file')
+    build.add_argument('manifest')
+    build.add_argument('--piece-size', type=int, required=True)
+    scan = sub.add_parser('scan', help="report how much of an old copy a manifest could reuse")
+    scan.add_argument('file')
+    scan.add_argument('manifest')
+    scan.add_argument('--workers', type=int)
+    args = parser.parse_args(argv)
+    if args.command == 'build':
+        write_manifest(build_manifest(args.file, args.piece_size), args.manifest)
+    else:
+        manifest = load_manifest(args.manifest)
+        matches = find_matches(args.file, manifest, args.workers)
+        reused = sum(piece_length(manifest, i) for i in matches)
+        print(f"{len(matches)}/{len(manifest['strong'])} pieces reusable, "
+              f"{reused} of {manifest['file_size']} bytes")
+
+
+if __name__ == "__main__":
+    main()
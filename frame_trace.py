@@ -0,0 +1,375 @@
+#!/usr/bin/env python3
+"""
+Binary frame traces
+With TraceFrames 1 in Common.cfg every peer writes trace_peer_<id>.bin: the
+header of each frame it sends or receives (monotonic nanoseconds, direction,
+neighbor, message type, piece index, payload size), 22 bytes per frame.
+Payloads are not kept.
+
+The analyzer merges the traces of a whole swarm and reports per-piece
+propagation trees, request -> piece latency, idle link time and when each
+peer completed:
+
+    python frame_trace.py trace_peer_*.bin
+    python frame_trace.py trace_peer_*.bin --piece 17     # one propagation tree
+    python frame_trace.py trace_peer_*.bin --json
+"""
+
+import argparse
+import json
+import struct
+import threading
+import time
+
+MAGIC = b'P2PTRACE'
+VERSION = 1
+# magic, version, peer id, wall clock ns and monotonic ns taken together
+# (to line up traces from different processes), number of pieces
+FILE_HEADER = struct.Struct('<8sBIqqI')
+# monotonic ns, direction, neighbor id, message type, piece index, payload size
+RECORD = struct.Struct('<qBIBiI')
+
+RECV = 0
+SEND = 1
+NO_PIECE = -1
+FLUSH_BYTES = 64 * 1024
+
+# Message types whose payload starts with a piece index (see peerProcess)
+HAVE = 4
+REQUEST = 6
+PIECE = 7
+DONE = 8
+INDEXED_TYPES = (HAVE, REQUEST, PIECE)
+
+
+def _piece_of(message_type, data, pos=0):
+    if message_type in INDEXED_TYPES and len(data) >= pos + 4:
+        return struct.unpack_from('>i', data, pos)[0]
+    return NO_PIECE
+
+
+class TraceRecorder:
+    """
+    Appends frame records to an in-memory buffer and writes it out every
+    FLUSH_BYTES (and on flush/close), so recording a frame costs a pack and
+    a bytearray extend under a lock.
+    """
+
+    def __init__(self, path, peer_id, num_pieces):
+        self.lock = threading.Lock()
+        self.buffer = bytearray()
+        self.file = open(path, 'wb')
+        self.file.write(FILE_HEADER.pack(MAGIC, VERSION, peer_id, time.time_ns(),
+                                         time.monotonic_ns(), num_pieces))
+
+    def record(self, direction, neighbor, message_type, payload, size=None):
+        """
+        Record one frame whose payload we have in hand (received frames).
+        size overrides len(payload) for frames read in pieces.
+        """
+        self._append(direction, neighbor, message_type, _piece_of(message_type, payload),
+                     len(payload) if size is None else size)
+
+    def record_frames(self, direction, neighbor, data):
+        """Record every frame in data (one sendall may carry several)."""
+        pos = 0
+        while pos + 5 <= len(data):
+            length = struct.unpack_from('>I', data, pos)[0]
+            message_type = data[pos + 4]
+            self._append(direction, neighbor, message_type,
+                         _piece_of(message_type, data, pos + 5), length)
+            pos += 5 + length
+
+    def _append(self, direction, neighbor, message_type, piece, size):
+        rec = RECORD.pack(time.monotonic_ns(), direction, neighbor, message_type, piece, size)
+        with self.lock:
+            if self.file.closed:
+                return
+            self.buffer += rec
+            if len(self.buffer) >= FLUSH_BYTES:
+                self._write()
+
+    def flush(self):
+        with self.lock:
+            self._write()
+
+    def close(self):
+        with self.lock:
+            if self.file.closed:
+                return
+            self._write()
+            self.file.close()
+
+    def _write(self):
+        if self.buffer and not self.file.closed:
+            self.file.write(self.buffer)
+            self.file.flush()
+            self.buffer = bytearray()
+
+
+class TracedSocket:
+    """Socket wrapper that records each frame passed to sendall."""
+
+    def __init__(self, sock, recorder, neighbor):
+        self._sock = sock
+        self._recorder = recorder
+        self._neighbor = neighbor
+
+    def sendall(self, data):
+        self._recorder.record_frames(SEND, self._neighbor, data)
+        return self._sock.sendall(data)
+
+    @property
+    def raw(self):
+        """The wrapped socket, for bytes that continue a frame already recorded."""
+        return self._sock
+
+    def __getattr__(self, name):
+        return getattr(self._sock, name)
+
+
+# ---------------------------------------------------------------- analysis
+
+class Trace:
+    """One peer's trace; times are wall-clock seconds."""
+
+    def __init__(self, peer_id, num_pieces, records):
+        self.peer_id = peer_id
+        self.num_pieces = num_pieces
+        self.records = records   # (time, direction, neighbor, type, piece, size)
+
+
+def load_trace(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    magic, version, peer_id, wall_ns, mono_ns, num_pieces = FILE_HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"{path} is not a version {VERSION} frame trace")
+    offset = wall_ns - mono_ns
+    end = FILE_HEADER.size + (len(data) - FILE_HEADER.size) // RECORD.size * RECORD.size
+    records = [((t + offset) / 1e9, direction, neighbor, mtype, piece, size)
+               for t, direction, neighbor, mtype, piece, size
+               in RECORD.iter_unpack(data[FILE_HEADER.size:end])]
+    return Trace(peer_id, num_pieces, records)
+
+
+def start_time(traces):
+    return min((t.records[0][0] for t in traces if t.records), default=0.0)
+
+
+def propagation(traces):
+    """
+    piece -> {peer: (parent, time)} from the first PIECE each peer received.
+    Peers that sent a piece but never received it are the roots (seeds).
+    """
+    trees = {}
+    for trace in traces:
+        for t, direction, neighbor, mtype, piece, _ in trace.records:
+            if direction == RECV and mtype == PIECE:
+                tree = trees.setdefault(piece, {})
+                if trace.peer_id not in tree:
+                    tree[trace.peer_id] = (neighbor, t)
+    return trees
+
+
+def tree_depths(tree):
+    """peer -> hops from the root for one piece's tree."""
+    depths = {}
+
+    def depth(peer, seen=()):
+        if peer in depths:
+            return depths[peer]
+        if peer not in tree or peer in seen:
+            return 0
+        depths[peer] = d = depth(tree[peer][0], seen + (peer,)) + 1
+        return d
+
+    for peer in tree:
+        depth(peer)
+    return depths
+
+
+def request_latencies(traces):
+    """(peer, neighbor, piece, seconds) from each REQUEST we sent to the PIECE answering it."""
+    out = []
+    for trace in traces:
+        asked = {}
+        for t, direction, neighbor, mtype, piece, _ in trace.records:
+            if direction == SEND and mtype == REQUEST:
+                asked.setdefault((neighbor, piece), t)
+            elif direction == RECV and mtype == PIECE:
+                sent = asked.pop((neighbor, piece), None)
+                if sent is not None:
+                    out.append((trace.peer_id, neighbor, piece, t - sent))
+    return out
+
+
+def idle_links(traces):
+    """
+    (peer, neighbor) -> (active, idle) seconds. A link is active from our
+    first REQUEST to it until the last PIECE it sent us; idle is the part of
+    that with no request to it outstanding. A piece that arrives from anyone
+    stops counting as outstanding everywhere (requests are reassigned when
+    they miss their deadline).
+    """
+    out = {}
+    for trace in traces:
+        outstanding = {}   # neighbor -> set of pieces asked of it
+        first = {}
+        last_piece = {}
+        idle = {}
+        idle_since = {}
+        for t, direction, neighbor, mtype, piece, _ in trace.records:
+            if direction == SEND and mtype == REQUEST:
+                pending = outstanding.setdefault(neighbor, set())
+                first.setdefault(neighbor, t)
+                if not pending and neighbor in idle_since:
+                    idle[neighbor] = idle.get(neighbor, 0.0) + t - idle_since.pop(neighbor)
+                pending.add(piece)
+            elif direction == RECV and mtype == PIECE:
+                if neighbor in first:
+                    last_piece[neighbor] = t
+                for nb, pending in outstanding.items():
+                    if piece in pending:
+                        pending.discard(piece)
+                        if not pending:
+                            idle_since[nb] = t
+        for neighbor, begin in first.items():
+            if neighbor not in last_piece:
+                continue
+            # Idle time after the last piece is not part of the active span
+            active = last_piece[neighbor] - begin
+            out[(trace.peer_id, neighbor)] = (active, min(active, idle.get(neighbor, 0.0)))
+    return out
+
+
+def completion(traces):
+    """
+    peer -> {'pieces', 'first', 'half', 'done'} in seconds. 'done' is when
+    the peer sent DONE, or its last received piece if it never did.
+    """
+    out = {}
+    for trace in traces:
+        done = next((t for t, direction, _, mtype, _, _ in trace.records
+                     if direction == SEND and mtype == DONE), None)
+        seen = set()
+        received = []
+        duplicates = 0
+        for t, direction, _, mtype, piece, _ in trace.records:
+            if direction == RECV and mtype == PIECE:
+                if piece in seen:
+                    duplicates += 1
+                else:
+                    seen.add(piece)
+                    received.append(t)
+        out[trace.peer_id] = {
+            'pieces': len(received),
+            'duplicates': duplicates,
+            'first': received[0] if received else None,
+            'half': received[(len(received) - 1) // 2] if received else None,
+            'done': done if done is not None else (received[-1] if received else None),
+        }
+    return out
+
+
+def _pct(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def summarize(traces):
+    """Everything the text report prints, as plain data (times from swarm start)."""
+    t0 = start_time(traces)
+    trees = propagation(traces)
+    depths = [max(tree_depths(tree).values()) for tree in trees.values() if tree]
+    spreads = [max(t for _, t in tree.values()) - min(t for _, t in tree.values())
+               for tree in trees.values() if tree]
+    latencies = [s for _, _, _, s in request_latencies(traces)]
+    links = idle_links(traces)
+    active = sum(a for a, _ in links.values())
+    idle = sum(i for _, i in links.values())
+    rel = lambda t: None if t is None else t - t0
+    return {
+        'peers': len(traces),
+        'frames': sum(len(t.records) for t in traces),
+        'pieces_traced': len(trees),
+        'tree_depth': {'mean': sum(depths) / len(depths) if depths else 0.0,
+                       'max': max(depths, default=0)},
+        'spread_s': {'p50': _pct(spreads, 0.5), 'p90': _pct(spreads, 0.9),
+                     'max': max(spreads, default=0.0)},
+        'request_latency_s': {'count': len(latencies), 'p50': _pct(latencies, 0.5),
+                              'p90': _pct(latencies, 0.9), 'p99': _pct(latencies, 0.99),
+                              'max': max(latencies, default=0.0)},
+        'links': {f"{p}<-{n}": {'active_s': a, 'idle_s': i} for (p, n), (a, i) in sorted(links.items())},
+        'idle_fraction': idle / active if active else 0.0,
+        'completion': {peer: {k: (rel(v) if k in ('first', 'half', 'done') else v)
+                              for k, v in c.items()}
+                       for peer, c in sorted(completion(traces).items())},
+    }
+
+
+def report(traces):
+    s = summarize(traces)
+    fmt = lambda t: '-' if t is None else f"{t:.3f}"
+    lat = s['request_latency_s']
+    lines = [
+        f"{s['peers']} peers, {s['frames']} frames, {s['pieces_traced']} pieces transferred",
+        f"propagation: tree depth mean {s['tree_depth']['mean']:.2f} max {s['tree_depth']['max']}, "
+        f"spread p50 {s['spread_s']['p50']:.3f}s p90 {s['spread_s']['p90']:.3f}s max {s['spread_s']['max']:.3f}s",
+        f"request -> piece: {lat['count']} samples, p50 {lat['p50'] * 1000:.1f}ms p90 {lat['p90'] * 1000:.1f}ms "
+        f"p99 {lat['p99'] * 1000:.1f}ms max {lat['max'] * 1000:.1f}ms",
+        f"links idle {s['idle_fraction'] * 100:.1f}% of their active time",
+        "",
+        f"{'link':<16}{'active_s':>10}{'idle_s':>10}",
+    ]
+    for name, link in s['links'].items():
+        lines.append(f"{name:<16}{link['active_s']:>10.3f}{link['idle_s']:>10.3f}")
+    lines += ["", f"{'peer':<8}{'pieces':>8}{'dups':>6}{'first_s':>10}{'half_s':>10}{'done_s':>10}"]
+    for peer, c in sorted(s['completion'].items(), key=lambda item: (item[1]['done'] is None, item[1]['done'] or 0)):
+        lines.append(f"{peer:<8}{c['pieces']:>8}{c['duplicates']:>6}{fmt(c['first']):>10}"
+                     f"{fmt(c['half']):>10}{fmt(c['done']):>10}")
+    return "\n".join(lines)
+
+
+def piece_tree(traces, piece):
+    """Indented propagation tree of one piece."""
+    tree = propagation(traces).get(piece, {})
+    if not tree:
+        return f"piece {piece} was not transferred"
+    t0 = start_time(traces)
+    children = {}
+    for peer, (parent, t) in tree.items():
+        children.setdefault(parent, []).append((t, peer))
+    roots = sorted(p for p in children if p not in tree)
+    lines = [f"piece {piece}"]
+
+    def walk(peer, indent):
+        for t, child in sorted(children.get(peer, ())):
+            lines.append(f"{'  ' * indent}{child}  +{t - t0:.3f}s")
+            walk(child, indent + 1)
+
+    for root in roots:
+        lines.append(f"  {root}")
+        walk(root, 2)
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Merge and analyze trace_peer_<id>.bin files.")
+    parser.add_argument('traces', nargs='+')
+    parser.add_argument('--piece', type=int, help="print the propagation tree of this piece")
+    parser.add_argument('--json', action='store_true', help="print the summary as JSON")
+    args = parser.parse_args(argv)
+    traces = [load_trace(path) for path in args.traces]
+    if args.piece is not None:
+        print(piece_tree(traces, args.piece))
+    elif args.json:
+        print(json.dumps(summarize(traces), indent=2))
+    else:
+        print(report(traces))
+
+
+if __name__ == "__main__":
+    main()
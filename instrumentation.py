@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""
+Instrumentation for a running peer
+- Metrics: latency histograms (log2 buckets, a few list increments per
+  sample) for each message type in process_message, each choking round and
+  each storage call.
+- ThreadProfiler: cProfile across the peer's threads, toggled with SIGUSR1.
+- tracemalloc snapshots, toggled with SIGUSR2.
+
+Output files are written next to log_peer_<id>.log:
+    metrics_peer_<id>.log                 (every MetricsInterval seconds)
+    profile_peer_<id>_<time>.prof         (open with python -m pstats)
+    tracemalloc_peer_<id>_<time>.txt / .snapshot
+"""
+
+import cProfile
+import functools
+import pstats
+import signal
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+
+NUM_BUCKETS = 40   # bucket b holds samples below 2**b microseconds
+
+
+class Histogram:
+    """
+    Latency histogram with power-of-two microsecond buckets. Updates take no
+    lock; under heavy contention a few samples may be lost, which is fine
+    for profiling.
+    """
+
+    def __init__(self):
+        self.counts = [0] * NUM_BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        bucket = min(NUM_BUCKETS - 1, int(seconds * 1_000_000).bit_length())
+        self.counts[bucket] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, q):
+        """Upper bound (seconds) of the bucket holding the q-th quantile."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bucket, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return (1 << bucket) / 1_000_000
+        return self.max
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+
+class Metrics:
+    """Named histograms, created on first use."""
+
+    def __init__(self):
+        self.histograms = {}
+
+    def record(self, name, seconds):
+        hist = self.histograms.get(name)
+        if hist is None:
+            hist = self.histograms.setdefault(name, Histogram())
+        hist.record(seconds)
+
+    def report(self):
+        """One line per histogram: count, mean, p50, p99, max (milliseconds)."""
+        lines = [f"{'name':<24}{'count':>9}{'mean_ms':>10}{'p50_ms':>10}{'p99_ms':>10}{'max_ms':>10}"]
+        for name in sorted(self.histograms):
+            h = self.histograms[name]
+            lines.append(f"{name:<24}{h.count:>9}{h.mean() * 1000:>10.3f}"
+                         f"{h.percentile(0.5) * 1000:>10.3f}{h.percentile(0.99) * 1000:>10.3f}"
+                         f"{h.max * 1000:>10.3f}")
+        return "\n".join(lines)
+
+    def flush(self, path):
+        with open(path, "a") as f:
+            f.write(f"[{datetime.now().strftime('%H:%M:%S')}]\n{self.report()}\n\n")
+
+
+def timed(name):
+    """Method decorator: record the call's duration in self.metrics under name."""
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(self, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(self, *args, **kwargs)
+            finally:
+                self.metrics.record(name, time.perf_counter() - start)
+        return wrapper
+    return decorate
+
+
+class ThreadProfiler:
+    """
+    cProfile only sees the thread that enabled it, so every thread gets a
+    Profile of its own. Threads call checkpoint() from their loops (message
+    handlers, the scheduler, disk workers), and that is where they start or
+    stop their Profile after start()/stop(). stop() waits briefly for the
+    threads to hand theirs in and merges them into one file.
+    """
+
+    def __init__(self):
+        self.active = False
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.finished = []   # disabled Profiles waiting to be merged
+        self.running = 0     # threads with an enabled Profile
+
+    def checkpoint(self):
+        profile = getattr(self.local, 'profile', None)
+        if self.active:
+            if profile is None:
+                profile = cProfile.Profile()
+                self.local.profile = profile
+                with self.lock:
+                    self.running += 1
+                profile.enable()
+        elif profile is not None:
+            profile.disable()
+            self.local.profile = None
+            with self.lock:
+                self.finished.append(profile)
+                self.running -= 1
+
+    def start(self):
+        with self.lock:
+            self.finished = []
+        self.active = True
+
+    def stop(self, path, wait=2.0):
+        """
+        Stop profiling and write the merged stats to path. Returns
+        (threads included, threads that never reached a checkpoint in time).
+        """
+        self.active = False
+        deadline = time.monotonic() + wait
+        while self.running and time.monotonic() < deadline:
+            time.sleep(0.05)
+        with self.lock:
+            profiles, self.finished = self.finished, []
+            late = self.running
+        if profiles:
+            stats = pstats.Stats(profiles[0])
+            for p in profiles[1:]:
+                stats.add(p)
+            stats.dump_stats(path)
+        return len(profiles), late
+
+
+def toggle_tracemalloc(prefix, frames=25, top=30):
+    """
+    Start tracing allocations, or, if already tracing, write a snapshot
+    (prefix.snapshot, loadable with tracemalloc.Snapshot.load) and the top
+    allocation sites (prefix.txt), then stop. Returns the text path or None.
+    """
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(frames)
+        return None
+    snapshot = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    snapshot.dump(prefix + ".snapshot")
+    with open(prefix + ".txt", "w") as f:
+        for stat in snapshot.statistics('lineno')[:top]:
+            f.write(f"{stat}\n")
+    return prefix + ".txt"
+
+
+def install_signal_handlers(peer):
+    """SIGUSR1 toggles cProfile, SIGUSR2 toggles tracemalloc (main thread, POSIX only)."""
+    if not hasattr(signal, 'SIGUSR1'):
+        return
+
+    def stamp():
+        return f"peer_{peer.peer_id}_{datetime.now().strftime('%H%M%S')}"
+
+    def on_usr1(signum, frame):
+        if not peer.profiler.active:
+            peer.profiler.start()
+            peer.log(f"Peer {peer.peer_id} started cProfile.")
+            return
+        path = f"profile_{stamp()}.prof"
+
+        def finish():
+            included, late = peer.profiler.stop(path)
+            peer.log(f"Peer {peer.peer_id} wrote cProfile of {included} threads to {path}"
+                     + (f" ({late} idle threads left out)" if late else "") + ".")
+        # Waiting for the threads happens off the signal handler
+        threading.Thread(target=finish, daemon=True).start()
+
+    def on_usr2(signum, frame):
+        written = toggle_tracemalloc(f"tracemalloc_{stamp()}")
+        if written:
+            peer.log(f"Peer {peer.peer_id} wrote tracemalloc snapshot to {written}.")
+        else:
+            peer.log(f"Peer {peer.peer_id} started tracemalloc.")
+
+    signal.signal(signal.SIGUSR1, on_usr1)
+    signal.signal(signal.SIGUSR2, on_usr2)
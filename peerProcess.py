@@ -4,6 +4,13 @@ P2P File Sharing Implementation - Core Functions
 This file extends the existing P2P_init.py with essential functionality
 """
 
+import argparse
+import collections
+import heapq
+import http.client
+import ipaddress
+import itertools
+import json
 import math
 import random
 import socket
@@ -12,8 +19,17 @@ import sys
 import threading
 import time
 import struct
+import urllib.request
 from datetime import datetime
+from urllib.parse import urlencode, urlsplit
 import P2P_init
+import delta_sync
+import frame_trace
+import instrumentation
+import piece_store
+import sharding
+import udp_transport
+from instrumentation import timed
 
 from P2P_init import (
     init_Common, handshake, PeerInfo_init, peer_info
@@ -29,17 +45,134 @@ BITFIELD = 5
 REQUEST = 6
 PIECE = 7
 DONE = 8
+PEX = 9        # peer exchange: addresses of other swarm members
+KEEP_ALIVE = 10  # empty frame so idle but healthy connections aren't reaped
+HAVE_ALL = 11    # instead of a BITFIELD with every piece (compact bitfields only)
+HAVE_NONE = 12   # instead of a BITFIELD with no pieces (compact bitfields only)
+BITFIELD_RLE = 13  # run-length encoded BITFIELD (compact bitfields only)
+PONG = 14        # echoes the token of a KEEP_ALIVE that carried one (pings only)
+
+# Histogram names for process_message timings
+MESSAGE_NAMES = {
+    CHOKE: 'msg.CHOKE', UNCHOKE: 'msg.UNCHOKE', INTERESTED: 'msg.INTERESTED',
+    NOT_INTERESTED: 'msg.NOT_INTERESTED', HAVE: 'msg.HAVE', BITFIELD: 'msg.BITFIELD',
+    REQUEST: 'msg.REQUEST', PIECE: 'msg.PIECE', DONE: 'msg.DONE', PEX: 'msg.PEX',
+    KEEP_ALIVE: 'msg.KEEP_ALIVE', HAVE_ALL: 'msg.HAVE_ALL', HAVE_NONE: 'msg.HAVE_NONE',
+    BITFIELD_RLE: 'msg.BITFIELD_RLE', PONG: 'msg.PONG',
+}
+
+# Feature flags in the last reserved handshake byte; a feature is used on a
+# connection only if both ends set its flag
+FEATURE_COMPACT_BITFIELD = 0x01   # HAVE_ALL, HAVE_NONE and BITFIELD_RLE
+FEATURE_PING = 0x02               # KEEP_ALIVE with a token is answered by PONG
+FEATURES = FEATURE_COMPACT_BITFIELD | FEATURE_PING
+
+# PEX entry flags
+PEX_FLAG_SEED = 0x01
+MAX_PEX_ADDED = 50      # entries per PEX message
+MAX_KNOWN_PEERS = 1000  # addresses we remember from PEX
+
+# Peer id of the HTTP web seed in self.connections (real peer ids start at 1)
+WEB_SEED_ID = 0
+PIECE_STORE_ID = -1     # from_peer_id of pieces copied out of the local piece store
+WEB_SEED_RETRY = 5.0    # seconds the web seed stays choked after an HTTP error
+
+# Piece priorities for partial downloads
+PRIORITY_SKIP = 0
+PRIORITY_NORMAL = 1
+PRIORITY_HIGH = 2
+PRIORITIES = {'skip': PRIORITY_SKIP, 'normal': PRIORITY_NORMAL, 'high': PRIORITY_HIGH}
 
 # Optional local helper (not strictly needed but kept)
 NUM_PIECES = 0
 
+# Adaptive upload slots (AdaptiveUploadSlots 1), see UploadSlotController
+SLOT_GROWTH = 1.1      # an added slot must raise the upload rate by 10% to stay
+SLOT_COLLAPSE = 0.5    # drop a slot when the per-slot rate falls below half its peak
+SLOT_PEAK_DECAY = 0.95 # per round, so the peak follows lasting changes
+SLOT_SMOOTHING = 0.5   # weight of the newest round in the smoothed per-slot rate
+SLOT_HOLD_ROUNDS = 5   # rounds without adding after a slot was taken back
+
+# Request deadlines: never tighter than this, never looser than RequestTimeout
+MIN_REQUEST_DEADLINE = 1.0
+REQUEST_CHECK_INTERVAL = 1.0   # seconds between overdue-request sweeps
+STOP_LINGER = 1.0   # seconds stop() waits for neighbors to close after our last frames
+
+# Socket buffers sized from the bandwidth-delay product (SocketBufferMax)
+BUFFER_TUNE_INTERVAL = 5.0   # seconds between resizing rounds
+BDP_HEADROOM = 2             # buffer = this many bandwidth-delay products, so a capped link can double
+SOCKET_BUFFER_MIN = 64 * 1024
+
 def calculate_num_pieces():
     """Calculate number of pieces based on file size and piece size."""
     global NUM_PIECES
-    NUM_PIECES = math.ceil(P2P_init.FILE_SIZE / P2P_init.PIECE_SIZE)
+    NUM_PIECES = -(-P2P_init.FILE_SIZE // P2P_init.PIECE_SIZE)
     return NUM_PIECES
 
 
+def piece_length(piece_index):
+    """Bytes in piece_index; only the last piece may be short."""
+    return min(P2P_init.PIECE_SIZE, P2P_init.FILE_SIZE - piece_index * P2P_init.PIECE_SIZE)
+
+
+def drain_socket(sock, timeout):
+    """Half-close sock, then read and discard until the other end closes or timeout passes."""
+    try:
+        sock.shutdown(socket.SHUT_WR)
+        sock.settimeout(timeout)
+        while sock.recv(65536):
+            pass
+    except (OSError, AttributeError):
+        # AttributeError: the web seed's stand-in socket can't half-close
+        pass
+
+
+def tune_socket(sock):
+    """Options for a new TCP connection: with TcpNoDelay, small frames are not held back by Nagle."""
+    if P2P_init.TCP_NODELAY:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+def can_cork(sock):
+    """Whether sock is a TCP socket we may cork (TcpNoDelay on, and Linux)."""
+    return P2P_init.TCP_NODELAY and hasattr(socket, 'TCP_CORK') and isinstance(sock, socket.socket)
+
+
+def set_cork(sock, corked):
+    """
+    While corked (TCP_CORK, Linux) the kernel only sends full segments;
+    uncorking pushes out the rest.
+    """
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1 if corked else 0)
+    except OSError:
+        pass
+
+
+def socket_buffer_size(rate, rtt, cap):
+    """Buffer for a link moving rate bytes/s at rtt seconds, within [SOCKET_BUFFER_MIN, cap]."""
+    return max(SOCKET_BUFFER_MIN, min(cap, int(BDP_HEADROOM * rate * rtt)))
+
+
+def parse_range(spec):
+    """
+    Parse a --range spec 'START-END[:PRIORITY]' into (start, end, priority).
+    START and END are inclusive byte offsets like an HTTP Range; an empty END
+    means end of file. The returned end is exclusive.
+    """
+    span, _, name = spec.partition(':')
+    if name and name not in PRIORITIES:
+        raise ValueError(f"unknown priority {name!r} (expected skip, normal or high)")
+    start, sep, end = span.partition('-')
+    if not sep:
+        raise ValueError(f"bad range {spec!r} (expected START-END)")
+    start = int(start)
+    end = int(end) + 1 if end else P2P_init.FILE_SIZE
+    if start < 0 or end <= start:
+        raise ValueError(f"bad range {spec!r}")
+    return start, end, PRIORITIES[name or 'normal']
+
+
 def create_message(message_type, payload=b''):
     """Create a message with length prefix."""
     length = len(payload)
@@ -48,6 +181,13 @@ def create_message(message_type, payload=b''):
 def create_done():
     return create_message(DONE)
 
+def create_keep_alive(token=None):
+    """A keep-alive; with a 4-byte token it is also a ping, answered by PONG."""
+    return create_message(KEEP_ALIVE, b'' if token is None else struct.pack('>I', token))
+
+def create_pong(token_bytes):
+    return create_message(PONG, token_bytes)
+
 def create_choke():
     return create_message(CHOKE)
 
@@ -67,6 +207,15 @@ def create_have(piece_index):
 def create_bitfield(bitfield_bytes):
     return create_message(BITFIELD, bitfield_bytes)
 
+def create_have_all():
+    return create_message(HAVE_ALL)
+
+def create_have_none():
+    return create_message(HAVE_NONE)
+
+def create_bitfield_rle(rle_bytes):
+    return create_message(BITFIELD_RLE, rle_bytes)
+
 def create_request(piece_index):
     payload = struct.pack('>I', piece_index)
     return create_message(REQUEST, payload)
@@ -75,6 +224,37 @@ def create_piece(piece_index, piece_data):
     payload = struct.pack('>I', piece_index) + piece_data
     return create_message(PIECE, payload)
 
+def create_pex(added, dropped):
+    """
+    added: list of (peer_id, host, port, flags), dropped: list of peer_ids.
+    Payload: count(2) + [id(4) port(2) flags(1) hostlen(1) host]...
+             count(2) + [id(4)]...
+    """
+    payload = struct.pack('>H', len(added))
+    for peer_id, host, port, flags in added:
+        host_bytes = host.encode('utf-8')[:255]
+        payload += struct.pack('>IHBB', peer_id, port, flags, len(host_bytes)) + host_bytes
+    payload += struct.pack('>H', len(dropped))
+    for peer_id in dropped:
+        payload += struct.pack('>I', peer_id)
+    return create_message(PEX, payload)
+
+def parse_pex(payload):
+    """Inverse of create_pex: returns (added, dropped)."""
+    added = []
+    (count,) = struct.unpack_from('>H', payload, 0)
+    pos = 2
+    for _ in range(count):
+        peer_id, port, flags, host_len = struct.unpack_from('>IHBB', payload, pos)
+        pos += 8
+        host = bytes(payload[pos:pos + host_len]).decode('utf-8', errors='replace')
+        pos += host_len
+        added.append((peer_id, host, port, flags))
+    (count,) = struct.unpack_from('>H', payload, pos)
+    pos += 2
+    dropped = [struct.unpack_from('>I', payload, pos + 4 * i)[0] for i in range(count)]
+    return added, dropped
+
 def parse_message(data):
     """Parse message and return (message_type, payload)."""
     if len(data) < 5:
@@ -98,11 +278,64 @@ def parse_handshake(data):
     peer_id = int.from_bytes(data[28:32], byteorder='big')
     return peer_id
 
+def parse_handshake_features(data):
+    """Feature flags from a handshake (0 from peers that predate them)."""
+    if len(data) != 32:
+        return 0
+    return data[27]
+
+def address_locality(local, remote):
+    """1.0 if IP address remote is on our host, 0.5 if on our subnet (/24, or /64 for IPv6), else 0."""
+    try:
+        ours = ipaddress.ip_address(local)
+        theirs = ipaddress.ip_address(remote)
+    except ValueError:
+        return 0.0
+    if ours == theirs or theirs.is_loopback:
+        return 1.0
+    prefix = 24 if theirs.version == 4 else 64
+    if ours.version == theirs.version and theirs in ipaddress.ip_network(f"{ours}/{prefix}", strict=False):
+        return 0.5
+    return 0.0
+
+def decode_bitfield(message_type, payload):
+    """Bitfield from a BITFIELD, BITFIELD_RLE, HAVE_ALL or HAVE_NONE payload."""
+    bitfield = Bitfield(P2P_init.NUM_PIECES, message_type == HAVE_ALL)
+    if message_type == BITFIELD:
+        bitfield.from_bytes(payload)
+    elif message_type == BITFIELD_RLE:
+        bitfield.from_rle(payload)
+    return bitfield
+
+def _put_varint(out, value):
+    """Append value to bytearray out as an LEB128 varint."""
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+def _get_varint(data, pos):
+    """Read an LEB128 varint at pos: (value, next pos). ValueError if malformed."""
+    value = shift = 0
+    while True:
+        if pos >= len(data) or shift > 63:
+            raise ValueError("malformed varint")
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+
+# bytes.translate tables between one byte per piece (0/1) and '0'/'1' digits
+_DIGITS_TO_BITS = bytes.maketrans(b'01', b'\x00\x01')
+_BITS_TO_DIGITS = bytes.maketrans(b'\x00\x01', b'01')
+
 
 class Bitfield:
     def __init__(self, num_pieces, has_file=False):
         self.num_pieces = num_pieces
-        self.num_bytes = math.ceil(num_pieces / 8)
+        self.num_bytes = (num_pieces + 7) // 8
         if has_file:
             self.bits = [True] * num_pieces
         else:
@@ -116,22 +349,71 @@ class Bitfield:
         if 0 <= piece_index < self.num_pieces:
             return self.bits[piece_index]
         return False
-    
+
+    # The codecs below work a byte string with one 0/1 byte per piece at a
+    # time (bytes() of the bits, whether a list or a shared '?' view), so
+    # a bitfield of millions of pieces never goes through a per-bit loop
+    def _assign(self, raw):
+        """Set the first len(raw) pieces from a string of 0/1 bytes."""
+        values = memoryview(raw).cast('?')
+        if isinstance(self.bits, list):
+            values = values.tolist()
+        self.bits[:len(raw)] = values
+
     def to_bytes(self):
-        byte_array = bytearray(self.num_bytes)
-        for i in range(self.num_pieces):
-            if self.bits[i]:
-                byte_index = i // 8
-                bit_index = 7 - (i % 8)
-                byte_array[byte_index] |= (1 << bit_index)
-        return bytes(byte_array)
+        if not self.num_pieces:
+            return b''
+        digits = bytes(self.bits).translate(_BITS_TO_DIGITS)
+        digits += b'0' * (8 * self.num_bytes - self.num_pieces)
+        # Binary int conversions take linear time
+        return int(digits, 2).to_bytes(self.num_bytes, 'big')
     
     def from_bytes(self, data):
-        for i in range(self.num_pieces):
-            byte_index = i // 8
-            bit_index = 7 - (i % 8)
-            if byte_index < len(data):
-                self.bits[i] = bool(data[byte_index] & (1 << bit_index))
+        count = min(self.num_pieces, 8 * len(data))
+        if not count:
+            return
+        digits = format(int.from_bytes(data, 'big'), f'0{8 * len(data)}b').encode()
+        self._assign(digits[:count].translate(_DIGITS_TO_BITS))
+
+    def to_rle(self):
+        """
+        Run-length encoding: the value of the first run (0 or 1), then the
+        length of each run as a varint, values alternating.
+        """
+        raw = bytes(self.bits)
+        value = raw[0] if raw else 0
+        out = bytearray([value])
+        pos = 0
+        while pos < self.num_pieces:
+            end = raw.find(b'\x00' if value else b'\x01', pos)
+            if end < 0:
+                end = self.num_pieces
+            _put_varint(out, end - pos)
+            pos = end
+            value ^= 1
+        return bytes(out)
+
+    def from_rle(self, data):
+        """Inverse of to_rle. ValueError unless the runs cover exactly num_pieces."""
+        if not data or data[0] > 1:
+            raise ValueError("malformed run-length bitfield")
+        value = data[0]
+        pos = 1
+        total = 0
+        runs = []
+        while pos < len(data):
+            run, pos = _get_varint(data, pos)
+            total += run
+            if total > self.num_pieces:
+                raise ValueError("run-length bitfield longer than the file")
+            runs.append(b'\x01' * run if value else bytes(run))
+            value ^= 1
+        if total != self.num_pieces:
+            raise ValueError("run-length bitfield shorter than the file")
+        self._assign(b''.join(runs))
+
+    def count(self):
+        return bytes(self.bits).count(1)
     
     def is_complete(self):
         return all(self.bits)
@@ -151,13 +433,776 @@ class Bitfield:
                 missing.append(i)
         return missing
 
-class Peer:
 
-    def __init__(self, peer_id):
+class UploadSlotController:
+    """
+    Picks how many neighbors to unchoke by hill climbing on the measured
+    upload rate. One more slot is tried while the total rate keeps growing;
+    the last slot is taken back when it added less than SLOT_GROWTH, and a
+    slot is dropped when the rate per slot collapses (the link is split
+    too many ways). Rounds where fewer neighbors were interested than we had
+    slots say nothing about capacity and leave the count alone.
+    """
+
+    def __init__(self, slots, low, high):
+        self.low = max(1, low)
+        self.high = max(self.low, high)
+        self.slots = min(max(slots, self.low), self.high)
+        self.last_rate = None      # bytes/s in the previous round
+        self.probe_base = None     # rate before the slot being tried was added
+        self.per_slot = None       # smoothed bytes/s per unchoked neighbor
+        self.peak_per_slot = 0.0
+        self.hold = 0
+
+    def update(self, rate, used):
+        """
+        rate: bytes/s uploaded last round with used slots unchoked.
+        Returns (new slot count, reason) on a change, else None.
+        """
+        previous, self.last_rate = self.last_rate, rate
+        probe_base, self.probe_base = self.probe_base, None
+        if used < self.slots:
+            return None
+        # One round holds few pieces; judge the per-slot rate smoothed
+        per_slot = rate / used
+        if self.per_slot is not None:
+            per_slot = SLOT_SMOOTHING * per_slot + (1 - SLOT_SMOOTHING) * self.per_slot
+        self.per_slot = per_slot
+        self.peak_per_slot = max(per_slot, self.peak_per_slot * SLOT_PEAK_DECAY)
+        self.hold = max(0, self.hold - 1)
+        if self.slots > self.low and per_slot < SLOT_COLLAPSE * self.peak_per_slot:
+            self.slots -= 1
+            return self.slots, f"rate per slot fell to {per_slot:.0f} B/s of a {self.peak_per_slot:.0f} B/s peak"
+        if probe_base is not None and rate < probe_base * SLOT_GROWTH:
+            self.slots -= 1
+            self.hold = SLOT_HOLD_ROUNDS
+            return self.slots, f"the last slot raised the upload rate only to {rate:.0f} B/s from {probe_base:.0f} B/s"
+        if (self.slots < self.high and not self.hold
+                and (previous is None or probe_base is not None or rate >= previous * SLOT_GROWTH)):
+            self.slots += 1
+            self.probe_base = rate
+            return self.slots, f"upload rate {rate:.0f} B/s is still growing"
+        return None
+
+
+class InFlightRegistry:
+    """
+    Pieces we have asked for and not yet received, shared by all neighbors:
+    piece index -> (neighbor id, request time, deadline).
+    The picker skips pieces in here so two neighbors are never asked for the
+    same piece. Safe to use from the per-connection threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._requests = {}
+        self.duplicate_pieces = 0     # pieces that arrived when we already had them
+        self.duplicate_bytes = 0
+
+    def __contains__(self, piece_index):
+        return piece_index in self._requests
+
+    def __len__(self):
+        return len(self._requests)
+
+    def claim(self, piece_index, peer_id, now, deadline=math.inf):
+        """Record a request for piece_index to peer_id. False if already in flight."""
+        with self._lock:
+            if piece_index in self._requests:
+                return False
+            self._requests[piece_index] = (peer_id, now, deadline)
+            return True
+
+    def release(self, piece_index):
+        """Forget the request for piece_index. Returns (peer_id, time, deadline) or None."""
+        with self._lock:
+            return self._requests.pop(piece_index, None)
+
+    def release_peer(self, peer_id):
+        """Forget every request outstanding to peer_id and return their pieces."""
+        with self._lock:
+            pieces = [p for p, entry in self._requests.items() if entry[0] == peer_id]
+            for p in pieces:
+                del self._requests[p]
+            return pieces
+
+    def release_overdue(self, now):
+        """Forget requests past their deadline and return them as (piece, peer_id)."""
+        with self._lock:
+            overdue = [(p, entry[0]) for p, entry in self._requests.items() if now >= entry[2]]
+            for p, _ in overdue:
+                del self._requests[p]
+            return overdue
+
+    def get(self, piece_index):
+        """(peer_id, request time, deadline) for piece_index, or None."""
+        with self._lock:
+            return self._requests.get(piece_index)
+
+    def pending(self, peer_id):
+        """Pieces currently requested from peer_id."""
+        with self._lock:
+            return [p for p, entry in self._requests.items() if entry[0] == peer_id]
+
+    def record_duplicate(self, num_bytes):
+        with self._lock:
+            self.duplicate_pieces += 1
+            self.duplicate_bytes += num_bytes
+
+
+class ScheduledCall:
+    """Handle for a job on a Scheduler; pass it to Scheduler.cancel()."""
+
+    def __init__(self, fn, args, interval, in_thread):
+        self.fn = fn
+        self.args = args
+        self.interval = interval   # None = run once
+        self.in_thread = in_thread
+        self.cancelled = False
+
+
+class Scheduler:
+    """
+    Runs periodic and delayed jobs (choking rounds, request sweeps,
+    announces, ...) from one thread, ordered in a heap by a monotonic clock.
+    stop() wakes that thread right away rather than after a sleep. Jobs that
+    can block for a while, like HTTP announces, may ask for in_thread=True
+    and get a short-lived thread of their own so they don't hold up the rest.
+    The thread only starts once something is scheduled; with threaded=False
+    there is none and the owner calls run_pending() itself.
+    """
+
+    def __init__(self, clock=time.monotonic, on_error=None, threaded=True, before_job=None):
+        self.clock = clock
+        self.threaded = threaded
+        self.before_job = before_job   # called on the running thread before each job
+        self.on_error = on_error
+        self.cond = threading.Condition()
+        self.heap = []      # (when, seq, ScheduledCall)
+        self.seq = itertools.count()
+        self.stopped = False
+        self.thread = None
+
+    def call_later(self, delay, fn, *args, in_thread=False):
+        """Run fn(*args) once, delay seconds from now."""
+        return self._push(ScheduledCall(fn, args, None, in_thread), delay)
+
+    def call_every(self, interval, fn, *args, first=None, in_thread=False):
+        """
+        Run fn(*args) every interval seconds, measured from the end of the
+        previous run. The first run is after `first` seconds (default interval).
+        """
+        call = ScheduledCall(fn, args, interval, in_thread)
+        return self._push(call, interval if first is None else first)
+
+    def cancel(self, call):
+        # Left in the heap and skipped when it comes up
+        call.cancelled = True
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.heap.clear()
+            self.cond.notify_all()
+
+    def run_pending(self):
+        """Run every job that is due on the calling thread."""
+        while True:
+            with self.cond:
+                if not self.heap or self.heap[0][0] > self.clock():
+                    return
+                _, _, call = heapq.heappop(self.heap)
+            if not call.cancelled:
+                self._invoke(call)
+
+    def _push(self, call, delay):
+        with self.cond:
+            if self.stopped:
+                return call
+            heapq.heappush(self.heap, (self.clock() + delay, next(self.seq), call))
+            if self.threaded and self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+            self.cond.notify()
+        return call
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.stopped:
+                    if not self.heap:
+                        self.cond.wait()
+                        continue
+                    delay = self.heap[0][0] - self.clock()
+                    if delay <= 0:
+                        break
+                    self.cond.wait(delay)
+                if self.stopped:
+                    return
+                _, _, call = heapq.heappop(self.heap)
+            if call.cancelled:
+                continue
+            if call.in_thread:
+                threading.Thread(target=self._invoke, args=(call,), daemon=True).start()
+            else:
+                self._invoke(call)
+
+    def _invoke(self, call):
+        try:
+            if self.before_job:
+                self.before_job()
+            call.fn(*call.args)
+        except Exception as e:
+            if self.on_error:
+                self.on_error(call, e)
+        if call.interval is not None and not call.cancelled:
+            self._push(call, call.interval)
+
+
+class DiskIO:
+    """
+    Piece reads and writes for a Peer. With threads == 0 they run inline on
+    the caller's thread, as before. Otherwise worker threads drain a
+    write-behind queue and serve reads, so socket handlers don't wait on the
+    disk. Queued pieces that are next to each other in the file are merged
+    into one write. At most max_queued jobs wait at a time; past that,
+    write()/read() block the caller. A blocked socket handler stops reading,
+    and TCP pushes back on the sender.
+    """
+    MAX_MERGED_WRITE = 4 * 1024 * 1024   # bytes per merged write
+
+    def __init__(self, peer, threads=0, max_queued=64):
+        self.peer = peer
+        self.threads = threads
+        self.slots = threading.BoundedSemaphore(max(1, max_queued))
+        self.cond = threading.Condition()
+        self.writes = {}      # piece -> (data, on_done), queued
+        self.writing = set()  # pieces a worker is writing right now
+        self.reads = collections.deque()   # (piece, on_done)
+        self.closed = False
+        self.workers = []
+        for _ in range(threads):
+            t = threading.Thread(target=self._worker, daemon=True)
+            t.start()
+            self.workers.append(t)
+
+    def __contains__(self, piece_index):
+        """True while a write for piece_index is queued or running."""
+        # Plain dict/set lookups, safe without the lock
+        return piece_index in self.writes or piece_index in self.writing
+
+    def write(self, piece_index, data, on_done, on_error=None):
+        """
+        Write a piece, then call on_done() once it is on disk, or on_error()
+        if the write failed.
+        """
+        if not self.threads:
+            try:
+                self.peer._write_piece(piece_index, data)
+            except Exception:
+                if on_error:
+                    on_error()
+                raise
+            on_done()
+            return
+        self.slots.acquire()
+        with self.cond:
+            self.writes[piece_index] = (data, on_done, on_error)
+            self.cond.notify()
+
+    def read(self, piece_index, on_done):
+        """Read a piece and call on_done(data); data is None on error."""
+        if not self.threads:
+            on_done(self.peer.read_piece(piece_index))
+            return
+        self.slots.acquire()
+        with self.cond:
+            self.reads.append((piece_index, on_done))
+            self.cond.notify()
+
+    def flush(self, timeout=None):
+        """Wait for queued writes to reach the disk. Returns False on timeout."""
+        with self.cond:
+            return self.cond.wait_for(lambda: not self.writes and not self.writing, timeout)
+
+    def close(self):
+        """Let workers finish what is queued, then exit."""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def join(self, timeout=None):
+        for t in self.workers:
+            t.join(timeout)
+
+    def _take_run(self):
+        """Pop the lowest queued piece plus the queued pieces right after it."""
+        first = min(self.writes)
+        run = []
+        size = 0
+        i = first
+        while i in self.writes and size < self.MAX_MERGED_WRITE:
+            data, on_done, on_error = self.writes.pop(i)
+            self.writing.add(i)
+            run.append((i, data, on_done, on_error))
+            size += len(data)
+            i += 1
+        return run
+
+    def _worker(self):
+        while True:
+            self.peer.profiler.checkpoint()
+            with self.cond:
+                self.cond.wait_for(lambda: self.writes or self.reads or self.closed)
+                if self.writes:
+                    run, read = self._take_run(), None
+                elif self.reads:
+                    run, read = None, self.reads.popleft()
+                else:
+                    return
+            if run:
+                self._write_run(run)
+            else:
+                self._read(*read)
+
+    def _write_run(self, run):
+        try:
+            # Every piece but the last is PIECE_SIZE long, so consecutive
+            # pieces are contiguous in the file
+            self.peer._write_piece(run[0][0], b''.join(data for _, data, _, _ in run))
+            written = True
+        except Exception as e:
+            self.peer.log(f"Error saving pieces {run[0][0]}-{run[-1][0]}: {e}")
+            written = False
+        for piece_index, _, on_done, on_error in run:
+            try:
+                if written:
+                    on_done()
+                elif on_error:
+                    on_error()
+            except Exception as e:
+                self.peer.log(f"Error saving piece {piece_index}: {e}")
+            finally:
+                with self.cond:
+                    self.writing.discard(piece_index)
+                    self.cond.notify_all()
+                self.slots.release()
+
+    def _read(self, piece_index, on_done):
+        try:
+            on_done(self.peer.read_piece(piece_index))
+        except Exception as e:
+            self.peer.log(f"Error serving piece {piece_index}: {e}")
+        finally:
+            self.slots.release()
+
+
+class WebSeed:
+    """
+    An HTTP server holding the whole file, used as a virtual neighbor
+    (WEB_SEED_ID). It stands in for the neighbor's socket: REQUEST frames
+    passed to sendall are fetched with Range requests over one keep-alive
+    connection, and the bytes come back through process_message as PIECE
+    frames, so the picker, deadlines and service-time estimates treat it
+    like any other neighbor. Other frames are dropped. An HTTP error is
+    reported as a CHOKE (releasing the request) and an UNCHOKE follows
+    WEB_SEED_RETRY seconds later.
+    """
+
+    def __init__(self, peer, url):
+        self.peer = peer
+        self.url = url
+        parts = urlsplit(url)
+        self.https = parts.scheme == 'https'
+        self.host = parts.hostname
+        self.port = parts.port
+        self.path = (parts.path or '/') + (f"?{parts.query}" if parts.query else '')
+        self.conn = None          # reused across requests while the server keeps it open
+        self.cond = threading.Condition()
+        self.pending = collections.deque()
+        self.closed = False
+        self.fetched_bytes = 0
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+
+    def sendall(self, data):
+        pos = 0
+        while pos + 5 <= len(data):
+            length = struct.unpack_from('>I', data, pos)[0]
+            if data[pos + 4] == REQUEST:
+                with self.cond:
+                    self.pending.append(struct.unpack_from('>I', data, pos + 5)[0])
+                    self.cond.notify()
+            pos += 5 + length
+
+    def shutdown(self, how):
+        pass
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.pending.clear()
+            self.cond.notify_all()
+
+    def fetch(self, piece_index):
+        """GET one piece with a Range request; raises OSError or HTTPException on failure."""
+        start = piece_index * P2P_init.PIECE_SIZE
+        end = min(start + P2P_init.PIECE_SIZE, P2P_init.FILE_SIZE)
+        for attempt in (1, 2):
+            if self.conn is None:
+                cls = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+                self.conn = cls(self.host, self.port, timeout=P2P_init.REQUEST_TIMEOUT)
+            try:
+                self.conn.request('GET', self.path, headers={'Range': f"bytes={start}-{end - 1}"})
+                resp = self.conn.getresponse()
+                body = resp.read()
+            except (OSError, http.client.HTTPException):
+                self.conn.close()
+                self.conn = None
+                # The server may have closed the idle connection; retry once on a new one
+                if attempt == 2:
+                    raise
+                continue
+            if resp.will_close:
+                self.conn.close()
+                self.conn = None
+            if resp.status == 200:
+                # Server ignored the Range header and sent the whole file
+                body = body[start:end]
+            elif resp.status != 206:
+                raise http.client.HTTPException(f"HTTP {resp.status} {resp.reason}")
+            if len(body) != end - start:
+                raise http.client.HTTPException(f"expected {end - start} bytes, got {len(body)}")
+            return body
+
+    def _worker(self):
+        while True:
+            self.peer.profiler.checkpoint()
+            with self.cond:
+                self.cond.wait_for(lambda: self.pending or self.closed)
+                if self.closed:
+                    break
+                piece_index = self.pending.popleft()
+            if self.peer.bitfield.has_piece(piece_index):
+                continue
+            start = time.perf_counter()
+            try:
+                data = self.fetch(piece_index)
+            except (OSError, http.client.HTTPException) as e:
+                self.peer.log(f"Web seed {self.url} failed on piece {piece_index}: {e}")
+                self._deliver(CHOKE, b'')
+                with self.cond:
+                    self.pending.clear()
+                    if self.cond.wait_for(lambda: self.closed, WEB_SEED_RETRY):
+                        break
+                self._deliver(UNCHOKE, b'')
+                continue
+            self.peer.metrics.record('webseed.fetch', time.perf_counter() - start)
+            self.fetched_bytes += len(data)
+            self._deliver(PIECE, struct.pack('>I', piece_index) + data)
+        if self.conn is not None:
+            self.conn.close()
+
+    def _deliver(self, message_type, payload):
+        try:
+            self.peer.process_message(message_type, payload, WEB_SEED_ID, self)
+        except Exception as e:
+            self.peer.log(f"Error handling web seed data: {e}")
+
+
+class StreamReader:
+    """
+    File-like reader over a peer's download that blocks until the bytes it
+    needs have arrived. Reading moves the peer's streaming cursor, so the
+    pieces just ahead of the reader are fetched first.
+    """
+
+    def __init__(self, peer, position=0):
+        self.peer = peer
+        self.position = position
+        self.closed = False
+
+    def read(self, size=-1, timeout=None):
+        """
+        Return up to size bytes from the current position (all remaining if
+        size < 0), waiting for missing pieces. Returns b'' at end of file, or
+        whatever is available if timeout expires first.
+        """
+        remaining = P2P_init.FILE_SIZE - self.position
+        if size < 0 or size > remaining:
+            size = remaining
+        out = bytearray()
+        while len(out) < size and not self.closed:
+            piece_index = self.position // P2P_init.PIECE_SIZE
+            if not self.peer.wait_for_piece(piece_index, timeout):
+                break
+            piece_end = min((piece_index + 1) * P2P_init.PIECE_SIZE, P2P_init.FILE_SIZE)
+            n = min(size - len(out), piece_end - self.position)
+            with open(self.peer.file_path, "rb") as f:
+                f.seek(self.position)
+                chunk = f.read(n)
+            out += chunk
+            self.position += len(chunk)
+        return bytes(out)
+
+    def __iter__(self):
+        """Yield the file piece by piece as contiguous pieces land."""
+        while not self.closed:
+            chunk = self.read(P2P_init.PIECE_SIZE - self.position % P2P_init.PIECE_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+    def close(self):
+        self.closed = True
+        with self.peer.piece_arrived:
+            self.peer.piece_arrived.notify_all()
+
+
+class NeighborState:
+    """
+    What we know about one connected neighbor. Fields set by the neighbor's
+    own frames (bitfield, peer_choking_me, interested_in_me, last_received)
+    are written only by its reader thread. am_choking belongs to the choking
+    code and changes under Peer.choke_lock. The request bookkeeping (overdue,
+    duplicate_requests, missed_deadlines, service time estimates) is also
+    touched by the request sweep, so it changes under self.lock. send()
+    serializes whole frames on the socket, so frames sent from different
+    threads never interleave. While send_file() streams a large piece,
+    send() queues its frame behind the piece instead of waiting: a reader
+    thread blocked on a long upload would stop draining the neighbor, which
+    may itself be blocked uploading to us.
+    """
+    __slots__ = ('socket', 'outbound', 'bitfield', 'am_choking', 'peer_choking_me',
+                 'interested_in_me', 'im_interested_in_them', 'downloaded_bytes_interval',
+                 'uploaded_bytes', 'srtt', 'rttvar', 'throughput', 'missed_deadlines',
+                 'overdue', 'duplicate_requests', 'pex_sent', 'last_received',
+                 'closed', 'lock', 'send_lock', 'queue_lock', 'uploads', 'queued',
+                 'compact_bitfield', 'pings', 'ping', 'rtt', 'locality', 'upload_mark',
+                 'streamed_requests', 'streaming')
+
+    def __init__(self, sock, now):
+        self.socket = sock
+        self.outbound = False           # True if we dialed this neighbor
+        self.compact_bitfield = False   # both ends speak HAVE_ALL/HAVE_NONE/BITFIELD_RLE
+        self.pings = False              # both ends answer KEEP_ALIVE tokens with PONG
+        self.ping = None                # (token, clock) of the ping awaiting its PONG
+        self.rtt = None                 # smoothed round trip time, seconds
+        self.locality = 0.0             # 1 same host, 0.5 same subnet, 0 elsewhere
+        self.upload_mark = None         # (clock, uploaded_bytes) at the last buffer tuning round
+        self.bitfield = Bitfield(P2P_init.NUM_PIECES, False)
+        self.am_choking = True
+        self.peer_choking_me = True
+        self.interested_in_me = False
+        self.im_interested_in_them = False
+        self.downloaded_bytes_interval = 0
+        self.uploaded_bytes = 0
+        # Request service time (request sent -> piece received), smoothed
+        # like TCP's RTT estimator; None until the first piece arrives
+        self.srtt = None
+        self.rttvar = 0.0
+        self.throughput = 0.0           # bytes/s, smoothed
+        self.missed_deadlines = 0
+        self.overdue = set()            # pieces asked for that missed their deadline
+        self.duplicate_requests = set() # streaming pieces also asked of this neighbor
+        self.pex_sent = {}              # peer_id -> flags last advertised to this neighbor
+        self.last_received = now        # when the neighbor last sent us a frame
+        self.closed = False             # removed from Peer.connections
+        self.lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        self.queue_lock = threading.Lock()  # guards uploads and queued
+        self.uploads = 0                # send_file() calls in progress
+        self.queued = []                # frames sent during an upload, not yet written
+        self.streamed_requests = collections.deque()  # large pieces asked of us, not yet sent
+        self.streaming = False          # a thread is sending streamed_requests
+
+    def queue_streamed(self, piece_index):
+        """
+        Queue a REQUEST for a large piece. True if no thread is sending this
+        neighbor's large pieces yet and the caller has to start one.
+        """
+        with self.queue_lock:
+            if piece_index not in self.streamed_requests:
+                self.streamed_requests.append(piece_index)
+            start, self.streaming = not self.streaming, True
+        return start
+
+    def next_streamed(self):
+        """Next queued large piece, or None once there is none (or we were removed)."""
+        with self.queue_lock:
+            if self.streamed_requests and not self.closed:
+                return self.streamed_requests.popleft()
+            self.streamed_requests.clear()
+            self.streaming = False
+            return None
+
+    def send(self, data):
+        with self.queue_lock:
+            if self.uploads:
+                self.queued.append(bytes(data))
+                return
+            self.send_lock.acquire()
+        try:
+            self.socket.sendall(data)
+        finally:
+            self.send_lock.release()
+
+    def send_piece(self, header, data):
+        """
+        Send a PIECE frame without joining header and data, which would
+        copy the piece. The socket is corked meanwhile, so the header
+        shares a segment with the data instead of going out alone.
+        """
+        # The data continues a frame already traced by sendall
+        sock = getattr(self.socket, 'raw', self.socket)
+        if not can_cork(sock):
+            self.send(header + data)
+            return
+        with self.queue_lock:
+            if self.uploads:
+                self.queued.append(header + data)
+                return
+            self.send_lock.acquire()
+        try:
+            set_cork(sock, True)
+            self.socket.sendall(header)
+            sock.sendall(data)
+        finally:
+            set_cork(sock, False)
+            self.send_lock.release()
+
+    def send_file(self, header, f, offset, count, chunk_size):
+        """
+        Send header, then count bytes of file f from offset, as one frame,
+        then any frames queued meanwhile. The body goes out with sendfile
+        where the socket has it (the kernel copies it), otherwise chunk_size
+        bytes at a time, all of it corked into full segments.
+        """
+        with self.queue_lock:
+            self.uploads += 1
+        # The body continues a frame already traced by sendall
+        sock = getattr(self.socket, 'raw', self.socket)
+        corked = can_cork(sock)
+        with self.send_lock:
+            if corked:
+                set_cork(sock, True)
+            try:
+                self.socket.sendall(header)
+                if hasattr(sock, 'sendfile'):
+                    if sock.sendfile(f, offset, count) != count:
+                        raise OSError("file ended inside a piece")
+                    return
+                f.seek(offset)
+                while count:
+                    chunk = f.read(min(count, chunk_size))
+                    if not chunk:
+                        raise OSError("file ended inside a piece")
+                    sock.sendall(chunk)
+                    count -= len(chunk)
+            finally:
+                try:
+                    self._send_queued()
+                finally:
+                    if corked:
+                        set_cork(sock, False)
+
+    def _send_queued(self):
+        """Write the frames queued during an upload; called holding send_lock."""
+        try:
+            while True:
+                with self.queue_lock:
+                    frames, self.queued = self.queued, []
+                    if not frames:
+                        self.uploads -= 1
+                        return
+                for frame in frames:
+                    self.socket.sendall(frame)
+        except BaseException:
+            # The socket is broken; the reader thread will drop the neighbor
+            with self.queue_lock:
+                self.uploads -= 1
+            raise
+
+    def add_duplicate(self, piece_index):
+        """Note a duplicate request for piece_index; False if one is already out."""
+        with self.lock:
+            if piece_index in self.duplicate_requests:
+                return False
+            self.duplicate_requests.add(piece_index)
+            return True
+
+
+class PieceLocks:
+    """
+    Striped locks over piece indices. Each stripe owns a contiguous range
+    of pieces, so threads working on different parts of the file rarely
+    contend, and a whole-bitfield update takes each stripe once, in order.
+    """
+    STRIPES = 16
+
+    def __init__(self, num_pieces):
+        self.stripes = [threading.Lock() for _ in range(self.STRIPES)]
+        self.span = max(1, math.ceil(num_pieces / self.STRIPES))
+
+    def __call__(self, piece_index):
+        """The lock guarding piece_index."""
+        return self.stripes[min(piece_index // self.span, self.STRIPES - 1)]
+
+    def ranges(self, num_pieces):
+        """(lock, range of pieces) for every stripe, in lock order."""
+        for i, lock in enumerate(self.stripes):
+            start = i * self.span
+            if start >= num_pieces:
+                break
+            yield lock, range(start, min(start + self.span, num_pieces))
+
+
+class Peer:
+    """
+    One member of the swarm.
+
+    Concurrency model. A peer runs the accept loop, one reader thread per
+    neighbor (handle_peer_messages), the scheduler thread (choking rounds,
+    request sweeps, keep-alives, PEX, metrics), DiskIO workers and the web
+    seed worker, all sharing this object. Single dict/list/set operations
+    are atomic (under the GIL, and per object on free-threaded builds);
+    the locks below cover every check-then-act and read-modify-write on
+    shared state:
+
+    - connections_lock: membership of self.connections (register, remove).
+      Everyone else iterates over _neighbors(), a snapshot.
+    - choke_lock: preferred_neighbors, optimistic_neighbor and each
+      neighbor's am_choking. Decisions are made under the lock, the
+      CHOKE/UNCHOKE frames are sent after releasing it.
+    - piece_locks: striped by piece index; our bitfield bits together with
+      the duplicate check in save_piece, and availability counts.
+    - NeighborState.lock / send_lock: see NeighborState.
+    - state_lock: finished_peers, done_broadcast_sent, uploaded_bytes,
+      known_peers and the super-seeding tables.
+    - in_flight, DiskIO and the Scheduler have their own locks.
+
+    Lock order: connections_lock, choke_lock, NeighborState.lock, a piece
+    stripe, then the helper objects' locks. Never hold one of these while
+    sending; send_lock is only ever held around a single sendall, or
+    around one streamed piece (send_file), which others don't wait for.
+    """
+
+    def __init__(self, peer_id, shard=None):
         self.peer_id = peer_id
+        self.shard = shard            # sharding.WorkerLink in a worker process (Workers K)
+
+        # Timings and on-demand profiling (see instrumentation.py)
+        self.metrics = instrumentation.Metrics()
+        self.profiler = instrumentation.ThreadProfiler()
+        self.trace = None             # frame_trace.TraceRecorder when TraceFrames is on
+        self.web_seed = None          # WebSeed when WebSeedURL is set
+        self.manifest = None          # delta manifest, once loaded (see _load_manifest)
+        self.store = None             # piece_store.PieceStore when PieceStore is set
+        self.piece_hashes = None      # SHA-1 of every piece, for the piece store
 
         # STOP FLAGS & SERVER HANDLE
         self.stopped = False          # main loop exit flag
+        self.stop_event = threading.Event()   # set by stop(); peerProcess waits on it
         self.server_socket = None     # gets set in start_server()
 
         if peer_id not in peer_info:
@@ -170,31 +1215,79 @@ class Peer:
         # Bitfield (seeder has full bitfield, leecher has empty)
         self.bitfield = Bitfield(P2P_init.NUM_PIECES, self.has_file)
 
-        # Global completion tracking
-        self.finished_peers = set()
-        if self.has_file:
-            self.finished_peers.add(peer_id)
+        # Global completion tracking. Seeders in PeerInfo.cfg start complete;
+        # a peer that starts complete too (delta sync, piece store) might
+        # otherwise never hear their DONE before they shut down
+        self.finished_peers = {pid for pid, (_, _, has) in peer_info.items() if has}
 
         self.total_peers = set(peer_info.keys())
         self.done_broadcast_sent = False
 
-        # Neighbors: peerID -> state dict
-        # state = {
-        #   'socket': socket,
-        #   'bitfield': Bitfield,
-        #   'am_choking': bool,
-        #   'peer_choking_me': bool,
-        #   'interested_in_me': bool,
-        #   'im_interested_in_them': bool,
-        #   'downloaded_bytes_interval': int
-        # }
+        # Listen addresses of other swarm members: PeerInfo.cfg, then PEX
+        self.known_peers = {
+            pid: (host, port) for pid, (host, port, _) in peer_info.items()
+            if pid != peer_id
+        }
+        self.announced_complete = False   # tracker has been told 'completed'
+        # Tracker swarm has had an incomplete peer (possibly us) since we joined
+        self.seen_leechers = False
+        # Seconds between re-announces: AnnounceInterval until the tracker says
+        self.announce_interval = P2P_init.ANNOUNCE_INTERVAL
+        self.announce_call = None
+
+        # Neighbors: peerID -> NeighborState
         self.connections = {}
+        self.connections_lock = threading.Lock()
         self.preferred_neighbors = set()
         self.optimistic_neighbor = None
+        self.upload_slots = P2P_init.NUMBER_OF_PREFERRED_NEIGHBORS
+        self.slot_control = None
+        if P2P_init.ADAPTIVE_UPLOAD_SLOTS:
+            self.slot_control = UploadSlotController(self.upload_slots, P2P_init.MIN_UPLOAD_SLOTS,
+                                                     P2P_init.MAX_UPLOAD_SLOTS)
+            self.upload_slots = self.slot_control.slots
+        self.slot_round = None   # (clock, uploaded bytes) at the last adaptive round
+        self.choke_lock = threading.Lock()
+        self.state_lock = threading.Lock()   # completion, upload total, known_peers, super-seeding
+
+        # Outstanding requests across all neighbors (piece -> neighbor, time)
+        self.in_flight = InFlightRegistry()
+
+        # How many neighbors have each piece (from BITFIELD/HAVE)
+        self.availability = [0] * P2P_init.NUM_PIECES
+        self.piece_locks = PieceLocks(P2P_init.NUM_PIECES)
+        self.pieces_saving = set()   # being written by save_piece, not yet in the bitfield
+        self.uploaded_bytes = 0
+        if shard is not None:
+            # Bitfield, availability and their locks are shared with the other workers
+            shard.attach(self)
+
+        # Partial downloads: skip pieces are never requested, high ones first.
+        # Completion (DONE, tracker 'left') only counts pieces we want.
+        self.piece_priority = [PRIORITY_NORMAL] * P2P_init.NUM_PIECES
+
+        # Super-seeding: advertise pieces one neighbor at a time instead of
+        # the full bitfield (only meaningful while we are the seeder)
+        self.super_seeding = P2P_init.SUPER_SEEDING and self.bitfield.is_complete()
+        self.super_seed_offers = {}   # neighbor id -> piece currently revealed to it
+        self.super_seed_revealed = {} # neighbor id -> every piece revealed to it
+
+        # Streaming: pieces from read_cursor on get deadlines and are fetched
+        # in order; StreamReader waits on piece_arrived
+        self.read_cursor = 0
+        self.stream_deadlines = {}    # piece -> when the reader needs it
+        self.piece_arrived = threading.Condition()
+        self.clock = time.monotonic   # swapped for a virtual clock by swarm_sim
+
+        # Periodic work (choking rounds, request sweeps, announces, PEX)
+        self.scheduler = Scheduler(on_error=lambda call, e: self.log(
+            f"Error in scheduled {getattr(call.fn, '__name__', call.fn)}: {e}"),
+            before_job=self.profiler.checkpoint)
 
         # LOG FILE MUST BE INITIALIZED BEFORE ANYTHING CALLS self.log()
         self.log_file = f"log_peer_{peer_id}.log"
-        open(self.log_file, "w").close()   # clear file NOW
+        if shard is None:
+            self._init_log_file()
 
         self.log("Peer process started")
         self.log(f"Host={self.host_name} Port={self.port_number} HasFile={self.has_file}")
@@ -202,12 +1295,30 @@ class Peer:
         # File path
         self.file_path = os.path.join(f"peer_{peer_id}", P2P_init.FILE_NAME)
 
-        # Ensure storage exists
-        self._init_file_storage()
+        # Ensure storage exists (the master process already did, for workers)
+        if shard is None:
+            self._init_file_storage()
+        if P2P_init.PIECE_STORE:
+            self._open_piece_store()
+        self.disk = DiskIO(self, P2P_init.DISK_IO_THREADS, P2P_init.DISK_QUEUE_SIZE)
+        if P2P_init.TRACE_FRAMES:
+            self.trace = frame_trace.TraceRecorder(f"trace_peer_{self._file_tag()}.bin", peer_id,
+                                                   P2P_init.NUM_PIECES)
+            self.scheduler.call_every(1.0, self.trace.flush)
 
         # If this peer starts with full file, you *could* log completion here
         if self.bitfield.is_complete() and self.has_file:
             self.log(f"Peer {self.peer_id} starts with the complete file.")
+        elif self.bitfield.is_complete() and shard is not None:
+            # Delta sync or the piece store completed it in the master process
+            self.finished_peers.add(self.peer_id)
+            self.done_broadcast_sent = True
+
+    def _file_tag(self):
+        """Peer id for per-process output files; workers add their index."""
+        if self.shard is None:
+            return str(self.peer_id)
+        return f"{self.peer_id}_w{self.shard.index}"
 
     def _init_file_storage(self):
         """
@@ -221,14 +1332,235 @@ class Peer:
             # We assume the full file is already there
             if not os.path.exists(self.file_path):
                 self.log(f"WARNING: expected full file at {self.file_path} but not found.")
+            elif P2P_init.DELTA_MANIFEST:
+                self._publish_manifest()
         else:
-            # Create an empty file of FILE_SIZE bytes if not exists
+            if P2P_init.DELTA_MANIFEST and os.path.exists(self.file_path):
+                self._delta_sync()
+            # Create a sparse file of FILE_SIZE bytes if not exists; disk
+            # blocks are only allocated for what we write (or want, see
+            # want_ranges)
             if not os.path.exists(self.file_path):
                 with open(self.file_path, "wb") as f:
-                    if P2P_init.FILE_SIZE > 0:
-                        f.seek(P2P_init.FILE_SIZE - 1)
-                        f.write(b'\0')
+                    f.truncate(P2P_init.FILE_SIZE)
 
+    def _publish_manifest(self):
+        """Seeder: write the delta-sync manifest of our file (URLs are published by whoever serves them)."""
+        target = P2P_init.DELTA_MANIFEST
+        if target.startswith(('http://', 'https://')):
+            return
+        self.manifest = delta_sync.build_manifest(self.file_path, P2P_init.PIECE_SIZE)
+        delta_sync.write_manifest(self.manifest, target)
+        self.log(f"Peer {self.peer_id} published delta manifest {target}.")
+
+    def _delta_sync(self):
+        """
+        Reuse what an older copy at file_path shares with the new version:
+        matched pieces are moved into place and marked as ours, everything
+        else is downloaded as usual.
+        """
+        manifest = self._load_manifest("Delta sync")
+        if manifest is None:
+            return
+        start = time.monotonic()
+        matches = delta_sync.find_matches(self.file_path, manifest, P2P_init.DELTA_WORKERS or None)
+        saved = delta_sync.rebuild(self.file_path, manifest, matches)
+        for piece_index in matches:
+            self.bitfield.set_piece(piece_index)
+        self.log(f"Peer {self.peer_id} delta sync reused {len(matches)}/{P2P_init.NUM_PIECES} pieces "
+                 f"from its old copy, {saved} of {P2P_init.FILE_SIZE} bytes saved "
+                 f"({time.monotonic() - start:.2f}s).")
+        if self.bitfield.is_complete():
+            self.finished_peers.add(self.peer_id)
+            self.done_broadcast_sent = True
+
+    def _load_manifest(self, purpose):
+        """The delta manifest if it can be read and matches Common.cfg; None (logged) otherwise."""
+        if self.manifest is not None:
+            return self.manifest
+        try:
+            manifest = delta_sync.load_manifest(P2P_init.DELTA_MANIFEST)
+        except (OSError, ValueError) as e:
+            self.log(f"{purpose} skipped, cannot read manifest {P2P_init.DELTA_MANIFEST}: {e}")
+            return None
+        if (manifest['file_size'] != P2P_init.FILE_SIZE or manifest['piece_size'] != P2P_init.PIECE_SIZE
+                or len(manifest['strong']) != P2P_init.NUM_PIECES):
+            self.log(f"{purpose} skipped, manifest does not match FileSize/PieceSize.")
+            return None
+        self.manifest = manifest
+        return manifest
+
+    def _open_piece_store(self):
+        """
+        Share pieces through the host-wide piece store. Pieces are named by
+        their SHA-1 in the delta manifest, so this needs DeltaManifest. A
+        leecher first takes whatever the store has; a seeder puts its
+        pieces there in the background.
+        """
+        if not P2P_init.DELTA_MANIFEST:
+            self.log("Piece store skipped, it needs DeltaManifest for the piece hashes.")
+            return
+        manifest = self._load_manifest("Piece store")
+        if manifest is None:
+            return
+        try:
+            self.store = piece_store.PieceStore(P2P_init.PIECE_STORE, P2P_init.PIECE_STORE_BUDGET)
+        except OSError as e:
+            self.log(f"Piece store skipped, cannot open {P2P_init.PIECE_STORE}: {e}")
+            return
+        self.piece_hashes = manifest['strong']
+        if self.shard is not None:
+            # The master process already filled or stocked it
+            return
+        if self.bitfield.is_complete():
+            threading.Thread(target=self._stock_piece_store, daemon=True).start()
+        else:
+            self._fill_from_piece_store()
+
+    def _fill_from_piece_store(self):
+        """Startup: copy every missing piece the store has into our file."""
+        start = time.monotonic()
+        taken = 0
+        try:
+            with open(self.file_path, "r+b") as f:
+                for piece_index in range(P2P_init.NUM_PIECES):
+                    if self.bitfield.has_piece(piece_index):
+                        continue
+                    if self.store.copy_out(self.piece_hashes[piece_index], f,
+                                           piece_index * P2P_init.PIECE_SIZE, piece_length(piece_index)):
+                        self.bitfield.set_piece(piece_index)
+                        taken += 1
+        except OSError as e:
+            self.log(f"Error reading the piece store: {e}")
+        self.log(f"Peer {self.peer_id} took {taken}/{P2P_init.NUM_PIECES} pieces from the piece store "
+                 f"({time.monotonic() - start:.2f}s).")
+        if self.bitfield.is_complete():
+            self.finished_peers.add(self.peer_id)
+            self.done_broadcast_sent = True
+
+    def _stock_piece_store(self):
+        """Seeder: put all our pieces in the store."""
+        added = self._stock_pieces(range(P2P_init.NUM_PIECES))
+        self.log(f"Peer {self.peer_id} has {added}/{P2P_init.NUM_PIECES} pieces in the piece store.")
+
+    def _stock_pieces(self, pieces):
+        """Add pieces of our file to the store if they match their hashes. Returns how many are in it."""
+        added = 0
+        try:
+            with open(self.file_path, "rb") as f:
+                for piece_index in pieces:
+                    if self.store.add(self.piece_hashes[piece_index], f,
+                                      piece_index * P2P_init.PIECE_SIZE, piece_length(piece_index)):
+                        added += 1
+                    else:
+                        self.log(f"Piece {piece_index} does not match the manifest, not added to the piece store.")
+        except OSError as e:
+            self.log(f"Error adding to the piece store: {e}")
+        return added
+
+    def _take_from_piece_store(self, piece_index):
+        """Copy piece_index out of the store instead of requesting it. True if it was there."""
+        digest = self.piece_hashes[piece_index]
+        if not self.store.has(digest) or not self._claim_piece_write(piece_index):
+            return False
+        try:
+            with open(self.file_path, "r+b") as f:
+                taken = self.store.copy_out(digest, f, piece_index * P2P_init.PIECE_SIZE,
+                                            piece_length(piece_index))
+        except OSError as e:
+            self.log(f"Error reading piece {piece_index} from the piece store: {e}")
+            taken = False
+        if not taken:
+            self._end_piece_write(piece_index)
+            return False
+        self._piece_stored(piece_index, PIECE_STORE_ID)
+        return True
+
+    def want_ranges(self, ranges):
+        """
+        Download only the given byte ranges: a list of (start, end, priority)
+        with end exclusive, later ranges overriding earlier ones. Pieces
+        outside every range are skipped. Space for the wanted pieces is
+        preallocated so the sparse file only materializes those regions.
+        """
+        self.piece_priority = [PRIORITY_SKIP] * P2P_init.NUM_PIECES
+        for start, end, priority in ranges:
+            self.set_priority(start, end, priority)
+        self.log(f"Peer {self.peer_id} wants {self.num_wanted()} of {P2P_init.NUM_PIECES} pieces.")
+        self._materialize_wanted()
+        self._refresh_interest()
+        self._check_download_complete()
+
+    def set_priority(self, start, end, priority):
+        """Give every piece overlapping bytes [start, end) the priority."""
+        first = max(0, start // P2P_init.PIECE_SIZE)
+        last = min(P2P_init.NUM_PIECES, -(-end // P2P_init.PIECE_SIZE))
+        for i in range(first, last):
+            self.piece_priority[i] = priority
+
+    def wants(self, piece_index):
+        return self.piece_priority[piece_index] != PRIORITY_SKIP
+
+    def num_wanted(self):
+        return sum(1 for p in self.piece_priority if p != PRIORITY_SKIP)
+
+    def download_complete(self):
+        """True once we hold every piece we want (the whole file by default)."""
+        bits = self.bitfield.bits
+        return all(bits[i] for i in range(P2P_init.NUM_PIECES) if self.piece_priority[i] != PRIORITY_SKIP)
+
+    def _wanted_missing(self, other_bitfield):
+        """Pieces the neighbor has that we want and lack."""
+        mine, theirs, prio = self.bitfield.bits, other_bitfield.bits, self.piece_priority
+        return [i for i in range(P2P_init.NUM_PIECES)
+                if theirs[i] and not mine[i] and prio[i] != PRIORITY_SKIP]
+
+    def _has_wanted_pieces(self, other_bitfield):
+        mine, theirs, prio = self.bitfield.bits, other_bitfield.bits, self.piece_priority
+        return any(theirs[i] and not mine[i] and prio[i] != PRIORITY_SKIP
+                   for i in range(P2P_init.NUM_PIECES))
+
+    def _materialize_wanted(self):
+        """Preallocate disk space for runs of wanted pieces we don't have yet."""
+        if self.has_file or not hasattr(os, 'posix_fallocate'):
+            return
+        runs = []
+        for i in range(P2P_init.NUM_PIECES):
+            if not self.wants(i) or self.bitfield.has_piece(i):
+                continue
+            offset = i * P2P_init.PIECE_SIZE
+            length = min(P2P_init.PIECE_SIZE, P2P_init.FILE_SIZE - offset)
+            if runs and runs[-1][0] + runs[-1][1] == offset:
+                runs[-1][1] += length
+            else:
+                runs.append([offset, length])
+        try:
+            fd = os.open(self.file_path, os.O_RDWR)
+            try:
+                for offset, length in runs:
+                    os.posix_fallocate(fd, offset, length)
+            finally:
+                os.close(fd)
+        except OSError as e:
+            self.log(f"Could not preallocate wanted ranges: {e}")
+
+    def _refresh_interest(self):
+        """Re-send INTERESTED / NOT_INTERESTED after the wanted set changed."""
+        for pid, state in self._neighbors():
+            interested = self._has_wanted_pieces(state.bitfield)
+            if interested == state.im_interested_in_them:
+                continue
+            state.im_interested_in_them = interested
+            try:
+                state.send(create_interested() if interested else create_not_interested())
+            except OSError:
+                pass
+
+    def _init_log_file(self):
+        """Create (or truncate) this peer's log file."""
+        open(self.log_file, "w").close()   # clear file NOW
+
+    @timed('log')
     def log(self, message):
         """Write log message with timestamp."""
         timestamp = datetime.now().strftime("%H:%M:%S")
@@ -238,55 +1570,237 @@ class Peer:
 
     def recv_exact(self, sock, num_bytes):
         """Receive exactly num_bytes from the socket."""
-        data = b''
+        data = bytearray()
         while len(data) < num_bytes:
             chunk = sock.recv(num_bytes - len(data))
             if not chunk:
                 raise ConnectionError("Socket closed unexpectedly")
             data += chunk
-        return data
+        return bytes(data)
+
+    def recv_into_exact(self, sock, view):
+        """Fill the writable buffer view from the socket."""
+        recv_into = getattr(sock, 'recv_into', None)
+        pos = 0
+        while pos < len(view):
+            if recv_into is not None:
+                n = recv_into(view[pos:])
+            else:
+                chunk = sock.recv(len(view) - pos)
+                n = len(chunk)
+                view[pos:pos + n] = chunk
+            if not n:
+                raise ConnectionError("Socket closed unexpectedly")
+            pos += n
 
 
     def start_server(self):
         """Start listening for incoming connections."""
-        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        server_socket.bind((self.host_name, self.port_number))
-        server_socket.listen()
+        if P2P_init.TRANSPORT == 'udp':
+            # One UDP socket; accept() hands out reliable streams over it
+            server_socket = udp_transport.UdpEndpoint(self.host_name, self.port_number)
+        else:
+            server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if self.shard is not None:
+                # Every worker listens on the port; the kernel spreads the connections
+                server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            server_socket.bind((self.host_name, self.port_number))
+            server_socket.listen()
 
         self.server_socket = server_socket
 
-        self.log(f"Peer {self.peer_id} listening on {self.host_name}:{self.port_number}")
+        self.log(f"Peer {self.peer_id} listening on {self.host_name}:{self.port_number} ({P2P_init.TRANSPORT})")
         return server_socket
 
+    def _open_connection(self, host, port):
+        """Connected stream to host:port over the configured transport."""
+        if P2P_init.TRANSPORT == 'udp':
+            return self.server_socket.connect((host, port))
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        tune_socket(sock)
+        sock.connect((host, port))
+        return sock
+
     def stop(self):
         """Gracefully stop this peer."""
         if self.stopped:
             return
         self.stopped = True
         self.log(f"Peer {self.peer_id} shutting down.")
+        self.scheduler.stop()
+        with self.piece_arrived:
+            self.piece_arrived.notify_all()
+        self.disk.close()
+
+        # The UdpEndpoint resets every connection on it when closed, so it
+        # goes last, once the connections have delivered what they queued
+        udp = P2P_init.TRANSPORT == 'udp'
+        if not udp:
+            self._close_server_socket()
+
+        if P2P_init.TRACKER_URL:
+            self.announce('stopped', timeout=1)
+
+        socks = [state.socket for _, state in self._neighbors()]
+        deadline = time.monotonic() + STOP_LINGER
+        if P2P_init.TRANSPORT == 'tcp':
+            # Closing with unread input sends a reset, which can destroy our
+            # last frames (a DONE) before the neighbor reads them; send FIN
+            # behind them and give neighbors a moment to close first
+            drains = [threading.Thread(target=drain_socket, args=(sock, STOP_LINGER), daemon=True)
+                      for sock in socks]
+            for t in drains:
+                t.start()
+            for t in drains:
+                t.join(max(0.0, deadline - time.monotonic()))
+        for sock in socks:
+            try:
+                sock.close()
+            except:
+                pass
+        if udp:
+            # close() only queued our FIN behind any unacked data
+            for sock in socks:
+                if hasattr(sock, 'wait_closed'):
+                    sock.wait_closed(max(0.0, deadline - time.monotonic()))
+            self._close_server_socket()
 
+        self.stop_event.set()
+
+    def _close_server_socket(self):
         try:
             if self.server_socket:
                 self.server_socket.close()
         except:
             pass
 
-        for _, state in list(self.connections.items()):
-            try:
-                state['socket'].close()
-            except:
-                pass
-    
     def broadcast_done(self):
         msg = create_done()
-        for pid, st in self.connections.items():
+        for pid, st in self._neighbors():
             try:
-                st['socket'].sendall(msg)
+                st.send(msg)
             except:
                 pass
         self.log("Broadcasted DONE to neighbors.")
 
+    def _at_connection_cap(self, dialing=False):
+        """
+        True once MaxConnections neighbors are connected. When dialing we stop
+        a quarter short, so peers that join later can still get in.
+        """
+        limit = P2P_init.MAX_CONNECTIONS
+        if limit <= 0:
+            return False
+        if dialing:
+            limit -= max(1, limit // 4)
+        return len(self.connections) >= limit
+
+    def _traced(self, sock, remote_id):
+        """sock, wrapped to record the frames we send when TraceFrames is on."""
+        if self.trace is None:
+            return sock
+        return frame_trace.TracedSocket(sock, self.trace, remote_id)
+
+    def _register_neighbor(self, remote_id, sock, outbound, features=0, rtt=None):
+        """
+        Add a handshaken connection to self.connections. If we already have one
+        to remote_id (both sides dialed each other) keep the connection dialed
+        by the lower peer id, so both ends make the same choice. Returns False
+        if sock was the one dropped. features: flags from the remote handshake;
+        rtt: seconds the handshake took, if we timed it.
+        """
+        state = self._new_neighbor_state(sock)
+        state.outbound = outbound
+        state.compact_bitfield = bool(features & FEATURES & FEATURE_COMPACT_BITFIELD)
+        state.pings = bool(features & FEATURES & FEATURE_PING)
+        state.rtt = rtt
+        state.locality = self._locality(remote_id, sock)
+        with self.connections_lock:
+            existing = self.connections.get(remote_id)
+            keep_new = existing is None or (self.peer_id if outbound else remote_id) == min(self.peer_id, remote_id)
+            if keep_new:
+                self.connections[remote_id] = state
+        if not keep_new:
+            self.log(f"Dropping duplicate connection with Peer {remote_id}.")
+            try:
+                sock.close()
+            except:
+                pass
+            return False
+        if existing is not None:
+            # Its reader thread finds the new state in self.connections and
+            # leaves it alone, so the replaced one is torn down here
+            self._tear_down_neighbor(remote_id, existing)
+            try:
+                existing.socket.close()
+            except:
+                pass
+        return True
+
+    def _locality(self, remote_id, sock):
+        """
+        1.0 for a neighbor on our host, 0.5 on our subnet, else 0: the same
+        PeerInfo.cfg hostname means the same host, otherwise the addresses
+        of the connection decide.
+        """
+        ours = peer_info.get(self.peer_id)
+        theirs = peer_info.get(remote_id)
+        if ours and theirs and ours[0].lower() == theirs[0].lower():
+            return 1.0
+        try:
+            return address_locality(sock.getsockname()[0], sock.getpeername()[0])
+        except (AttributeError, OSError, IndexError, TypeError):
+            # Sockets without IP addresses (tests, the simulator)
+            return 0.0
+
+    def _new_neighbor_state(self, sock):
+        """Fresh NeighborState for a neighbor reached over sock."""
+        return NeighborState(sock, self.clock())
+
+    def _neighbors(self):
+        """
+        Snapshot of self.connections as (peer_id, state) pairs, safe to
+        iterate while neighbors come and go.
+        """
+        with self.connections_lock:
+            return list(self.connections.items())
+
+    def _send_initial_messages(self, remote_id, sock):
+        """First messages after the handshake: our bitfield (or, when super-seeding, an empty one plus one HAVE)."""
+        state = self.connections.get(remote_id)
+        if state is None or state.socket is not sock:
+            return
+        if self.super_seeding:
+            state.send(self._bitfield_message(state, Bitfield(P2P_init.NUM_PIECES, False)))
+            self._super_seed_offer(remote_id)
+        else:
+            state.send(self._bitfield_message(state, self.bitfield))
+        if self.peer_id in self.finished_peers:
+            # Neighbors only learn we are done from DONE; a seeder, or a peer
+            # that finished before this connection, would otherwise never say so
+            state.send(create_done())
+        if state.pings:
+            self._ping(state)
+
+    def _bitfield_message(self, state, bitfield):
+        """
+        The frame announcing bitfield to the neighbor with state: HAVE_ALL,
+        HAVE_NONE or BITFIELD_RLE when it is shorter and the neighbor
+        speaks them, a plain BITFIELD otherwise.
+        """
+        if not state.compact_bitfield:
+            return create_bitfield(bitfield.to_bytes())
+        have = bitfield.count()
+        if have == bitfield.num_pieces:
+            return create_have_all()
+        if have == 0:
+            return create_have_none()
+        rle = bitfield.to_rle()
+        if len(rle) < bitfield.num_bytes:
+            return create_bitfield_rle(rle)
+        return create_bitfield(bitfield.to_bytes())
+
     def handle_incoming_connections(self, server_socket):
         """
         Accept incoming connections in a loop, perform handshake,
@@ -298,6 +1812,8 @@ class Peer:
             except OSError:
                 # Socket closed while stopping
                 break
+            if P2P_init.TRANSPORT == 'tcp':
+                tune_socket(client_socket)
 
             # Receive handshake first
             try:
@@ -307,32 +1823,30 @@ class Peer:
                 continue
 
             remote_id = parse_handshake(hs)
+            features = parse_handshake_features(hs)
             if remote_id is None:
                 self.log(f"Received invalid handshake from {addr}, closing.")
                 client_socket.close()
                 continue
 
+            if self._at_connection_cap() and remote_id not in self.connections:
+                self.log(f"Refusing Peer {remote_id}: MaxConnections reached.")
+                client_socket.close()
+                continue
+
             # Log "is connected from"
             self.log(f"Peer {self.peer_id} is connected from Peer {remote_id}.")
 
             # Send our handshake back
-            client_socket.sendall(handshake(self.peer_id))
+            client_socket.sendall(handshake(self.peer_id, FEATURES))
+            client_socket = self._traced(client_socket, remote_id)
 
             # Create neighbor state
-            neighbor_state = {
-                'socket': client_socket,
-                'bitfield': Bitfield(P2P_init.NUM_PIECES, False),
-                'am_choking': True,
-                'peer_choking_me': True,
-                'interested_in_me': False,
-                'im_interested_in_them': False,
-                'downloaded_bytes_interval': 0
-            }
-            self.connections[remote_id] = neighbor_state
+            if not self._register_neighbor(remote_id, client_socket, outbound=False, features=features):
+                continue
 
             # After handshake, send our bitfield
-            bf_msg = create_bitfield(self.bitfield.to_bytes())
-            client_socket.sendall(bf_msg)
+            self._send_initial_messages(remote_id, client_socket)
 
             # Start a thread to handle messages from this neighbor
             t = threading.Thread(
@@ -357,6 +1871,41 @@ class Peer:
                 client_socket.close()
             except:
                 pass
+            self._remove_neighbor(peer_id, client_socket)
+
+    def _remove_neighbor(self, peer_id, sock):
+        """Forget a neighbor whose connection is gone and hand its requests to others."""
+        with self.connections_lock:
+            state = self.connections.get(peer_id)
+            # The reaper and the handler thread may both get here
+            if state is None or state.socket is not sock:
+                return
+            del self.connections[peer_id]
+        self._tear_down_neighbor(peer_id, state)
+
+    def _tear_down_neighbor(self, peer_id, state):
+        """
+        Undo what a neighbor state no longer in self.connections counted for:
+        its pieces in availability, its choking and super-seeding entries and
+        the requests outstanding to peer_id, which go to other neighbors.
+        """
+        # From here on HAVE/BITFIELD from this neighbor no longer count
+        state.closed = True
+        for lock, pieces in self.piece_locks.ranges(P2P_init.NUM_PIECES):
+            with lock:
+                for i in pieces:
+                    if state.bitfield.bits[i]:
+                        self.availability[i] -= 1
+        with self.state_lock:
+            self.super_seed_offers.pop(peer_id, None)
+            self.super_seed_revealed.pop(peer_id, None)
+        with self.choke_lock:
+            self.preferred_neighbors.discard(peer_id)
+            if self.optimistic_neighbor == peer_id:
+                self.optimistic_neighbor = None
+        pieces = self.in_flight.release_peer(peer_id)
+        if pieces:
+            self._reassign(pieces)
 
     def handle_peer_messages(self, client_socket, peer_id):
         """
@@ -371,66 +1920,112 @@ class Peer:
             type_byte = self.recv_exact(client_socket, 1)
             message_type = type_byte[0]
 
+            if message_type == PIECE and self._streams(length - 4):
+                self.profiler.checkpoint()
+                self._receive_piece_streamed(client_socket, peer_id, length - 4)
+                continue
+
             # Read payload
             payload = b''
             if length > 0:
                 payload = self.recv_exact(client_socket, length)
 
+            if self.trace is not None:
+                self.trace.record(frame_trace.RECV, peer_id, message_type, payload)
+            self.profiler.checkpoint()
             self.process_message(message_type, payload, peer_id, client_socket)
 
     def process_message(self, message_type, payload, peer_id, client_socket):
+        """Process one message from a neighbor, timing it per message type."""
+        start = time.perf_counter()
+        try:
+            self._handle_message(message_type, payload, peer_id, client_socket)
+        finally:
+            self.metrics.record(MESSAGE_NAMES.get(message_type, 'msg.unknown'),
+                                time.perf_counter() - start)
+
+    def _handle_message(self, message_type, payload, peer_id, client_socket):
         """
         Process incoming messages from a neighbor.
         Handles: bitfield, have, interested, not interested, choke, unchoke, request, piece.
         """
         neighbor = self.connections.get(peer_id)
-        if neighbor is None:
-            # Should not happen
+        if neighbor is None or neighbor.socket is not client_socket:
+            # Removed, or replaced by a second connection to the same peer:
+            # frames still read from the old socket belong to no neighbor
+            return
+
+        # Any frame, keep-alives included, pushes back the read deadline
+        neighbor.last_received = self.clock()
+        if message_type == KEEP_ALIVE:
+            if payload and neighbor.pings:
+                neighbor.send(create_pong(payload[:4]))
+            return
+
+        if message_type == PONG:
+            self._record_pong(neighbor, payload)
+            return
+
+        if message_type == PEX:
+            self.handle_pex(payload, peer_id)
             return
 
         if message_type == DONE:
             self.log(f"Received DONE from Peer {peer_id}")
-            self.finished_peers.add(peer_id)
-            if self.finished_peers == self.total_peers:
-                self.log("All peers have completed the file. Stopping.")
-                self.stop()
+            self._peer_done(peer_id)
             return
 
-        if message_type == BITFIELD:
-            # Neighbor's initial bitfield
-            neighbor['bitfield'].from_bytes(payload)
+        if message_type in (BITFIELD, BITFIELD_RLE, HAVE_ALL, HAVE_NONE):
+            # Neighbor's initial bitfield, in whichever encoding
+            self._apply_bitfield(neighbor, decode_bitfield(message_type, payload))
             # Decide if we are interested
-            if self.bitfield.has_interesting_pieces(neighbor['bitfield']):
-                client_socket.sendall(create_interested())
-                neighbor['im_interested_in_them'] = True
+            if self._has_wanted_pieces(neighbor.bitfield):
+                neighbor.send(create_interested())
+                neighbor.im_interested_in_them = True
             else:
-                client_socket.sendall(create_not_interested())
-                neighbor['im_interested_in_them'] = False
+                neighbor.send(create_not_interested())
+                neighbor.im_interested_in_them = False
 
         elif message_type == HAVE:
             # Neighbor just got one new piece
             piece_index = struct.unpack('>I', payload)[0]
-            neighbor['bitfield'].set_piece(piece_index)
+            self._apply_have(neighbor, piece_index)
             self.log(f"Peer {self.peer_id} received the 'have' message from {peer_id} for the piece {piece_index}.")
-            # Decide if this makes us interested now
-            if self.bitfield.has_interesting_pieces(neighbor['bitfield']) and not neighbor['im_interested_in_them']:
-                client_socket.sendall(create_interested())
-                neighbor['im_interested_in_them'] = True
+            if self.super_seeding:
+                self._super_seed_on_have(peer_id, piece_index)
+            # Decide if this makes us interested now (only the new piece can
+            # change that, so no need to rescan the whole bitfield)
+            if (not neighbor.im_interested_in_them and not self.bitfield.has_piece(piece_index)
+                    and self.wants(piece_index)):
+                neighbor.send(create_interested())
+                neighbor.im_interested_in_them = True
+            # An unchoked neighbor left idle by the in-flight table may now
+            # have something for us
+            if not neighbor.peer_choking_me and self._is_idle(peer_id, neighbor):
+                self.send_request(peer_id, client_socket)
 
         elif message_type == INTERESTED:
-            neighbor['interested_in_me'] = True
+            neighbor.interested_in_me = True
             self.log(f"Peer {self.peer_id} received the 'interested' message from {peer_id}.")
 
         elif message_type == NOT_INTERESTED:
-            neighbor['interested_in_me'] = False
+            neighbor.interested_in_me = False
             self.log(f"Peer {self.peer_id} received the 'not interested' message from {peer_id}.")
 
         elif message_type == CHOKE:
-            neighbor['peer_choking_me'] = True
+            neighbor.peer_choking_me = True
             self.log(f"Peer {self.peer_id} is choked by {peer_id}.")
+            # Whatever we asked this neighbor for will not come; give it to
+            # neighbors that have it
+            with neighbor.lock:
+                neighbor.overdue.clear()
+                neighbor.duplicate_requests.clear()
+            pieces = self.in_flight.release_peer(peer_id)
+            if pieces:
+                self._reassign(pieces)
 
         elif message_type == UNCHOKE:
-            neighbor['peer_choking_me'] = False
+            neighbor.peer_choking_me = False
             self.log(f"Peer {self.peer_id} is unchoked by {peer_id}.")
             # Once unchoked, send a request
             self.send_request(peer_id, client_socket)
@@ -438,60 +2033,576 @@ class Peer:
         elif message_type == REQUEST:
             # Neighbor requests a piece from us
             piece_index = struct.unpack('>I', payload)[0]
-            piece_data = self.read_piece(piece_index)
-            if piece_data is not None:
-                msg = create_piece(piece_index, piece_data)
-                client_socket.sendall(msg)
+            with self.state_lock:
+                hidden = (self.super_seeding
+                          and piece_index not in self.super_seed_revealed.get(peer_id, ()))
+            if hidden:
+                # Only pieces we revealed to this neighbor are served
+                return
+            if 0 <= piece_index < P2P_init.NUM_PIECES and self._streams(piece_length(piece_index)):
+                # Never on this reader thread: the upload lasts as long as the
+                # neighbor takes to drain it, and we must keep reading meanwhile.
+                # One thread per neighbor sends them in turn, one open file at a time
+                if neighbor.queue_streamed(piece_index):
+                    threading.Thread(target=self._send_streamed_requests, args=(neighbor,),
+                                     daemon=True).start()
+            else:
+                self.disk.read(piece_index, lambda piece_data: self._send_piece(
+                    neighbor, client_socket, piece_index, piece_data))
 
         elif message_type == PIECE:
             # We got a piece from neighbor
             piece_index = struct.unpack('>I', payload[:4])[0]
             piece_data = payload[4:]
-            self.save_piece(piece_index, piece_data, peer_id)
-
-            # Track download rate
-            neighbor['downloaded_bytes_interval'] += len(piece_data)
-
-            # If neighbor still has interesting pieces and we are not choked, request another
-            if not neighbor['peer_choking_me'] and self.bitfield.has_interesting_pieces(neighbor['bitfield']):
-                self.send_request(peer_id, client_socket)
-            else:
-                # Might send not interested if nothing left
-                if not self.bitfield.has_interesting_pieces(neighbor['bitfield']):
-                    client_socket.sendall(create_not_interested())
-                    neighbor['im_interested_in_them'] = False
+            self._piece_received(neighbor, peer_id, client_socket, piece_index, len(piece_data),
+                                 lambda: self.save_piece(piece_index, piece_data, peer_id))
 
         else:
             # Unknown/unused message type
             pass
 
-    def send_request(self, peer_id, client_socket):
+    def _piece_received(self, neighbor, peer_id, client_socket, piece_index, size, save):
+        """Bookkeeping for a PIECE of size bytes from neighbor; save() stores it."""
+        entry = self.in_flight.release(piece_index)
+        if entry is not None and entry[0] == peer_id:
+            self._record_service_time(neighbor, self.clock() - entry[1], size)
+        with neighbor.lock:
+            neighbor.overdue.discard(piece_index)
+            neighbor.duplicate_requests.discard(piece_index)
+            # Track download rate
+            neighbor.downloaded_bytes_interval += size
+        save()
+
+        # If neighbor still has interesting pieces and we are not choked, request another
+        if not neighbor.peer_choking_me and self._has_wanted_pieces(neighbor.bitfield):
+            self.send_request(peer_id, client_socket)
+        else:
+            # Might send not interested if nothing left
+            if not self._has_wanted_pieces(neighbor.bitfield):
+                neighbor.send(create_not_interested())
+                neighbor.im_interested_in_them = False
+
+    def _streams(self, size):
+        """Whether a piece of size bytes moves between socket and disk in chunks."""
+        return 0 < P2P_init.PIECE_CHUNK_SIZE < size
+
+    def _receive_piece_streamed(self, sock, peer_id, size):
+        """
+        Read the body of a PIECE frame (size bytes after the index) straight
+        into our file, PieceChunkSize bytes at a time, so memory per
+        transfer stays bounded whatever the piece size. A piece we already
+        have, or with the wrong size, is read and dropped.
+        """
+        start = time.perf_counter()
+        piece_index = struct.unpack('>I', self.recv_exact(sock, 4))[0]
+        if self.trace is not None:
+            self.trace.record(frame_trace.RECV, peer_id, PIECE, struct.pack('>I', piece_index), 4 + size)
+        neighbor = self.connections.get(peer_id)
+        valid = 0 <= piece_index < P2P_init.NUM_PIECES and size == piece_length(piece_index)
+        claimed = valid and neighbor is not None and self._claim_piece_write(piece_index)
+        view = memoryview(bytearray(min(size, P2P_init.PIECE_CHUNK_SIZE)))
+        try:
+            f = open(self.file_path, "r+b", buffering=0) if claimed else None
+            try:
+                if f is not None:
+                    f.seek(piece_index * P2P_init.PIECE_SIZE)
+                remaining = size
+                while remaining:
+                    n = min(remaining, len(view))
+                    self.recv_into_exact(sock, view[:n])
+                    written = 0
+                    while f is not None and written < n:
+                        written += f.write(view[written:n])
+                    remaining -= n
+            finally:
+                if f is not None:
+                    f.close()
+        except BaseException:
+            if claimed:
+                self._end_piece_write(piece_index)
+            raise
+
+        try:
+            if neighbor is None:
+                return
+            neighbor.last_received = self.clock()
+            if not valid:
+                self.log(f"Dropped PIECE {piece_index} of {size} bytes from {peer_id}: no such piece.")
+                return
+
+            def save():
+                if claimed:
+                    self._piece_stored(piece_index, peer_id)
+                else:
+                    # Another neighbor already delivered it
+                    self.in_flight.record_duplicate(size)
+            self._piece_received(neighbor, peer_id, sock, piece_index, size, save)
+        finally:
+            self.metrics.record(MESSAGE_NAMES[PIECE], time.perf_counter() - start)
+
+    def _send_streamed_requests(self, neighbor):
+        """Send a neighbor's queued large pieces until its queue is empty."""
+        piece_index = neighbor.next_streamed()
+        while piece_index is not None:
+            if not self.stopped:
+                self._send_piece_streamed(neighbor, piece_index)
+            piece_index = neighbor.next_streamed()
+
+    def _send_piece_streamed(self, neighbor, piece_index):
+        """Answer a REQUEST for a large piece straight from the file (see NeighborState.send_file)."""
+        length = piece_length(piece_index)
+        header = struct.pack('>IBI', 4 + length, PIECE, piece_index)
+        try:
+            with open(self.file_path, "rb") as f:
+                neighbor.send_file(header, f, piece_index * P2P_init.PIECE_SIZE, length,
+                                   P2P_init.PIECE_CHUNK_SIZE)
+        except OSError as e:
+            self.log(f"Error sending piece {piece_index}: {e}")
+            return
+        with self.state_lock:
+            self.uploaded_bytes += length
+        with neighbor.lock:
+            neighbor.uploaded_bytes += length
+
+    def _peer_done(self, peer_id, relay=True):
+        """Record that peer_id has everything; stop once every peer has."""
+        with self.state_lock:
+            self.finished_peers.add(peer_id)
+            all_done = self.total_peers <= self.finished_peers
+        if relay and self.shard is not None:
+            self.shard.send(('done', peer_id))
+        if all_done:
+            self.log("All peers have completed the file. Stopping.")
+            self._stop_all_done()
+
+    def _stop_all_done(self):
+        """Stop, first telling neighbors over PEX which peers finished."""
+        if self.stopped:
+            return
+        if P2P_init.PEX_INTERVAL > 0:
+            # Peers we are not connected to only hear about completions
+            # through PEX, and our neighbors may be their only link to us
+            self.send_pex()
+        self.stop()
+
+    def _apply_bitfield(self, neighbor, received):
+        """Take a neighbor's bitfield, keeping availability in step stripe by stripe."""
+        bits = neighbor.bitfield.bits
+        for lock, pieces in self.piece_locks.ranges(P2P_init.NUM_PIECES):
+            with lock:
+                # _remove_neighbor already took this neighbor's pieces off
+                if neighbor.closed:
+                    return
+                if bits[pieces.start:pieces.stop] == received.bits[pieces.start:pieces.stop]:
+                    continue
+                for i in pieces:
+                    has = received.bits[i]
+                    if has != bits[i]:
+                        bits[i] = has
+                        self.availability[i] += 1 if has else -1
+
+    def _apply_have(self, neighbor, piece_index):
+        """Mark one piece of a neighbor's; True if it is news."""
+        if not 0 <= piece_index < P2P_init.NUM_PIECES:
+            return False
+        with self.piece_locks(piece_index):
+            if neighbor.closed or neighbor.bitfield.bits[piece_index]:
+                return False
+            neighbor.bitfield.bits[piece_index] = True
+            self.availability[piece_index] += 1
+        return True
+
+    def _send_piece(self, neighbor, sock, piece_index, piece_data):
+        """Answer a REQUEST once the piece has been read (see DiskIO.read)."""
+        if piece_data is None:
+            return
+        header = struct.pack('>IBI', 4 + len(piece_data), PIECE, piece_index)
+        try:
+            neighbor.send_piece(header, piece_data)
+        except OSError:
+            return
+        with self.state_lock:
+            self.uploaded_bytes += len(piece_data)
+        with neighbor.lock:
+            neighbor.uploaded_bytes += len(piece_data)
+
+    def _super_seed_offer(self, peer_id):
+        """
+        Reveal one piece to peer_id with a HAVE: the rarest piece it lacks,
+        preferring pieces not currently revealed to anyone else.
+        """
+        state = self.connections.get(peer_id)
+        if state is None:
+            return
+        with self.state_lock:
+            if not self.super_seeding:
+                return
+            offered = set(self.super_seed_offers.values())
+            lacking = [i for i in range(P2P_init.NUM_PIECES) if not state.bitfield.has_piece(i)]
+            if not lacking:
+                self.super_seed_offers.pop(peer_id, None)
+                return
+            fresh = [i for i in lacking if i not in offered] or lacking
+            rarest = min(self.availability[i] for i in fresh)
+            piece_index = random.choice([i for i in fresh if self.availability[i] == rarest])
+            self.super_seed_offers[peer_id] = piece_index
+            self.super_seed_revealed.setdefault(peer_id, set()).add(piece_index)
+        try:
+            state.send(create_have(piece_index))
+        except OSError:
+            return
+        self.log(f"Super-seeding: revealed piece {piece_index} to {peer_id}.")
+
+    def _super_seed_on_have(self, from_peer_id, piece_index):
+        """
+        React to a HAVE while super-seeding. A neighbor gets its next piece
+        once the piece we gave it shows up at some other peer, i.e. it has
+        been passed on. If no other neighbor is left to pass it to, the
+        neighbor gets the next piece as soon as it has its current one.
+        """
+        with self.state_lock:
+            holders = [pid for pid, offered in self.super_seed_offers.items()
+                       if offered == piece_index]
+        for pid in holders:
+            if pid != from_peer_id:
+                self._super_seed_offer(pid)
+            elif all(st.bitfield.has_piece(piece_index)
+                     for other, st in self._neighbors() if other != pid):
+                self._super_seed_offer(pid)
+
+        # Once every piece is out in the swarm, go back to normal seeding
+        if all(count > 0 for count in self.availability):
+            with self.state_lock:
+                # Only the first reader thread to notice switches over
+                if not self.super_seeding:
+                    return
+                self.super_seeding = False
+                self.super_seed_offers.clear()
+                self.super_seed_revealed.clear()
+            self.log("Super-seeding: every piece has been distributed; advertising full bitfield.")
+            for pid, state in self._neighbors():
+                try:
+                    state.send(self._bitfield_message(state, self.bitfield))
+                except OSError:
+                    pass
+
+    def send_request(self, peer_id, client_socket, piece_index=None):
         """
         Send a 'request' message for a piece that:
         - we don't have
         - the neighbor (peer_id) does have
+        - nobody else is already fetching
+        piece_index forces a specific piece (used when reassigning).
         """
-        # If this peer is already complete, don't request anything
-        if self.bitfield.is_complete():
+        # If this peer already has everything it wants, don't request anything
+        if self.download_complete():
             return
 
         neighbor = self.connections.get(peer_id)
         if neighbor is None:
             return
 
+        deadline = self.clock() + self.request_deadline(neighbor)
+        if piece_index is not None:
+            if self.bitfield.has_piece(piece_index) or piece_index in self.disk or not self.in_flight.claim(
+                    piece_index, peer_id, self.clock(), deadline):
+                return
+            neighbor.send(create_request(piece_index))
+            self.log(f"Peer {self.peer_id} sent 'request' message to {peer_id} for piece {piece_index}.")
+            return
+
         # Find missing pieces that neighbor has
-        missing = self.bitfield.get_missing_pieces(neighbor['bitfield'])
+        missing = self._wanted_missing(neighbor.bitfield)
         if not missing:
             # Nothing to request, send not interested
-            client_socket.sendall(create_not_interested())
-            neighbor['im_interested_in_them'] = False
+            neighbor.send(create_not_interested())
+            neighbor.im_interested_in_them = False
+            return
+
+        if peer_id == WEB_SEED_ID:
+            # Only pieces peers can't give us right now, best first
+            missing = self._web_seed_pieces(missing)
+        elif P2P_init.STREAMING_WINDOW > 0 and self._request_streaming_piece(peer_id, neighbor, deadline):
+            return
+
+        # Skip pieces already requested from someone else; if that leaves
+        # nothing we stay interested and wait for a release. Pieces still
+        # being written count as ours. High priority pieces go first, and
+        # pieces a nearer neighbor could send us are left to it if we can.
+        closer = self._closer_sources(peer_id)
+        for priority in (PRIORITY_HIGH, PRIORITY_NORMAL):
+            candidates = [p for p in missing
+                          if p not in self.in_flight and p not in self.disk
+                          and self.piece_priority[p] == priority]
+            if closer:
+                only_here = [p for p in candidates if not any(bitfield.bits[p] for bitfield in closer)]
+                candidates = only_here or candidates
+            while candidates:
+                piece_index = candidates[0] if peer_id == WEB_SEED_ID else random.choice(candidates)
+                if self.store is not None and self._take_from_piece_store(piece_index):
+                    # Another local peer fetched it meanwhile
+                    candidates.remove(piece_index)
+                    continue
+                if self.in_flight.claim(piece_index, peer_id, self.clock(), deadline):
+                    break
+                candidates.remove(piece_index)
+            else:
+                continue
+            break
+        else:
             return
 
-        piece_index = random.choice(missing)
         msg = create_request(piece_index)
-        client_socket.sendall(msg)
+        neighbor.send(msg)
         self.log(f"Peer {self.peer_id} sent 'request' message to {peer_id} for piece {piece_index}.")
 
+    def _web_seed_pieces(self, missing):
+        """
+        Which of the missing pieces to fetch from the web seed: those no
+        unchoked neighbor has (they are choking us, offline or nobody has
+        the piece), plus those that missed a deadline. Late pieces come
+        first, then the rarest.
+        """
+        now = self.clock()
+        states = self._neighbors()
+        sources = [state.bitfield for pid, state in states
+                   if pid != WEB_SEED_ID and not state.peer_choking_me]
+        late = set()
+        for _, state in states:
+            with state.lock:
+                late.update(state.overdue)
+        late.update(p for p, deadline in list(self.stream_deadlines.items()) if deadline <= now)
+        pieces = [p for p in missing
+                  if p in late or not any(bf.has_piece(p) for bf in sources)]
+        pieces.sort(key=lambda p: (p not in late, self.availability[p]))
+        return pieces
+
+    def start_web_seed(self):
+        """
+        Add WebSeedURL as a virtual neighbor that has every piece. It
+        unchokes us after one unchoking interval, so peers get the first
+        chance to serve us.
+        """
+        if not P2P_init.WEB_SEED_URL or self.download_complete():
+            return
+        if self.shard is not None and self.shard.index != 0:
+            # One web seed connection per peer; its pieces land in the shared bitfield
+            return
+        self.web_seed = WebSeed(self, P2P_init.WEB_SEED_URL)
+        with self.connections_lock:
+            self.connections[WEB_SEED_ID] = self._new_neighbor_state(self.web_seed)
+        self.log(f"Peer {self.peer_id} using web seed {P2P_init.WEB_SEED_URL}.")
+        self.process_message(HAVE_ALL, b'', WEB_SEED_ID, self.web_seed)
+        self.scheduler.call_later(P2P_init.UNCHOKING_INTERVAL, self.process_message,
+                                  UNCHOKE, b'', WEB_SEED_ID, self.web_seed)
+
+    def _poke_web_seed(self):
+        """Give an idle web seed a request if some piece has become fetchable from it."""
+        state = self.connections.get(WEB_SEED_ID)
+        if state is not None and not state.peer_choking_me and self._is_idle(WEB_SEED_ID, state):
+            self.send_request(WEB_SEED_ID, self.web_seed)
+
+    def open_stream(self, position=0):
+        """Blocking reader over the download, see StreamReader."""
+        return StreamReader(self, position)
+
+    def wait_for_piece(self, piece_index, timeout=None):
+        """
+        Block until we have piece_index (moving the streaming cursor there).
+        Returns False on timeout or if the peer stops first.
+        """
+        with self.piece_arrived:
+            if not self.bitfield.has_piece(piece_index):
+                self.read_cursor = piece_index
+            return self.piece_arrived.wait_for(
+                lambda: self.bitfield.has_piece(piece_index) or self.stopped, timeout
+            ) and self.bitfield.has_piece(piece_index)
+
+    def _stream_window(self):
+        """Missing pieces in the streaming window, in order, as (piece, deadline)."""
+        now = self.clock()
+        window = []
+        # The window slides: it starts at the first missing piece at or
+        # after the read cursor
+        start = self.read_cursor
+        while start < P2P_init.NUM_PIECES and (self.bitfield.has_piece(start) or not self.wants(start)):
+            start += 1
+        for i in range(start, min(P2P_init.NUM_PIECES, start + P2P_init.STREAMING_WINDOW)):
+            if self.bitfield.has_piece(i) or not self.wants(i) or i in self.disk:
+                continue
+            if i not in self.stream_deadlines:
+                self.stream_deadlines[i] = now + (len(window) + 1) * P2P_init.STREAMING_DEADLINE
+            window.append((i, self.stream_deadlines[i]))
+        return window
+
+    def _at_risk(self, piece_index, deadline):
+        """True if the current request for piece_index is unlikely to land by deadline."""
+        entry = self.in_flight.get(piece_index)
+        if entry is None:
+            return True
+        holder = self.connections.get(entry[0])
+        if holder is None or holder.srtt is None:
+            # No history for the holder: only worry once the deadline passes
+            return self.clock() >= deadline
+        return entry[1] + holder.srtt > deadline
+
+    def _request_streaming_piece(self, peer_id, neighbor, deadline):
+        """
+        Ask neighbor for the earliest window piece it has. A piece already
+        requested elsewhere is requested again from this neighbor if it is
+        at risk of missing its deadline. Returns True if a request was sent.
+        """
+        for piece_index, piece_deadline in self._stream_window():
+            if not neighbor.bitfield.has_piece(piece_index):
+                continue
+            if self.in_flight.claim(piece_index, peer_id, self.clock(), deadline):
+                neighbor.send(create_request(piece_index))
+                self.log(f"Peer {self.peer_id} sent 'request' message to {peer_id} for piece {piece_index}.")
+                return True
+            entry = self.in_flight.get(piece_index)
+            if (entry is not None and entry[0] != peer_id
+                    and self._at_risk(piece_index, piece_deadline)
+                    and neighbor.add_duplicate(piece_index)):
+                neighbor.send(create_request(piece_index))
+                self.log(f"Peer {self.peer_id} sent duplicate 'request' to {peer_id} for at-risk piece {piece_index}.")
+                return True
+        return False
+
+    def _rescue_stream(self):
+        """Duplicate-request window pieces whose deadline is at risk from idle neighbors."""
+        for piece_index, piece_deadline in self._stream_window():
+            if piece_index not in self.in_flight or not self._at_risk(piece_index, piece_deadline):
+                continue
+            holder = self.in_flight.get(piece_index)
+            for pid, state in self._request_candidates():
+                if (holder is not None and pid == holder[0]) or not state.bitfield.has_piece(piece_index):
+                    continue
+                if not state.add_duplicate(piece_index):
+                    break
+                try:
+                    state.send(create_request(piece_index))
+                except OSError:
+                    continue
+                self.log(f"Peer {self.peer_id} sent duplicate 'request' to {pid} for at-risk piece {piece_index}.")
+                break
+
+    def request_deadline(self, neighbor):
+        """
+        Seconds we give neighbor to answer a request: smoothed service time
+        plus four deviations (TCP's RTO rule). Service time covers both the
+        round trip and the piece transfer, so slow links get longer deadlines.
+        """
+        if neighbor.srtt is None:
+            return P2P_init.REQUEST_TIMEOUT
+        rto = neighbor.srtt + 4 * neighbor.rttvar
+        return min(P2P_init.REQUEST_TIMEOUT, max(MIN_REQUEST_DEADLINE, rto))
+
+    def _record_service_time(self, neighbor, elapsed, num_bytes):
+        """Fold one request -> piece sample into the neighbor's estimates."""
+        with neighbor.lock:
+            if neighbor.srtt is None:
+                neighbor.srtt = elapsed
+                neighbor.rttvar = elapsed / 2
+            else:
+                neighbor.rttvar = 0.75 * neighbor.rttvar + 0.25 * abs(neighbor.srtt - elapsed)
+                neighbor.srtt = 0.875 * neighbor.srtt + 0.125 * elapsed
+            if elapsed > 0:
+                rate = num_bytes / elapsed
+                if neighbor.throughput == 0:
+                    neighbor.throughput = rate
+                else:
+                    neighbor.throughput = 0.875 * neighbor.throughput + 0.125 * rate
+            # A delivered piece earns back some standing
+            if neighbor.missed_deadlines > 0:
+                neighbor.missed_deadlines -= 1
+
+    def _is_idle(self, peer_id, neighbor):
+        """No request outstanding to neighbor, overdue ones included."""
+        return (not neighbor.overdue and not neighbor.duplicate_requests
+                and not self.in_flight.pending(peer_id))
+
+    def _request_candidates(self):
+        """
+        Neighbors we could send a request to right now, best first: fewest
+        missed deadlines, then highest throughput (scaled up for nearby
+        neighbors with ProximityWeight).
+        """
+        candidates = [
+            (pid, state) for pid, state in self._neighbors()
+            if not state.peer_choking_me and self._is_idle(pid, state)
+        ]
+        weight = P2P_init.PROXIMITY_WEIGHT
+        if weight > 0:
+            proximity = self._proximity(candidates)
+            candidates.sort(key=lambda item: (item[1].missed_deadlines,
+                                              -item[1].throughput * (1 + weight * proximity[item[0]]),
+                                              -proximity[item[0]]))
+        else:
+            candidates.sort(key=lambda item: (item[1].missed_deadlines, -item[1].throughput))
+        return candidates
+
+    def _closer_sources(self, peer_id):
+        """
+        With ProximityWeight, bitfields of the neighbors unchoking us that
+        are nearer than peer_id; send_request leaves their pieces to them.
+        """
+        if P2P_init.PROXIMITY_WEIGHT <= 0 or peer_id == WEB_SEED_ID:
+            return []
+        neighbors = [(pid, state) for pid, state in self._neighbors() if pid != WEB_SEED_ID]
+        proximity = self._proximity(neighbors)
+        mine = proximity.get(peer_id, 0.0)
+        return [state.bitfield for pid, state in neighbors
+                if pid != peer_id and not state.peer_choking_me and proximity[pid] > mine]
+
+    def _reassign(self, pieces):
+        """Ask other neighbors for pieces whose request was released."""
+        for piece_index in pieces:
+            if self.bitfield.has_piece(piece_index) or piece_index in self.in_flight:
+                continue
+            for pid, state in self._request_candidates():
+                if state.bitfield.has_piece(piece_index):
+                    try:
+                        self.send_request(pid, state.socket, piece_index)
+                    except OSError:
+                        continue
+                    self.log(f"Reassigned piece {piece_index} to {pid}.")
+                    break
+        self._request_from_idle_neighbors()
+
+    def _request_from_idle_neighbors(self):
+        """
+        Send a request to every neighbor that has unchoked us but has nothing
+        outstanding, e.g. after in-flight pieces were released.
+        """
+        for pid, state in self._request_candidates():
+            if not state.im_interested_in_them:
+                continue
+            try:
+                self.send_request(pid, state.socket)
+            except OSError:
+                pass
+
+    @timed('requests.expire')
+    def expire_requests(self):
+        """Release requests that missed their deadline and reassign them."""
+        if P2P_init.STREAMING_WINDOW > 0:
+            self._rescue_stream()
+        if self.web_seed is not None:
+            self._poke_web_seed()
+        if not len(self.in_flight):
+            return
+        overdue = self.in_flight.release_overdue(self.clock())
+        for piece_index, pid in overdue:
+            state = self.connections.get(pid)
+            if state is not None:
+                with state.lock:
+                    state.missed_deadlines += 1
+                    state.overdue.add(piece_index)
+            self.log(f"Request for piece {piece_index} to {pid} missed its deadline.")
+        if overdue:
+            self._reassign([p for p, _ in overdue])
+
+    @timed('disk.read')
     def read_piece(self, piece_index):
         """
         Read a piece from our local file.
@@ -511,137 +2622,524 @@ class Peer:
             self.log(f"Error reading piece {piece_index}: {e}")
             return None
 
+    @timed('disk.write')
+    def _write_piece(self, piece_index, piece_data):
+        """
+        Write piece bytes at their offset in our local file. piece_data may
+        run on over the following pieces (merged writes from DiskIO).
+        """
+        with open(self.file_path, "r+b") as f:
+            offset = piece_index * P2P_init.PIECE_SIZE
+            f.seek(offset)
+            f.write(piece_data)
+
     def save_piece(self, piece_index, piece_data, from_peer_id):
         """
-        Save a downloaded piece to our local file, update bitfield,
-        log download, and send 'have' to neighbors.
+        Save a downloaded piece to our local file. Once it is on disk,
+        _piece_stored updates the bitfield, logs and sends 'have'.
         """
         try:
-            with open(self.file_path, "r+b") as f:
-                offset = piece_index * P2P_init.PIECE_SIZE
-                f.seek(offset)
-                f.write(piece_data)
+            self.in_flight.release(piece_index)
+            if not self._claim_piece_write(piece_index):
+                # Another neighbor already delivered it; don't rewrite it
+                self.in_flight.record_duplicate(len(piece_data))
+                return
 
+            self.disk.write(piece_index, piece_data,
+                            lambda: self._piece_stored(piece_index, from_peer_id),
+                            lambda: self._end_piece_write(piece_index))
+
+        except Exception as e:
+            self.log(f"Error saving piece {piece_index}: {e}")
 
-            # Update bitfield
-            new_piece = not self.bitfield.has_piece(piece_index)
-            if new_piece:
-                self.bitfield.set_piece(piece_index)
+    def _piece_stored(self, piece_index, from_peer_id):
+        """A downloaded piece reached the disk: mark it and tell the neighbors."""
+        # Update bitfield
+        with self.piece_arrived:
+            self.bitfield.set_piece(piece_index)
+        self._end_piece_write(piece_index)
+
+        # Count how many pieces we now have
+        pieces_have = sum(1 for b in self.bitfield.bits if b)
+
+        # Log download
+        source = "the piece store" if from_peer_id == PIECE_STORE_ID else from_peer_id
+        self.log(f"Peer {self.peer_id} has downloaded the piece {piece_index} from {source}. "
+                 f"Now the number of pieces it has is {pieces_have}.")
+
+        if self.shard is not None:
+            # The other workers tell their own neighbors
+            self.shard.send(('have', piece_index))
+        self._announce_piece(piece_index)
+
+        if self.store is not None and from_peer_id != PIECE_STORE_ID:
+            # Other local peers can copy it from there
+            self._stock_pieces([piece_index])
+
+    def _announce_piece(self, piece_index):
+        """Wake readers and send 'have' for a piece that just reached our bitfield."""
+        with self.piece_arrived:
+            self.stream_deadlines.pop(piece_index, None)
+            self.piece_arrived.notify_all()
+
+        # Send 'have' to all neighbors
+        have_msg = create_have(piece_index)
+        for nb_id, nb_state in self._neighbors():
+            try:
+                nb_state.send(have_msg)
+            except:
+                pass
 
-                # Count how many pieces we now have
-                pieces_have = sum(1 for b in self.bitfield.bits if b)
+        if self.disk.threads or self.shard is not None:
+            # The PIECE handler checked interest before this write landed,
+            # or another worker's neighbor sent the piece
+            self._refresh_interest()
 
-                # Log download
-                self.log(f"Peer {self.peer_id} has downloaded the piece {piece_index} from {from_peer_id}. "
-                         f"Now the number of pieces it has is {pieces_have}.")
+        self._check_download_complete()
 
-                # Send 'have' to all neighbors
-                have_msg = create_have(piece_index)
-                for nb_id, nb_state in self.connections.items():
-                    try:
-                        nb_state['socket'].sendall(have_msg)
-                    except:
-                        pass
-
-                # If we just completed the file, broadcast DONE once
-                if self.bitfield.is_complete() and not self.done_broadcast_sent:
-                    self.log("File complete. Broadcasting DONE.")
-                    self.done_broadcast_sent = True
-                    self.finished_peers.add(self.peer_id)
-                    self.broadcast_done()
-
-                    # If all peers already finished, stop immediately
-                    if self.finished_peers == self.total_peers:
-                        self.log("All peers complete — stopping.")
-                        self.stop()
+    def _claim_piece_write(self, piece_index):
+        """
+        Two neighbors (or a neighbor and the web seed) may deliver the same
+        piece at once; only the first one gets written. False if we have
+        the piece or another copy is being written.
+        """
+        with self.piece_locks(piece_index):
+            if self.bitfield.has_piece(piece_index) or piece_index in self.pieces_saving:
+                return False
+            self.pieces_saving.add(piece_index)
+            return True
+
+    def _end_piece_write(self, piece_index):
+        """The write of piece_index is over; a later copy may be saved again."""
+        with self.piece_locks(piece_index):
+            self.pieces_saving.discard(piece_index)
+
+    def _check_download_complete(self):
+        """Broadcast DONE once we hold every wanted piece."""
+        if self.done_broadcast_sent or not self.download_complete():
+            return
+        with self.state_lock:
+            # Disk workers may finish the last two pieces at the same time
+            if self.done_broadcast_sent:
+                return
+            self.done_broadcast_sent = True
+            self.finished_peers.add(self.peer_id)
+            all_done = self.total_peers <= self.finished_peers
+        if self.bitfield.is_complete():
+            self.log("File complete. Broadcasting DONE.")
+        else:
+            self.log("Wanted pieces complete. Broadcasting DONE.")
+        self.broadcast_done()
+        if self.web_seed is not None:
+            self.log(f"Fetched {self.web_seed.fetched_bytes} bytes from the web seed.")
 
-        except Exception as e:
-            self.log(f"Error saving piece {piece_index}: {e}")
+        # If all peers already finished, stop immediately
+        if all_done:
+            self.log("All peers complete — stopping.")
+            self._stop_all_done()
 
     def connect_to_peers(self):
         """
         Initial connections at startup:
-        Each peer connects to all peers listed before it in PeerInfo.cfg.
+        With a tracker (TrackerURL), announce and dial the random subset of
+        peers it returns. Otherwise, or if the tracker can't be reached, each
+        peer connects to all peers listed before it in PeerInfo.cfg.
         """
+        if P2P_init.TRACKER_URL:
+            response = self.announce('started')
+            if response is not None:
+                self._connect_to_tracker_peers(response)
+                return
+            self.log("Tracker unreachable, falling back to PeerInfo.cfg.")
+
         peer_ids_sorted = sorted(P2P_init.peer_info.keys())
         my_index = peer_ids_sorted.index(self.peer_id)
         older_peers = peer_ids_sorted[:my_index]
 
         for other_id in older_peers:
+            if self._at_connection_cap(dialing=True):
+                break
             host, port, _ = P2P_init.peer_info[other_id]
+            self._dial(other_id, host, port)
+
+    def _dial(self, other_id, host, port):
+        """Connect to one peer, exchange handshakes and bitfields, start its handler thread."""
+        if self.shard is not None and not self.shard.owns(other_id):
+            # Another worker of ours dials this one
+            return
+        try:
+            sock = self._open_connection(host, port)
+
+            # Send handshake
+            sent = self.clock()
+            sock.sendall(handshake(self.peer_id, FEATURES))
+            print(self.bitfield)
+
+            # Receive handshake back (the first RTT sample)
+            hs = self.recv_exact(sock, 32)
+            rtt = self.clock() - sent
+            returned_id = parse_handshake(hs)
+
+            # Log "makes a connection"
+            self.log(f"Peer {self.peer_id} makes a connection to Peer {returned_id}.")
+            sock = self._traced(sock, returned_id)
+
+            # Neighbor state
+            if not self._register_neighbor(returned_id, sock, outbound=True,
+                                           features=parse_handshake_features(hs), rtt=rtt):
+                return
+
+            # Send our bitfield
+            self._send_initial_messages(returned_id, sock)
+
+            # Start message handling thread
+            t = threading.Thread(
+                target=self.handle_peer_connection,
+                args=(sock, returned_id),
+                daemon=True
+            )
+            t.start()
+
+        except Exception as e:
+            self.log(f"Error connecting to Peer {other_id}: {e}")
+
+    def bytes_left(self):
+        """Wanted bytes we still miss (what the tracker calls 'left')."""
+        left = 0
+        for i in range(P2P_init.NUM_PIECES):
+            if not self.bitfield.has_piece(i) and self.wants(i):
+                left += piece_length(i)
+        return left
+
+    def announce(self, event=None, timeout=5):
+        """
+        Announce ourselves to the tracker and return its response dict
+        ({'interval', 'peers', 'complete', 'incomplete'}), or None on failure.
+        """
+        params = {
+            'peer_id': self.peer_id,
+            'host': self.host_name,
+            'port': self.port_number,
+            'left': self.bytes_left(),
+            'numwant': P2P_init.NUM_WANT,
+        }
+        if event:
+            params['event'] = event
+        try:
+            with urllib.request.urlopen(f"{P2P_init.TRACKER_URL}?{urlencode(params)}",
+                                        timeout=timeout) as resp:
+                response = json.load(resp)
+        except (OSError, ValueError) as e:
+            self.log(f"Announce to tracker failed: {e}")
+            return None
+        if params['left'] or response.get('incomplete', 0) > 0:
+            self.seen_leechers = True
+        self._follow_announce_interval(response.get('interval'))
+        return response
+
+    def _follow_announce_interval(self, interval):
+        """Re-announce every `interval` seconds from now on, as the tracker asks."""
+        if not isinstance(interval, (int, float)) or interval <= 0 or interval == self.announce_interval:
+            return
+        self.log(f"Tracker asks for announces every {interval} seconds.")
+        self.announce_interval = interval
+        call = self.announce_call
+        if call is not None:
+            # The scheduler reads it when it schedules the next run
+            call.interval = interval
+
+    def _connect_to_tracker_peers(self, response):
+        """Dial peers from a tracker response until MaxConnections is reached."""
+        for entry in response.get('peers', []):
+            other_id = entry['peer_id']
+            if other_id == self.peer_id:
+                continue
+            with self.state_lock:
+                self.known_peers[other_id] = (entry['host'], entry['port'])
+            if other_id in self.connections:
+                continue
+            if self._at_connection_cap(dialing=True):
+                break
+            self._dial(other_id, entry['host'], entry['port'])
+
+    def handle_pex(self, payload, from_peer_id):
+        """
+        Learn addresses (and finished peers) from a neighbor's PEX message.
+        Learned peers are only dialed: the swarm we wait for before stopping
+        stays the one in PeerInfo.cfg, whose completions PEX passes along.
+        """
+        try:
+            added, dropped = parse_pex(payload)
+        except struct.error:
+            self.log(f"Malformed PEX from Peer {from_peer_id}.")
+            return
+        finished = []
+        with self.state_lock:
+            for pid, host, port, flags in added:
+                if pid == self.peer_id:
+                    continue
+                if flags & PEX_FLAG_SEED and pid not in self.finished_peers:
+                    finished.append(pid)
+                if pid not in self.known_peers and len(self.known_peers) >= MAX_KNOWN_PEERS:
+                    continue
+                self.known_peers[pid] = (host, port)
+            for pid in dropped:
+                if pid not in self.connections and pid not in self.finished_peers:
+                    self.known_peers.pop(pid, None)
+        for pid in finished:
+            self._peer_done(pid)
+
+    def _pex_entry(self, pid):
+        host, port = self.known_peers[pid]
+        flags = PEX_FLAG_SEED if pid in self.finished_peers else 0
+        return (pid, host, port, flags)
+
+    def send_pex(self):
+        """
+        Tell every neighbor which of our neighbors were added (or changed
+        seed status) and dropped since the last round. We list ourselves too,
+        so peers that only saw our inbound connection learn our listen port,
+        and every peer we know has finished, connected or not, so completions
+        travel further than one hop.
+        """
+        neighbors = self._neighbors()
+        with self.state_lock:
+            listed = {pid for pid, _ in neighbors} | self.finished_peers
+            advertised = {pid: self._pex_entry(pid) for pid in listed
+                          if pid in self.known_peers}
+        my_flags = PEX_FLAG_SEED if self.bitfield.is_complete() else 0
+        advertised[self.peer_id] = (self.peer_id, self.host_name, self.port_number, my_flags)
+
+        for nb_id, state in neighbors:
+            sent = state.pex_sent
+            added = [entry for pid, entry in advertised.items()
+                     if pid != nb_id and sent.get(pid) != entry[3]]
+            # Completions first: the rest is only addresses
+            added.sort(key=lambda entry: not entry[3] & PEX_FLAG_SEED)
+            added = added[:MAX_PEX_ADDED]
+            dropped = [pid for pid in sent if pid not in advertised]
+            if not added and not dropped:
+                continue
             try:
-                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                sock.connect((host, port))
-
-                # Send handshake
-                sock.sendall(handshake(self.peer_id))
-                print(self.bitfield)
-
-                # Receive handshake back
-                hs = self.recv_exact(sock, 32)
-                returned_id = parse_handshake(hs)
-
-                # Log "makes a connection"
-                self.log(f"Peer {self.peer_id} makes a connection to Peer {returned_id}.")
-
-                # Neighbor state
-                neighbor_state = {
-                    'socket': sock,
-                    'bitfield': Bitfield(P2P_init.NUM_PIECES, False),
-                    'am_choking': True,
-                    'peer_choking_me': True,
-                    'interested_in_me': False,
-                    'im_interested_in_them': False,
-                    'downloaded_bytes_interval': 0
-                }
-                self.connections[returned_id] = neighbor_state
-
-                # Send our bitfield
-                bf_msg = create_bitfield(self.bitfield.to_bytes())
-                sock.sendall(bf_msg)
-
-                # Start message handling thread
-                t = threading.Thread(
-                    target=self.handle_peer_connection,
-                    args=(sock, returned_id),
-                    daemon=True
-                )
-                t.start()
+                state.send(create_pex(added, dropped))
+            except OSError:
+                continue
+            for entry in added:
+                sent[entry[0]] = entry[3]
+            for pid in dropped:
+                del sent[pid]
 
-            except Exception as e:
-                self.log(f"Error connecting to Peer {other_id}: {e}")
+    def maintain_neighbors(self):
+        """
+        Keep the neighbor set within budget: dial known peers while below the
+        dialing limit, drop the slowest links while above MaxConnections.
+        """
+        if P2P_init.MAX_CONNECTIONS <= 0:
+            return
+        neighbors = self._neighbors()
+        excess = len(neighbors) - P2P_init.MAX_CONNECTIONS
+        if excess > 0:
+            with self.choke_lock:
+                keep = self.preferred_neighbors | {self.optimistic_neighbor, WEB_SEED_ID}
+            slowest = sorted(
+                ((pid, state) for pid, state in neighbors if pid not in keep),
+                key=lambda item: item[1].throughput
+            )
+            for pid, state in slowest[:excess]:
+                self.log(f"Pruning slow neighbor {pid}.")
+                try:
+                    state.socket.close()
+                except:
+                    pass
+            return
+
+        # Once complete there is nothing to gain from other seeds
+        complete = self.download_complete()
+        with self.state_lock:
+            candidates = [(pid, addr) for pid, addr in self.known_peers.items()
+                          if pid not in self.connections
+                          and not (complete and pid in self.finished_peers)]
+        random.shuffle(candidates)
+        for pid, (host, port) in candidates:
+            if self._at_connection_cap(dialing=True) or self.stopped:
+                break
+            self._dial(pid, host, port)
+
+    def start_pex(self):
+        """Run peer exchange rounds every PexInterval seconds (no-op when 0)."""
+        if P2P_init.PEX_INTERVAL <= 0:
+            return
+        self.scheduler.call_every(P2P_init.PEX_INTERVAL, self._pex_round)
+
+    def _pex_round(self):
+        self.send_pex()
+        self.maintain_neighbors()
+
+    def start_keep_alive(self):
+        """Send keep-alives every KeepAliveInterval and reap neighbors silent for IdleTimeout."""
+        if P2P_init.KEEP_ALIVE_INTERVAL > 0:
+            self.scheduler.call_every(P2P_init.KEEP_ALIVE_INTERVAL, self.send_keep_alives)
+        if P2P_init.IDLE_TIMEOUT > 0:
+            self.scheduler.call_every(max(1.0, P2P_init.IDLE_TIMEOUT / 4), self.reap_idle_neighbors)
+
+    def start_buffer_tuning(self):
+        """Grow socket buffers to each link's bandwidth-delay product (SocketBufferMax, tcp only)."""
+        if P2P_init.SOCKET_BUFFER_MAX > 0 and P2P_init.TRANSPORT == 'tcp':
+            self.scheduler.call_every(BUFFER_TUNE_INTERVAL, self.tune_socket_buffers)
+
+    def tune_socket_buffers(self):
+        """
+        Size each neighbor's send and receive buffers from its measured RTT
+        and the faster of our upload to it and our download from it. Buffers
+        only grow: the kernel's own choice stays when it is already larger.
+        """
+        now = self.clock()
+        for pid, state in self._neighbors():
+            if pid == WEB_SEED_ID:
+                continue
+            with state.lock:
+                uploaded, throughput = state.uploaded_bytes, state.throughput
+            mark, state.upload_mark = state.upload_mark, (now, uploaded)
+            if state.rtt is None or mark is None or now <= mark[0]:
+                continue
+            rate = max(throughput, (uploaded - mark[1]) / (now - mark[0]))
+            if rate <= 0:
+                continue
+            size = socket_buffer_size(rate, state.rtt, P2P_init.SOCKET_BUFFER_MAX)
+            sock = getattr(state.socket, 'raw', state.socket)
+            try:
+                grown = False
+                for option in (socket.SO_SNDBUF, socket.SO_RCVBUF):
+                    if sock.getsockopt(socket.SOL_SOCKET, option) < size:
+                        sock.setsockopt(socket.SOL_SOCKET, option, size)
+                        grown = True
+                if grown:
+                    # The kernel may double the value or cap it (net.core.wmem_max/rmem_max)
+                    self.log(f"Peer {self.peer_id} grew the socket buffers for {pid} to "
+                             f"{sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)}/"
+                             f"{sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)} bytes "
+                             f"({rate:.0f} B/s, {state.rtt * 1000:.1f} ms RTT).")
+            except OSError:
+                continue
+
+    def send_keep_alives(self):
+        msg = create_keep_alive()
+        for pid, state in self._neighbors():
+            try:
+                if state.pings:
+                    # The keep-alive doubles as an RTT probe
+                    self._ping(state)
+                else:
+                    state.send(msg)
+            except OSError:
+                pass
+
+    def _ping(self, state):
+        """Send a keep-alive with a fresh token; its PONG gives an RTT sample."""
+        token = random.getrandbits(32)
+        with state.lock:
+            state.ping = (token, self.clock())
+        state.send(create_keep_alive(token))
+
+    def _record_pong(self, neighbor, payload):
+        """Fold the round trip of our last ping into the neighbor's smoothed RTT."""
+        now = self.clock()
+        with neighbor.lock:
+            if neighbor.ping is None or payload != struct.pack('>I', neighbor.ping[0]):
+                # Stale or unsolicited
+                return
+            sample = now - neighbor.ping[1]
+            neighbor.ping = None
+            if neighbor.rtt is None:
+                neighbor.rtt = sample
+            else:
+                neighbor.rtt = 0.875 * neighbor.rtt + 0.125 * sample
+
+    def reap_idle_neighbors(self):
+        """
+        Drop neighbors that sent nothing, not even a keep-alive, for
+        IdleTimeout seconds. A vanished host never makes recv fail, so
+        without this its entry would keep a connection and unchoke slot.
+        """
+        cutoff = self.clock() - P2P_init.IDLE_TIMEOUT
+        refill_preferred = False
+        for pid, state in self._neighbors():
+            if state.last_received >= cutoff or pid == WEB_SEED_ID:
+                continue
+            self.log(f"Peer {self.peer_id} dropping neighbor {pid}: nothing received for "
+                     f"{P2P_init.IDLE_TIMEOUT}s.")
+            sock = state.socket
+            try:
+                # close() alone doesn't wake the handler thread blocked in recv
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            try:
+                sock.close()
+            except:
+                pass
+            with self.choke_lock:
+                refill_preferred |= pid in self.preferred_neighbors
+                was_optimistic = self.optimistic_neighbor == pid
+            self._remove_neighbor(pid, sock)
+            # Hand freed unchoke slots to someone else now, not next round
+            if was_optimistic and self.shard is None:
+                self.update_optimistic_neighbor()
+        if refill_preferred and self.shard is None:
+            self.update_preferred_neighbors()
+
+    def start_metrics(self):
+        """Append the timing histograms to metrics_peer_<id>.log every MetricsInterval seconds."""
+        if P2P_init.METRICS_INTERVAL > 0:
+            self.scheduler.call_every(P2P_init.METRICS_INTERVAL, self.flush_metrics)
+
+    def flush_metrics(self):
+        self.metrics.flush(f"metrics_peer_{self._file_tag()}.log")
+
+    def start_announcing(self):
+        """
+        Re-announce to the tracker periodically (no-op without TrackerURL),
+        every AnnounceInterval seconds or as often as the tracker asks.
+        """
+        if not P2P_init.TRACKER_URL:
+            return
+        # The HTTP request can take seconds; keep it off the scheduler thread
+        self.announce_call = self.scheduler.call_every(self.announce_interval, self.reannounce,
+                                                       in_thread=True)
+
+    def reannounce(self):
+        """
+        One periodic announce: report progress, top up connections from the
+        returned peers, and stop once the tracker sees no incomplete peers.
+        A seeder that has not yet seen a leecher keeps waiting for one.
+        """
+        event = None
+        if self.download_complete() and not self.announced_complete:
+            event = 'completed'
+        response = self.announce(event)
+        if response is None:
+            return
+        if event:
+            self.announced_complete = True
+        self._connect_to_tracker_peers(response)
+        if self.download_complete() and self.seen_leechers and response.get('incomplete') == 0:
+            self.log("Tracker reports every peer complete. Stopping.")
+            self.stop()
 
     def start_choking_algorithm(self):
         """
-        Start background threads for:
+        Schedule:
         - updating preferred neighbors every UnchokingInterval seconds
         - updating optimistic unchoked neighbor every OptimisticUnchokingInterval seconds
+        - reassigning requests that missed their deadline
         """
-        t1 = threading.Thread(
-            target=self._preferred_neighbors_loop,
-            daemon=True
-        )
-        t2 = threading.Thread(
-            target=self._optimistic_unchoke_loop,
-            daemon=True
-        )
-        t1.start()
-        t2.start()
-
-    def _preferred_neighbors_loop(self):
-        while not self.stopped:
-            time.sleep(P2P_init.UNCHOKING_INTERVAL)
-            if self.stopped:
-                break
-            self.update_preferred_neighbors()
-
-    def _optimistic_unchoke_loop(self):
-        while not self.stopped:
-            time.sleep(P2P_init.OPTIMISTIC_UNCHOKING_INTERVAL)
-            if self.stopped:
-                break
-            self.update_optimistic_neighbor()
+        if self.shard is None:
+            # Workers are choked and unchoked by the master (sharding.Master)
+            self.scheduler.call_every(P2P_init.UNCHOKING_INTERVAL, self.update_preferred_neighbors)
+            self.scheduler.call_every(P2P_init.OPTIMISTIC_UNCHOKING_INTERVAL, self.update_optimistic_neighbor)
+        self.scheduler.call_every(REQUEST_CHECK_INTERVAL, self.expire_requests)
 
+    @timed('choke.preferred')
     def update_preferred_neighbors(self):
         """
         Every p seconds, select k preferred neighbors.
@@ -650,90 +3148,165 @@ class Peer:
         """
         # Collect interested neighbors
         interested_neighbors = [
-            (pid, state) for pid, state in self.connections.items()
-            if state['interested_in_me']
+            (pid, state.downloaded_bytes_interval) for pid, state in self._neighbors()
+            if state.interested_in_me
         ]
 
+        with self.state_lock:
+            uploaded = self.uploaded_bytes
+        self.adapt_upload_slots(uploaded, len(self.preferred_neighbors))
+
         if not interested_neighbors:
             return
 
-        if self.bitfield.is_complete():
+        preferred = self.set_preferred_neighbors(self.choose_preferred_neighbors(interested_neighbors))
+
+        # Log preferred neighbors list
+        neighbors_str = ",".join(str(pid) for pid in preferred)
+        self.log(f"Peer {self.peer_id} has the preferred neighbors {neighbors_str}.")
+
+    def choose_preferred_neighbors(self, interested_neighbors):
+        """
+        The k neighbors to unchoke out of interested_neighbors, a list of
+        (peer id, bytes it sent us this interval).
+        """
+        weight = P2P_init.PROXIMITY_WEIGHT
+        if weight > 0:
+            proximity = self._proximity(self._neighbors())
+            if self.download_complete():
+                # Random, tilted towards nearby neighbors
+                interested_neighbors.sort(key=lambda item: random.random() + weight * proximity.get(item[0], 0.0),
+                                          reverse=True)
+            else:
+                # Rate scaled up for nearby neighbors; proximity breaks ties
+                interested_neighbors.sort(key=lambda item: (item[1] * (1 + weight * proximity.get(item[0], 0.0)),
+                                                            proximity.get(item[0], 0.0)), reverse=True)
+        elif self.download_complete():
             # Choose k randomly among interested
             random.shuffle(interested_neighbors)
-            selected = [pid for pid, _ in interested_neighbors[:P2P_init.NUMBER_OF_PREFERRED_NEIGHBORS]]
         else:
             # Sort by downloaded_bytes_interval descending
-            interested_neighbors.sort(
-                key=lambda item: item[1]['downloaded_bytes_interval'],
-                reverse=True
-            )
-            selected = [pid for pid, _ in interested_neighbors[:P2P_init.NUMBER_OF_PREFERRED_NEIGHBORS]]
+            interested_neighbors.sort(key=lambda item: item[1], reverse=True)
+        return [pid for pid, _ in interested_neighbors[:self.upload_slots]]
 
-        self.preferred_neighbors = set(selected)
+    def _proximity(self, neighbors):
+        """
+        peer id -> proximity in [0, 1] for the (peer id, state) pairs: the
+        mean of the neighbor's locality and of its RTT relative to the
+        closest neighbor's (0 while unmeasured).
+        """
+        rtts = [state.rtt for _, state in neighbors if state.rtt]
+        best = min(rtts) if rtts else None
+        return {pid: (state.locality + (best / state.rtt if state.rtt else 0.0)) / 2
+                for pid, state in neighbors}
 
-        # Log preferred neighbors list
-        if self.preferred_neighbors:
-            neighbors_str = ",".join(str(pid) for pid in sorted(self.preferred_neighbors))
-        else:
-            neighbors_str = ""
-        self.log(f"Peer {self.peer_id} has the preferred neighbors {neighbors_str}.")
+    def adapt_upload_slots(self, uploaded, used):
+        """
+        With AdaptiveUploadSlots, retune upload_slots from the upload rate
+        since the last round. uploaded: running total of bytes uploaded;
+        used: neighbors unchoked by the last round.
+        """
+        if self.slot_control is None:
+            return
+        now = self.clock()
+        last, self.slot_round = self.slot_round, (now, uploaded)
+        if last is None or now <= last[0]:
+            return
+        rate = (uploaded - last[1]) / (now - last[0])
+        change = self.slot_control.update(rate, used)
+        if change is not None:
+            self.upload_slots, reason = change
+            self.log(f"Peer {self.peer_id} now unchokes {self.upload_slots} preferred neighbors: {reason}.")
 
-        # Unchoke new preferred neighbors
-        for pid in self.preferred_neighbors:
-            if pid in self.connections:
-                state = self.connections[pid]
-                if state['am_choking'] and pid != self.optimistic_neighbor:
-                    try:
-                        state['socket'].sendall(create_unchoke())
-                        state['am_choking'] = False
-                    except:
-                        pass
-
-        # Choke neighbors that are no longer preferred and not optimistic neighbor
-        for pid, state in self.connections.items():
-            if pid not in self.preferred_neighbors and pid != self.optimistic_neighbor:
-                if not state['am_choking']:
-                    try:
-                        state['socket'].sendall(create_choke())
-                        state['am_choking'] = True
-                    except:
-                        pass
+    def set_preferred_neighbors(self, selected):
+        """
+        Unchoke the selected neighbors, choke the others (except the
+        optimistic one) and start a new rate interval. Ids that are not our
+        neighbors are ignored. Returns the preferred neighbors, sorted.
+        """
+        neighbors = self._neighbors()
+        # Decide under choke_lock, send once it is released
+        to_unchoke, to_choke = [], []
+        with self.choke_lock:
+            self.preferred_neighbors = {pid for pid, state in neighbors
+                                        if pid in selected and not state.closed}
+            for pid, state in neighbors:
+                if pid == self.optimistic_neighbor or state.closed:
+                    continue
+                # Unchoke new preferred neighbors, choke those no longer preferred
+                if pid in self.preferred_neighbors:
+                    if state.am_choking:
+                        state.am_choking = False
+                        to_unchoke.append(state)
+                elif not state.am_choking:
+                    state.am_choking = True
+                    to_choke.append(state)
+            preferred = sorted(self.preferred_neighbors)
+
+        for states, msg in ((to_unchoke, create_unchoke()), (to_choke, create_choke())):
+            for state in states:
+                try:
+                    state.send(msg)
+                except:
+                    pass
 
         # Reset download interval counters
-        for _, state in self.connections.items():
-            state['downloaded_bytes_interval'] = 0
+        for _, state in neighbors:
+            with state.lock:
+                state.downloaded_bytes_interval = 0
+        return preferred
 
+    @timed('choke.optimistic')
     def update_optimistic_neighbor(self):
         """
         Every m seconds, randomly select one interested but choked neighbor as the
         optimistic unchoked neighbor.
         """
         # candidates: interested in me, currently choked by me, not already preferred
-        candidates = [
-            pid for pid, state in self.connections.items()
-            if state['interested_in_me'] and state['am_choking'] and pid not in self.preferred_neighbors
-        ]
+        neighbors = self._neighbors()
+        with self.choke_lock:
+            candidates = [
+                pid for pid, state in neighbors
+                if state.interested_in_me and state.am_choking
+                and pid not in self.preferred_neighbors and not state.closed
+            ]
 
         if not candidates:
             return
 
         new_opt = random.choice(candidates)
-        self.optimistic_neighbor = new_opt
+        if self.set_optimistic_neighbor(new_opt):
+            # Log optimistic neighbor
+            self.log(f"Peer {self.peer_id} has the optimistically unchoked neighbor {new_opt}.")
+
+    def set_optimistic_neighbor(self, peer_id):
+        """
+        Make peer_id the optimistically unchoked neighbor and unchoke it.
+        An id that is not our neighbor (or None) clears it. True if set.
+        """
+        state = self.connections.get(peer_id)
+        with self.choke_lock:
+            if state is None or state.closed:
+                self.optimistic_neighbor = None
+                return False
+            self.optimistic_neighbor = peer_id
+            if not state.am_choking:
+                return True
+            state.am_choking = False
 
         # Unchoke this neighbor
-        state = self.connections[new_opt]
         try:
-            state['socket'].sendall(create_unchoke())
-            state['am_choking'] = False
+            state.send(create_unchoke())
         except:
             pass
-
-        # Log optimistic neighbor
-        self.log(f"Peer {self.peer_id} has the optimistically unchoked neighbor {new_opt}.")
+        return True
 
 
-def peerProcess(peer_id):
-    """Main peer process function."""
+def peerProcess(peer_id, ranges=None, shard=None):
+    """
+    Main peer process function. ranges: --range specs to download only part
+    of the file. shard: set in the worker processes of a sharded peer.
+    """
 
     # Read configuration directly from Common.cfg
     init_Common()
@@ -741,11 +3314,25 @@ def peerProcess(peer_id):
     # Read peer info directly from PeerInfo.cfg
     PeerInfo_init()
 
+    if shard is None and P2P_init.WORKERS > 1:
+        if P2P_init.TRANSPORT == 'tcp':
+            # This process only coordinates; the workers do the networking
+            peer = Peer(peer_id)
+            if ranges:
+                peer.want_ranges([parse_range(spec) for spec in ranges])
+            sharding.Master(peer, P2P_init.WORKERS, ranges).run()
+            return
+        print("Workers needs Transport tcp; running one process.")
+
     # Create peer instance
-    peer = Peer(peer_id)
+    peer = Peer(peer_id, shard)
+    if ranges:
+        peer.want_ranges([parse_range(spec) for spec in ranges])
 
     # Start server
     server_socket = peer.start_server()
+    if shard is not None:
+        shard.start()
 
     # Start thread to handle incoming connections
     t_accept = threading.Thread(
@@ -755,37 +3342,51 @@ def peerProcess(peer_id):
     )
     t_accept.start()
 
-    # Connect to older peers
+    # Connect to older peers (or tracker-supplied peers)
     peer.connect_to_peers()
+    peer.start_announcing()
+    peer.start_pex()
+    peer.start_keep_alive()
+    peer.start_buffer_tuning()
+    peer.start_metrics()
+    peer.start_web_seed()
+    instrumentation.install_signal_handlers(peer)
 
     # Start choking/unchoking algorithms
     peer.start_choking_algorithm()
 
     try:
         # Keep the main thread alive until the peer decides to stop
-        while not peer.stopped:
-            time.sleep(1)
+        peer.stop_event.wait()
     except KeyboardInterrupt:
         peer.log("Peer process terminated by user.")
         peer.stop()
     finally:
+        # Let queued piece writes reach the disk
+        peer.disk.close()
+        peer.disk.join(5)
+        if P2P_init.METRICS_INTERVAL > 0:
+            peer.flush_metrics()
+        if peer.trace is not None:
+            peer.trace.close()
         # Extra safety: close sockets if anything is still open
         if peer.server_socket is not None:
             try:
                 peer.server_socket.close()
             except:
                 pass
-        for _, state in peer.connections.items():
+        for _, state in peer._neighbors():
             try:
-                state['socket'].close()
+                state.socket.close()
             except:
                 pass
         peer.log("Peer process exiting.")
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: python peerProcess.py <peer_id>")
-        sys.exit(1)
-
-    peer_id = int(sys.argv[1])
-    peerProcess(peer_id)
+    parser = argparse.ArgumentParser(description="Run one peer of the swarm.")
+    parser.add_argument('peer_id', type=int)
+    parser.add_argument('--range', action='append', dest='ranges', metavar='START-END[:PRIORITY]',
+                        help="only download these bytes (inclusive, END may be empty for end of "
+                             "file); PRIORITY is skip, normal (default) or high; repeatable")
+    args = parser.parse_args()
+    peerProcess(args.peer_id, args.ranges)
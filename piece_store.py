@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+"""
+Content-addressed piece store shared by every peer on a host
+Pieces are kept as one file each under <dir>/<first two hex digits>/<sha1>,
+named by the SHA-1 the delta-sync manifest lists for them, so peers of any
+swarm and any peer directory find the same content under the same name.
+Entries are only added after their SHA-1 was checked. Copies into and out
+of the store use copy_file_range, which shares the blocks instead of
+copying them (a reflink) on filesystems that support it. Reading an entry
+touches its modification time, and gc() deletes the least recently used
+entries until the store fits its byte budget.
+
+    python piece_store.py /var/cache/p2p-pieces stats
+    python piece_store.py /var/cache/p2p-pieces gc --budget 1073741824
+"""
+
+import argparse
+import errno
+import hashlib
+import os
+import threading
+
+COPY_CHUNK = 1024 * 1024   # bytes per read/write when the kernel can't copy for us
+
+
+def copy_range(src, src_offset, dst, dst_offset, length):
+    """
+    Copy length bytes between two open binary files. Tries copy_file_range
+    (in-kernel, reflinked where the filesystem allows) and falls back to
+    reading and writing.
+    """
+    copied = 0
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while copied < length:
+                n = os.copy_file_range(src.fileno(), dst.fileno(), length - copied,
+                                       src_offset + copied, dst_offset + copied)
+                if n == 0:
+                    break
+                copied += n
+        except OSError as e:
+            # Older kernels refuse to copy across filesystems
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                raise
+    while copied < length:
+        src.seek(src_offset + copied)
+        block = src.read(min(COPY_CHUNK, length - copied))
+        if not block:
+            raise OSError(f"{src.name} ends {length - copied} bytes short")
+        dst.seek(dst_offset + copied)
+        dst.write(block)
+        copied += len(block)
+
+
+def file_sha1(f, length):
+    """SHA-1 hex digest of the first length bytes of an open binary file."""
+    digest = hashlib.sha1()
+    f.seek(0)
+    while length > 0:
+        block = f.read(min(COPY_CHUNK, length))
+        if not block:
+            break
+        digest.update(block)
+        length -= len(block)
+    return digest.hexdigest()
+
+
+class PieceStore:
+    """
+    A store directory with a byte budget (0 = unlimited). Several processes
+    may use one directory: entries appear atomically with os.replace, and
+    the size kept here is only an estimate that gc() corrects.
+    """
+
+    def __init__(self, directory, budget=0):
+        self.directory = directory
+        self.budget = budget
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.size = sum(size for _, size, _ in self.entries())
+
+    def path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def entries(self):
+        """(path, size, mtime) of every entry."""
+        found = []
+        for sub in os.scandir(self.directory):
+            if not sub.is_dir() or len(sub.name) != 2:
+                continue
+            for entry in os.scandir(sub.path):
+                if entry.name.startswith('.'):
+                    continue   # an add in progress
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue   # collected meanwhile
+                found.append((entry.path, st.st_size, st.st_mtime))
+        return found
+
+    def has(self, digest):
+        return os.path.exists(self.path(digest))
+
+    def add(self, digest, src, offset, length):
+        """
+        Store length bytes at offset of the open file src as digest, unless
+        they don't hash to it. True if the entry is (now) in the store.
+        """
+        target = self.path(digest)
+        if os.path.exists(target):
+            self._touch(target)
+            return True
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        tmp = os.path.join(os.path.dirname(target), f".{digest}.{os.getpid()}.{threading.get_ident()}")
+        try:
+            with open(tmp, 'w+b') as f:
+                copy_range(src, offset, f, 0, length)
+                if file_sha1(f, length) != digest:
+                    os.unlink(tmp)
+                    return False
+            os.replace(tmp, target)
+        except OSError:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            raise
+        with self.lock:
+            self.size += length
+            over = self.budget and self.size > self.budget
+        if over:
+            self.gc()
+        return True
+
+    def copy_out(self, digest, dst, offset, length):
+        """
+        Copy entry digest to offset of the open file dst. False if there is
+        no such entry (or it was collected meanwhile) or its size is not length.
+        """
+        target = self.path(digest)
+        try:
+            with open(target, 'rb') as f:
+                if os.fstat(f.fileno()).st_size != length:
+                    return False
+                copy_range(f, 0, dst, offset, length)
+        except FileNotFoundError:
+            return False
+        self._touch(target)
+        return True
+
+    def _touch(self, target):
+        try:
+            os.utime(target)
+        except FileNotFoundError:
+            pass
+
+    def gc(self, budget=None):
+        """
+        Delete least recently used entries until at most budget bytes
+        (default: the store's budget, if it has one) remain. Returns bytes freed.
+        """
+        if budget is None:
+            if not self.budget:
+                return 0
+            budget = self.budget
+        entries = sorted(self.entries(), key=lambda e: e[2])
+        total = sum(size for _, size, _ in entries)
+        freed = 0
+        for path, size, _ in entries:
+            if total <= budget:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            freed += size
+        with self.lock:
+            self.size = total
+        return freed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Inspect or shrink a piece store.")
+    parser.add_argument('directory')
+    sub = parser.add_subparsers(dest='command', required=True)
+    sub.add_parser('stats', help="count entries and bytes")
+    gc = sub.add_parser('gc', help="delete least recently used entries")
+    gc.add_argument('--budget', type=int, required=True, help="bytes to keep")
+    args = parser.parse_args(argv)
+    store = PieceStore(args.directory)
+    if args.command == 'stats':
+        print(f"{len(store.entries())} pieces, {store.size} bytes")
+    else:
+        freed = store.gc(args.budget)
+        print(f"freed {freed} bytes, {store.size} bytes left")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+"""
+Sharded peer: one peer id served by several processes (Workers K)
+The master process prepares the file and the log like a normal peer, then
+starts K worker processes. Each worker is a full Peer with its own
+neighbors; all of them listen on the peer's port with SO_REUSEPORT, so the
+kernel spreads incoming connections over them, and outgoing dials are
+split by remote peer id. Our bitfield and the availability counts live in
+multiprocessing.shared_memory, guarded by striped cross-process locks.
+The master relays HAVE/DONE between workers and runs the choking rounds
+over the neighbors of all workers:
+
+    master -> worker   ('report',)             send neighbor stats
+                       ('preferred', [ids])     unchoke these, choke the rest
+                       ('optimistic', id)       optimistic unchoke (None = not yours)
+                       ('have', piece)          another worker stored piece
+                       ('done', peer id)        another worker heard DONE
+    worker -> master   ('stats', index, [(id, interested, choking, bytes)], uploaded)
+                       ('have', piece), ('done', peer id)
+"""
+
+import multiprocessing
+import random
+import threading
+from multiprocessing import shared_memory
+
+import P2P_init
+
+REPORT_TIMEOUT = 1.0   # seconds the master waits for stats in a choking round
+
+# Workers start fresh rather than forking a process that already runs threads
+_context = multiprocessing.get_context('spawn')
+
+
+class SharedPieceState:
+    """
+    Bitfield (one byte per piece) and availability counts (int32 per piece)
+    in one shared memory block, plus the lock stripes guarding them.
+    """
+
+    def __init__(self, num_pieces, name=None, locks=None, stripes=16):
+        self.num_pieces = num_pieces
+        self.avail_offset = (num_pieces + 7) // 8 * 8
+        size = max(1, self.avail_offset + 4 * num_pieces)
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.locks = locks if locks is not None else [_context.Lock() for _ in range(stripes)]
+        self.bits = self.shm.buf[:num_pieces].cast('?')
+        self.availability = self.shm.buf[self.avail_offset:self.avail_offset + 4 * num_pieces].cast('i')
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def attach(self, peer):
+        """Make peer use the shared bitfield, availability and locks."""
+        peer.bitfield.bits = self.bits
+        peer.availability = self.availability
+        peer.piece_locks.stripes = self.locks
+
+    def close(self, unlink=False):
+        self.bits.release()
+        self.availability.release()
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+class WorkerLink:
+    """A worker's end of the master connection; Peer.shard in a worker process."""
+
+    def __init__(self, index, count, shm_name, locks, conn):
+        self.index = index
+        self.count = count
+        self.shm_name = shm_name
+        self.locks = locks
+        self.conn = conn
+        self.send_lock = threading.Lock()
+        self.peer = None
+        self.shared = None
+
+    def attach(self, peer):
+        """Called from Peer.__init__: switch peer to the shared piece state."""
+        self.peer = peer
+        self.shared = SharedPieceState(P2P_init.NUM_PIECES, self.shm_name, self.locks)
+        self.shared.attach(peer)
+
+    def start(self):
+        """Start following the master once the peer is up."""
+        threading.Thread(target=self._reader, daemon=True).start()
+
+    def owns(self, other_id):
+        """Whether this worker is the one that dials other_id."""
+        return other_id % self.count == self.index
+
+    def send(self, message):
+        try:
+            with self.send_lock:
+                self.conn.send(message)
+        except OSError:
+            pass
+
+    def _reader(self):
+        peer = self.peer
+        while True:
+            try:
+                message = self.conn.recv()
+            except (EOFError, OSError):
+                # Master is gone; don't linger as an orphan
+                peer.stop()
+                return
+            try:
+                kind = message[0]
+                if kind == 'report':
+                    with peer.state_lock:
+                        uploaded = peer.uploaded_bytes
+                    self.send(('stats', self.index, [
+                        (pid, state.interested_in_me, state.am_choking, state.downloaded_bytes_interval)
+                        for pid, state in peer._neighbors()], uploaded))
+                elif kind == 'preferred':
+                    peer.set_preferred_neighbors(message[1])
+                elif kind == 'optimistic':
+                    peer.set_optimistic_neighbor(message[1])
+                elif kind == 'have':
+                    peer._announce_piece(message[1])
+                elif kind == 'done':
+                    peer._peer_done(message[1], relay=False)
+            except Exception as e:
+                peer.log(f"Error handling master message {message[0]}: {e}")
+
+
+def worker_main(peer_id, ranges, index, count, shm_name, locks, conn):
+    """Entry point of a worker process."""
+    import peerProcess
+    peerProcess.peerProcess(peer_id, ranges, WorkerLink(index, count, shm_name, locks, conn))
+
+
+class Master:
+    """
+    Runs in the original process with a Peer that opens no sockets: the
+    Peer prepared the log, the file and the bitfield, and keeps logging.
+    """
+
+    def __init__(self, peer, count, ranges=None):
+        self.peer = peer
+        self.count = count
+        self.ranges = ranges
+        self.shared = SharedPieceState(P2P_init.NUM_PIECES)
+        for i, has in enumerate(peer.bitfield.bits):
+            self.shared.bits[i] = has
+        self.shared.attach(peer)
+        self.conns = []
+        self.procs = []
+        self.send_locks = []
+        self.cond = threading.Condition()
+        self.reports = {}
+        self.uploaded = {}   # worker index -> bytes it has uploaded, as last reported
+
+    def run(self):
+        """Start the workers and coordinate them until they all exit."""
+        peer = self.peer
+        try:
+            for index in range(self.count):
+                parent_end, child_end = _context.Pipe()
+                proc = _context.Process(target=worker_main, name=f"peer-{peer.peer_id}-w{index}",
+                                        args=(peer.peer_id, self.ranges, index, self.count,
+                                              self.shared.name, self.shared.locks, child_end))
+                proc.start()
+                child_end.close()
+                self.conns.append(parent_end)
+                self.send_locks.append(threading.Lock())
+                self.procs.append(proc)
+                threading.Thread(target=self._reader, args=(index,), daemon=True).start()
+            peer.log(f"Peer {peer.peer_id} running {self.count} worker processes on port {peer.port_number}.")
+            peer.scheduler.call_every(P2P_init.UNCHOKING_INTERVAL, self.choke_round)
+            peer.scheduler.call_every(P2P_init.OPTIMISTIC_UNCHOKING_INTERVAL, self.optimistic_round)
+            for proc in self.procs:
+                proc.join()
+        except KeyboardInterrupt:
+            peer.log("Peer process terminated by user.")
+            for proc in self.procs:
+                proc.join(5)
+        finally:
+            peer.scheduler.stop()
+            peer.disk.close()
+            for conn in self.conns:
+                conn.close()
+            self.shared.close(unlink=True)
+            peer.log("Peer process exiting.")
+
+    def send(self, index, message):
+        try:
+            with self.send_locks[index]:
+                self.conns[index].send(message)
+        except OSError:
+            pass
+
+    def broadcast(self, message, skip=None):
+        for index in range(len(self.conns)):
+            if index != skip:
+                self.send(index, message)
+
+    def _reader(self, index):
+        while True:
+            try:
+                message = self.conns[index].recv()
+            except (EOFError, OSError):
+                return
+            kind = message[0]
+            if kind in ('have', 'done'):
+                self.broadcast(message, skip=index)
+            elif kind == 'stats':
+                with self.cond:
+                    self.reports[message[1]] = message[2]
+                    self.uploaded[message[1]] = message[3]
+                    self.cond.notify_all()
+
+    def collect(self):
+        """Ask every worker for its neighbor stats: [(id, interested, choking, bytes)]."""
+        with self.cond:
+            self.reports = {}
+        self.broadcast(('report',))
+        alive = sum(1 for proc in self.procs if proc.is_alive())
+        with self.cond:
+            self.cond.wait_for(lambda: len(self.reports) >= alive, REPORT_TIMEOUT)
+            reports = list(self.reports.values())
+        return [entry for entries in reports for entry in entries]
+
+    def choke_round(self):
+        """update_preferred_neighbors over the neighbors of every worker."""
+        stats = self.collect()
+        with self.cond:
+            uploaded = sum(self.uploaded.values())
+        self.peer.adapt_upload_slots(uploaded, len(self.peer.preferred_neighbors))
+        interested = [(pid, downloaded) for pid, is_interested, _, downloaded in stats if is_interested]
+        if not interested:
+            return
+        selected = self.peer.choose_preferred_neighbors(interested)
+        self.peer.preferred_neighbors = set(selected)
+        self.peer.log(f"Peer {self.peer.peer_id} has the preferred neighbors "
+                      f"{','.join(str(pid) for pid in sorted(selected))}.")
+        self.broadcast(('preferred', selected))
+
+    def optimistic_round(self):
+        """update_optimistic_neighbor over the neighbors of every worker."""
+        stats = self.collect()
+        candidates = [pid for pid, interested, choking, _ in stats
+                      if interested and choking and pid not in self.peer.preferred_neighbors]
+        if not candidates:
+            return
+        new_opt = random.choice(candidates)
+        self.peer.log(f"Peer {self.peer.peer_id} has the optimistically unchoked neighbor {new_opt}.")
+        self.broadcast(('optimistic', new_opt))
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Loopback latency of the request/piece loop, with and without TcpNoDelay
+Two NeighborStates talk over a real TCP connection on 127.0.0.1. Each round
+the downloader does what a peer does after a piece arrives, HAVE to the
+uploader and then the next REQUEST, and waits for the PIECE, which the
+uploader sends like Peer._send_piece. The round trip is timed per round:
+
+    python socket_bench.py --rounds 1000 --piece-size 16384
+"""
+
+import argparse
+import socket
+import struct
+import threading
+import time
+
+import P2P_init
+import peerProcess
+
+
+def recv_exact(sock, num_bytes):
+    data = bytearray(num_bytes)
+    view = memoryview(data)
+    pos = 0
+    while pos < num_bytes:
+        n = sock.recv_into(view[pos:])
+        if not n:
+            raise ConnectionError("Socket closed unexpectedly")
+        pos += n
+    return data
+
+
+def recv_frame(sock):
+    length, message_type = struct.unpack('>IB', recv_exact(sock, 5))
+    return message_type, recv_exact(sock, length)
+
+
+def serve(sock, piece):
+    """Uploader: answer every REQUEST with a PIECE until the connection closes."""
+    neighbor = peerProcess.NeighborState(sock, 0.0)
+    try:
+        while True:
+            message_type, payload = recv_frame(sock)
+            if message_type == peerProcess.REQUEST:
+                header = struct.pack('>IBI', 4 + len(piece), peerProcess.PIECE,
+                                     struct.unpack('>I', payload)[0])
+                neighbor.send_piece(header, piece)
+    except (ConnectionError, OSError):
+        pass
+    finally:
+        sock.close()
+
+
+def run(no_delay, rounds, piece_size):
+    """Seconds each round took, with TcpNoDelay set to no_delay."""
+    P2P_init.TCP_NODELAY = no_delay
+    P2P_init.NUM_PIECES = 1
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen()
+    client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    peerProcess.tune_socket(client)
+    client.connect(listener.getsockname())
+    server, _ = listener.accept()
+    listener.close()
+    peerProcess.tune_socket(server)
+    threading.Thread(target=serve, args=(server, bytes(piece_size)), daemon=True).start()
+
+    neighbor = peerProcess.NeighborState(client, 0.0)
+    times = []
+    try:
+        for i in range(rounds):
+            start = time.perf_counter()
+            neighbor.send(peerProcess.create_have(i))
+            neighbor.send(peerProcess.create_request(i))
+            while recv_frame(client)[0] != peerProcess.PIECE:
+                pass
+            times.append(time.perf_counter() - start)
+    finally:
+        client.close()
+    return times
+
+
+def summary(times):
+    times = sorted(times)
+    pick = lambda q: times[min(len(times) - 1, int(q * len(times)))] * 1000
+    return {'mean_ms': sum(times) / len(times) * 1000, 'p50_ms': pick(0.5),
+            'p99_ms': pick(0.99), 'max_ms': times[-1] * 1000}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time HAVE+REQUEST -> PIECE rounds over loopback TCP.")
+    parser.add_argument('--rounds', type=int, default=1000)
+    parser.add_argument('--piece-size', type=int, default=16384)
+    args = parser.parse_args(argv)
+    for label, no_delay in (('TcpNoDelay 0', False), ('TcpNoDelay 1', True)):
+        stats = summary(run(no_delay, args.rounds, args.piece_size))
+        print(f"{label}: " + "  ".join(f"{k} {v:.3f}" for k, v in stats.items()))
+
+
+if __name__ == "__main__":
+    main()
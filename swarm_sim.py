@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+"""
+Discrete-event swarm simulator
+Drives the real Peer decision logic (choking, optimistic unchoke, piece
+selection, process_message) over a virtual clock instead of sockets and
+sleep loops, so large swarms can be studied on one core.
+"""
+
+import argparse
+import heapq
+import math
+import random
+import struct
+import time
+
+import P2P_init
+import peerProcess
+from peerProcess import Peer, PIECE, DONE
+
+
+class SimLink:
+    """
+    One direction of a simulated connection (src -> dst).
+    Frames are serialized on the link (and on the sender's uplink when the
+    sender has an upload cap) and delivered `latency` seconds after the last
+    byte leaves. Delivery order per link is FIFO, like TCP.
+    """
+
+    __slots__ = ('sim', 'src', 'dst', 'bandwidth', 'latency',
+                 'busy_until', 'bytes_sent', 'reverse')
+
+    def __init__(self, sim, src, dst, bandwidth, latency):
+        self.sim = sim
+        self.src = src
+        self.dst = dst
+        self.bandwidth = bandwidth
+        self.latency = latency
+        self.busy_until = 0.0
+        self.bytes_sent = 0
+        self.reverse = None
+
+    def sendall(self, data):
+        length = struct.unpack_from('>I', data)[0]
+        if length + 5 == len(data):
+            # Common case: exactly one frame
+            self.sim.transmit(self, data[4], memoryview(data)[5:], len(data))
+            return
+        # Several frames concatenated into one call
+        pos = 0
+        while pos + 5 <= len(data):
+            length = struct.unpack_from('>I', data, pos)[0]
+            message_type = data[pos + 4]
+            payload = data[pos + 5:pos + 5 + length]
+            self.sim.transmit(self, message_type, payload, length + 5)
+            pos += 5 + length
+
+    def close(self):
+        pass
+
+
+class SimPeer(Peer):
+    """Peer whose storage and logging are virtual; everything else is real."""
+
+    def __init__(self, peer_id, sim):
+        self.sim = sim
+        self.upload_busy_until = 0.0
+        self.completed_at = None
+        super().__init__(peer_id)
+
+    def _init_log_file(self):
+        pass
+
+    def log(self, message):
+        if self.sim.verbose:
+            print(f"[{self.sim.now:10.3f}] {self.peer_id}: {message}")
+
+    def _init_file_storage(self):
+        pass
+
+    def read_piece(self, piece_index):
+        offset = piece_index * P2P_init.PIECE_SIZE
+        max_len = min(P2P_init.PIECE_SIZE, P2P_init.FILE_SIZE - offset)
+        if max_len <= 0:
+            return None
+        return self.sim.piece_bytes(max_len)
+
+    def _write_piece(self, piece_index, piece_data):
+        pass
+
+
+class SwarmSimulator:
+    """
+    Event-driven swarm: a heap of (time, seq, callback, args) entries.
+    Choking rounds are scheduled per peer with random phase, message
+    delivery is scheduled by SimLink.
+    """
+
+    def __init__(self, num_peers, num_seeders=1, degree=20,
+                 bandwidth=1_000_000, latency=0.02, upload_bandwidth=None,
+                 seed=0, verbose=False):
+        self.num_peers = num_peers
+        self.num_seeders = num_seeders
+        self.degree = degree
+        self.bandwidth = bandwidth
+        self.latency = latency
+        self.upload_bandwidth = upload_bandwidth
+        self.verbose = verbose
+        self.rng = random.Random(seed)
+        random.seed(seed)   # Peer uses the module-level generator
+
+        self.now = 0.0
+        self._events = []
+        self._seq = 0
+        self._zero_cache = {}
+
+        self.peers = {}
+        self.links = []
+        self.events_processed = 0
+        self.bytes_by_type = {}
+        self.incomplete = set()
+        self.first_copy_at = None
+        self.seeder_upload_at_first_copy = None
+
+    # ---------------------------------------------------------------- clock
+
+    def schedule(self, delay, callback, *args):
+        self._seq += 1
+        heapq.heappush(self._events, (self.now + delay, self._seq, callback, args))
+
+    def clock(self):
+        return self.now
+
+    def piece_bytes(self, length):
+        data = self._zero_cache.get(length)
+        if data is None:
+            data = bytes(length)
+            self._zero_cache[length] = data
+        return data
+
+    # ------------------------------------------------------------- topology
+
+    def build(self):
+        """Create peers and a random connected overlay of roughly `degree` neighbors each."""
+        ids = list(range(1, self.num_peers + 1))
+        seeders = set(ids[:self.num_seeders])
+        all_ids = set(ids)
+
+        # Peer() only needs its own PeerInfo entry; building it with the full
+        # table would copy all N ids into every peer's total_peers.
+        for pid in ids:
+            P2P_init.peer_info.clear()
+            P2P_init.peer_info[pid] = ('sim', 0, pid in seeders)
+            peer = SimPeer(pid, self)
+            peer.total_peers = all_ids
+            peer.clock = self.clock
+            self.peers[pid] = peer
+            if pid not in seeders:
+                self.incomplete.add(pid)
+        P2P_init.peer_info.clear()
+        for pid in ids:
+            P2P_init.peer_info[pid] = ('sim', 0, pid in seeders)
+
+        edges = set()
+        if self.degree >= len(ids) - 1:
+            # Small swarm: full mesh, like peerProcess with PeerInfo.cfg
+            edges = {(a, b) for a in ids for b in ids if a < b}
+        else:
+            # A ring guarantees connectivity; each peer then dials degree/2
+            # random chords so the average degree is about `degree`
+            chords = max(1, self.degree // 2)
+            for i, pid in enumerate(ids):
+                nxt = ids[(i + 1) % len(ids)]
+                edges.add((min(pid, nxt), max(pid, nxt)))
+                for other in self.rng.sample(ids, chords + 1):
+                    if other != pid:
+                        edges.add((min(pid, other), max(pid, other)))
+
+        for a, b in sorted(edges):
+            self.connect(a, b)
+
+        for pid, peer in self.peers.items():
+            self.schedule(self.rng.uniform(0, P2P_init.UNCHOKING_INTERVAL),
+                          self._preferred_round, peer)
+            self.schedule(self.rng.uniform(0, P2P_init.OPTIMISTIC_UNCHOKING_INTERVAL),
+                          self._optimistic_round, peer)
+            self.schedule(self.rng.uniform(0, peerProcess.REQUEST_CHECK_INTERVAL),
+                          self._request_check, peer)
+
+    def connect(self, a, b):
+        """Open a simulated connection and exchange bitfields, as after a handshake."""
+        peer_a, peer_b = self.peers[a], self.peers[b]
+        ab = SimLink(self, peer_a, peer_b, self.bandwidth, self.latency)
+        ba = SimLink(self, peer_b, peer_a, self.bandwidth, self.latency)
+        ab.reverse, ba.reverse = ba, ab
+        self.links.extend((ab, ba))
+        peer_a.connections[b] = peer_a._new_neighbor_state(ab)
+        peer_b.connections[a] = peer_b._new_neighbor_state(ba)
+        peer_a._send_initial_messages(b, ab)
+        peer_b._send_initial_messages(a, ba)
+
+    # ------------------------------------------------------------- delivery
+
+    def transmit(self, link, message_type, payload, size):
+        sender = link.src
+        start = max(self.now, link.busy_until)
+        tx_time = size / link.bandwidth
+        if self.upload_bandwidth:
+            start = max(start, sender.upload_busy_until)
+            tx_time = max(tx_time, size / self.upload_bandwidth)
+            sender.upload_busy_until = start + tx_time
+        link.busy_until = start + tx_time
+        link.bytes_sent += size
+        self.bytes_by_type[message_type] = self.bytes_by_type.get(message_type, 0) + size
+        self._seq += 1
+        heapq.heappush(self._events, (link.busy_until + link.latency, self._seq,
+                                      self._deliver, (link, message_type, payload)))
+
+    def _deliver(self, link, message_type, payload):
+        peer = link.dst
+        if peer.stopped:
+            return
+        peer.process_message(message_type, payload, link.src.peer_id, link.reverse)
+        if message_type == PIECE and peer.completed_at is None and peer.bitfield.is_complete():
+            peer.completed_at = self.now
+            self.incomplete.discard(peer.peer_id)
+            if self.first_copy_at is None:
+                self.first_copy_at = self.now
+                self.seeder_upload_at_first_copy = self.seeder_upload()
+
+    def _preferred_round(self, peer):
+        if not peer.stopped:
+            peer.update_preferred_neighbors()
+            self.schedule(P2P_init.UNCHOKING_INTERVAL, self._preferred_round, peer)
+
+    def _request_check(self, peer):
+        if not peer.stopped and peer.peer_id in self.incomplete:
+            peer.expire_requests()
+            self.schedule(peerProcess.REQUEST_CHECK_INTERVAL, self._request_check, peer)
+
+    def _optimistic_round(self, peer):
+        if not peer.stopped:
+            peer.update_optimistic_neighbor()
+            self.schedule(P2P_init.OPTIMISTIC_UNCHOKING_INTERVAL, self._optimistic_round, peer)
+
+    # ----------------------------------------------------------------- run
+
+    def run(self, max_time=3600.0):
+        """Process events until every leecher completes or max_time passes."""
+        wall_start = time.perf_counter()
+        events = self._events
+        while events and self.incomplete:
+            when, _, callback, args = heapq.heappop(events)
+            if when > max_time:
+                self.now = max_time
+                break
+            self.now = when
+            callback(*args)
+            self.events_processed += 1
+        self.wall_time = time.perf_counter() - wall_start
+        return self.report()
+
+    def seeder_upload(self):
+        """Piece bytes uploaded so far by the initial seeders."""
+        return sum(self.peers[pid].uploaded_bytes for pid in range(1, self.num_seeders + 1))
+
+    def report(self):
+        times = sorted(p.completed_at for p in self.peers.values()
+                       if p.completed_at is not None)
+        leechers = self.num_peers - self.num_seeders
+
+        def pct(q):
+            if not times:
+                return None
+            return times[min(len(times) - 1, int(q * len(times)))]
+
+        return {
+            'peers': self.num_peers,
+            'completed': len(times),
+            'leechers': leechers,
+            'virtual_time': self.now,
+            'wall_time': self.wall_time,
+            'speedup': self.now / self.wall_time if self.wall_time > 0 else math.inf,
+            'events': self.events_processed,
+            'completion_p50': pct(0.5),
+            'completion_p90': pct(0.9),
+            'completion_max': times[-1] if times else None,
+            'bytes_total': sum(self.bytes_by_type.values()),
+            'bytes_piece': self.bytes_by_type.get(PIECE, 0),
+            'bytes_done': self.bytes_by_type.get(DONE, 0),
+            'duplicate_pieces': sum(p.in_flight.duplicate_pieces for p in self.peers.values()),
+            'first_copy_at': self.first_copy_at,
+            'seeder_upload_first_copy': self.seeder_upload_at_first_copy,
+            'seeder_upload_total': self.seeder_upload(),
+        }
+
+
+# The P2P_init globals configure() sets
+CONFIGURED = ('SUPER_SEEDING', 'ADAPTIVE_UPLOAD_SLOTS', 'MIN_UPLOAD_SLOTS', 'MAX_UPLOAD_SLOTS',
+              'NUMBER_OF_PREFERRED_NEIGHBORS', 'UNCHOKING_INTERVAL', 'OPTIMISTIC_UNCHOKING_INTERVAL',
+              'FILE_NAME', 'PIECE_SIZE', 'FILE_SIZE', 'NUM_PIECES')
+
+
+def configure(num_pieces, piece_size, preferred=3, unchoking_interval=5,
+              optimistic_interval=10, super_seeding=False, adaptive_slots=None):
+    """
+    Set the P2P_init globals the Peer logic reads (normally from Common.cfg).
+    adaptive_slots: (min, max) upload slots to turn AdaptiveUploadSlots on.
+    """
+    P2P_init.SUPER_SEEDING = super_seeding
+    P2P_init.ADAPTIVE_UPLOAD_SLOTS = adaptive_slots is not None
+    if adaptive_slots is not None:
+        P2P_init.MIN_UPLOAD_SLOTS, P2P_init.MAX_UPLOAD_SLOTS = adaptive_slots
+    P2P_init.NUMBER_OF_PREFERRED_NEIGHBORS = preferred
+    P2P_init.UNCHOKING_INTERVAL = unchoking_interval
+    P2P_init.OPTIMISTIC_UNCHOKING_INTERVAL = optimistic_interval
+    P2P_init.FILE_NAME = "sim"
+    P2P_init.PIECE_SIZE = piece_size
+    P2P_init.FILE_SIZE = num_pieces * piece_size
+    P2P_init.NUM_PIECES = num_pieces
+    peerProcess.NUM_PIECES = num_pieces
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Simulate a swarm of Peer objects on a virtual clock.")
+    parser.add_argument('--peers', type=int, default=100)
+    parser.add_argument('--seeders', type=int, default=1)
+    parser.add_argument('--degree', type=int, default=20, help="random neighbors per peer")
+    parser.add_argument('--pieces', type=int, default=64)
+    parser.add_argument('--piece-size', type=int, default=262144)
+    parser.add_argument('--preferred', type=int, default=3)
+    parser.add_argument('--unchoking-interval', type=float, default=5)
+    parser.add_argument('--optimistic-interval', type=float, default=10)
+    parser.add_argument('--bandwidth', type=float, default=1_000_000, help="per-link bytes/s")
+    parser.add_argument('--upload-bandwidth', type=float, default=None, help="per-peer upload cap, bytes/s")
+    parser.add_argument('--latency', type=float, default=0.02, help="per-link one-way seconds")
+    parser.add_argument('--max-time', type=float, default=3600)
+    parser.add_argument('--super-seed', action='store_true', help="initial seeders use super-seeding")
+    parser.add_argument('--adaptive-slots', type=int, nargs=2, metavar=('MIN', 'MAX'),
+                        help="tune the number of preferred neighbors between MIN and MAX")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    configure(args.pieces, args.piece_size, args.preferred,
+              args.unchoking_interval, args.optimistic_interval, args.super_seed,
+              args.adaptive_slots)
+    sim = SwarmSimulator(args.peers, args.seeders, args.degree, args.bandwidth,
+                         args.latency, args.upload_bandwidth, args.seed, args.verbose)
+    sim.build()
+    result = sim.run(args.max_time)
+    for key, value in result.items():
+        print(f"{key:>16}: {value}")
+    return result
+
+
+if __name__ == "__main__":
+    main()
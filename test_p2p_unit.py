@@ -1,10 +1,40 @@
+import multiprocessing
 import os
+import pstats
+import random
 import sys
 import shutil
+import socket
+import struct
+import tempfile
+import threading
+import time
 import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 import P2P_init
 import peerProcess
+import sharding
+import swarm_sim
+import delta_sync
+import frame_trace
+import instrumentation
+import piece_store
+import socket_bench
+import tracker
+import udp_transport
+
+def keep_config(test, *names):
+    """Put these P2P_init settings back once the test is over, so tests don't depend on their order."""
+    for name in names:
+        test.addCleanup(setattr, P2P_init, name, getattr(P2P_init, name))
+
+
+def keep_sim_config(test):
+    """Same for everything swarm_sim.configure() sets."""
+    keep_config(test, *swarm_sim.CONFIGURED)
+    test.addCleanup(setattr, peerProcess, 'NUM_PIECES', peerProcess.NUM_PIECES)
+
 
 class TestCommonCfg(unittest.TestCase):
     def test_common_cfg_exists_and_parsable(self):
@@ -142,6 +172,1549 @@ class TestSmokeImports(unittest.TestCase):
         for mod, attr in ((P2P_init, 'handshake'), (peerProcess, 'parse_handshake')):
             self.assertTrue(hasattr(mod, attr), f"{mod.__name__} should define {attr}")
 
+class TestSwarmSimulator(unittest.TestCase):
+    def setUp(self):
+        self.saved_peer_info = dict(P2P_init.peer_info)
+        keep_sim_config(self)
+        swarm_sim.configure(num_pieces=16, piece_size=4096, unchoking_interval=2,
+                            optimistic_interval=4)
+
+    def tearDown(self):
+        P2P_init.peer_info.clear()
+        P2P_init.peer_info.update(self.saved_peer_info)
+
+    def test_small_swarm_completes(self):
+        sim = swarm_sim.SwarmSimulator(30, num_seeders=1, degree=6,
+                                       bandwidth=100_000, latency=0.01, seed=1)
+        sim.build()
+        result = sim.run(max_time=600)
+        self.assertEqual(result['completed'], 29)
+        # every leecher needs at least one copy of every piece
+        self.assertGreaterEqual(result['bytes_piece'], 29 * 16 * 4096)
+        self.assertLess(result['virtual_time'], 600)
+
+    def test_run_is_deterministic_for_a_seed(self):
+        results = []
+        for _ in range(2):
+            sim = swarm_sim.SwarmSimulator(10, degree=4, seed=7)
+            sim.build()
+            results.append(sim.run(max_time=600)['completion_max'])
+        self.assertEqual(results[0], results[1])
+
+class FakeSocket:
+    """Collects whatever a Peer sends so tests can inspect the frames."""
+    def __init__(self):
+        self.sent = []
+
+    def sendall(self, data):
+        self.sent.append(bytes(data))
+
+    def shutdown(self, how):
+        self.was_shut_down = True
+
+    def close(self):
+        pass
+
+    def frames(self):
+        return [peerProcess.parse_message(m) for m in self.sent]
+
+
+class PeerTestCase(unittest.TestCase):
+    """Builds Peer objects in a scratch directory with a small file layout."""
+    NUM_PIECES = 8
+    PIECE_SIZE = 64
+
+    def setUp(self):
+        # Cleanups run last-registered first: these undo the scratch
+        # directory only after the peers a test stops have logged
+        self.old_cwd = os.getcwd()
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp, ignore_errors=True)
+        os.chdir(self.tmp)
+        self.addCleanup(os.chdir, self.old_cwd)
+        self.saved_peer_info = dict(P2P_init.peer_info)
+        self.addCleanup(self.restore_peer_info)
+        keep_config(self, 'NUMBER_OF_PREFERRED_NEIGHBORS', 'FILE_NAME', 'PIECE_SIZE', 'FILE_SIZE', 'NUM_PIECES')
+        P2P_init.NUMBER_OF_PREFERRED_NEIGHBORS = 2
+        P2P_init.FILE_NAME = 'thefile'
+        P2P_init.PIECE_SIZE = self.PIECE_SIZE
+        P2P_init.FILE_SIZE = self.NUM_PIECES * self.PIECE_SIZE
+        P2P_init.NUM_PIECES = self.NUM_PIECES
+        P2P_init.peer_info.clear()
+        for pid in range(1, 6):
+            P2P_init.peer_info[pid] = ('localhost', 7000 + pid, pid == 1)
+
+    def restore_peer_info(self):
+        P2P_init.peer_info.clear()
+        P2P_init.peer_info.update(self.saved_peer_info)
+
+    def make_peer(self, peer_id=2):
+        return peerProcess.Peer(peer_id)
+
+    def add_neighbor(self, peer, remote_id, pieces=()):
+        sock = FakeSocket()
+        state = peer._new_neighbor_state(sock)
+        for i in pieces:
+            state.bitfield.set_piece(i)
+        peer.connections[remote_id] = state
+        return sock
+
+
+class TestInFlightRegistry(PeerTestCase):
+    def test_claim_and_release(self):
+        reg = peerProcess.InFlightRegistry()
+        self.assertTrue(reg.claim(3, 1001, 0.0))
+        self.assertFalse(reg.claim(3, 1002, 0.0))
+        self.assertEqual(reg.pending(1001), [3])
+        self.assertEqual(reg.release(3)[:2], (1001, 0.0))
+        self.assertNotIn(3, reg)
+        reg.claim(1, 1001, 0.0, deadline=8.0)
+        reg.claim(2, 1002, 5.0, deadline=13.0)
+        self.assertEqual(reg.release_overdue(10.0), [(1, 1001)])
+        self.assertEqual(reg.release_peer(1002), [2])
+        self.assertEqual(len(reg), 0)
+
+    def test_two_neighbors_never_asked_for_same_piece(self):
+        peer = self.make_peer()
+        requested = []
+        for remote_id in (3, 4):
+            sock = self.add_neighbor(peer, remote_id, pieces=range(2))
+            peer.connections[remote_id].peer_choking_me = False
+            peer.send_request(remote_id, sock)
+            requested += [struct.unpack('>I', payload)[0]
+                          for mtype, payload in sock.frames() if mtype == peerProcess.REQUEST]
+        self.assertEqual(sorted(requested), [0, 1])
+
+    def test_choke_releases_and_duplicate_is_counted(self):
+        peer = self.make_peer()
+        sock3 = self.add_neighbor(peer, 3, pieces=[5])
+        sock4 = self.add_neighbor(peer, 4, pieces=[5])
+        peer.connections[3].peer_choking_me = False
+        peer.connections[4].peer_choking_me = False
+        peer.connections[4].im_interested_in_them = True
+        peer.send_request(3, sock3)
+        self.assertEqual(peer.in_flight.pending(3), [5])
+        # neighbor 4 is idle; a CHOKE from 3 hands the piece over to it
+        peer.process_message(peerProcess.CHOKE, b'', 3, sock3)
+        self.assertEqual(peer.in_flight.pending(4), [5])
+        data = bytes(self.PIECE_SIZE)
+        peer.save_piece(5, data, 4)
+        peer.save_piece(5, data, 3)
+        self.assertEqual(peer.in_flight.duplicate_pieces, 1)
+        self.assertEqual(len(peer.in_flight), 0)
+
+class TestRequestDeadlines(PeerTestCase):
+    def test_deadline_follows_service_time(self):
+        peer = self.make_peer()
+        self.add_neighbor(peer, 3)
+        state = peer.connections[3]
+        self.assertEqual(peer.request_deadline(state), P2P_init.REQUEST_TIMEOUT)
+        for _ in range(10):
+            peer._record_service_time(state, 2.0, self.PIECE_SIZE)
+        self.assertAlmostEqual(state.throughput, self.PIECE_SIZE / 2.0)
+        self.assertGreaterEqual(peer.request_deadline(state), 2.0)
+        self.assertLess(peer.request_deadline(state), 4.0)
+
+    def test_overdue_request_moves_to_other_neighbor(self):
+        peer = self.make_peer()
+        now = [0.0]
+        peer.clock = lambda: now[0]
+        sock3 = self.add_neighbor(peer, 3, pieces=[6])
+        sock4 = self.add_neighbor(peer, 4, pieces=[6])
+        peer.connections[3].peer_choking_me = False
+        peer.send_request(3, sock3)
+        self.assertEqual(peer.in_flight.pending(3), [6])
+        # neighbor 4 unchokes us later; nothing left to ask it for yet
+        peer.connections[4].peer_choking_me = False
+        now[0] = P2P_init.REQUEST_TIMEOUT + 1
+        peer.expire_requests()
+        self.assertEqual(peer.in_flight.pending(4), [6])
+        self.assertEqual(peer.connections[3].missed_deadlines, 1)
+        # the stalled neighbor is not handed new work while it owes a piece
+        self.assertFalse(peer._is_idle(3, peer.connections[3]))
+        requested = [struct.unpack('>I', p)[0] for t, p in sock4.frames() if t == peerProcess.REQUEST]
+        self.assertEqual(requested, [6])
+
+class TestTracker(PeerTestCase):
+    def test_announce_returns_bounded_subset_without_self(self):
+        t = tracker.Tracker(interval=30)
+        for pid in range(1, 51):
+            t.announce(pid, 'localhost', 6000 + pid, left=0 if pid == 1 else 100)
+        resp = t.announce(7, 'localhost', 6007, left=100, numwant=10)
+        ids = [p['peer_id'] for p in resp['peers']]
+        self.assertEqual(len(ids), 10)
+        self.assertNotIn(7, ids)
+        self.assertEqual((resp['complete'], resp['incomplete']), (1, 49))
+        t.announce(7, 'localhost', 6007, left=0, event='stopped')
+        self.assertEqual(t.scrape(), {'complete': 1, 'incomplete': 48})
+
+    def test_silent_peers_expire(self):
+        now = [0.0]
+        t = tracker.Tracker(interval=10, clock=lambda: now[0])
+        t.announce(1, 'localhost', 6001, left=0)
+        now[0] = 25.0
+        resp = t.announce(2, 'localhost', 6002, left=10)
+        self.assertEqual(resp['peers'], [])
+
+    def test_peer_announces_over_http(self):
+        server = tracker.start_tracker('localhost', 0)
+        self.addCleanup(server.shutdown)
+        keep_config(self, 'TRACKER_URL')
+        P2P_init.TRACKER_URL = 'http://localhost:%d/announce' % server.server_address[1]
+        seeder = self.make_peer(1)
+        leecher = self.make_peer(2)
+        seeder.announce('started')
+        resp = leecher.announce('started')
+        self.assertEqual([p['peer_id'] for p in resp['peers']], [1])
+        self.assertEqual(resp['incomplete'], 1)
+        self.assertEqual(leecher.bytes_left(), P2P_init.FILE_SIZE)
+
+    def test_seeder_waits_for_a_leecher_before_stopping(self):
+        server = tracker.start_tracker('localhost', 0)
+        self.addCleanup(server.shutdown)
+        keep_config(self, 'TRACKER_URL')
+        P2P_init.TRACKER_URL = 'http://localhost:%d/announce' % server.server_address[1]
+        seeder = self.make_peer(1)
+        seeder.announce('started')
+        seeder.reannounce()
+        self.assertFalse(seeder.stopped)
+        leecher = self.make_peer(2)
+        leecher.announce('started')
+        seeder.reannounce()
+        self.assertFalse(seeder.stopped)
+        server.tracker.announce(2, 'localhost', leecher.port_number, left=0, event='completed')
+        seeder.reannounce()
+        self.assertTrue(seeder.stopped)
+
+    def test_reannounces_follow_tracker_interval(self):
+        server = tracker.start_tracker('localhost', 0, interval=7)
+        self.addCleanup(server.shutdown)
+        keep_config(self, 'TRACKER_URL')
+        P2P_init.TRACKER_URL = 'http://localhost:%d/announce' % server.server_address[1]
+        peer = self.make_peer(2)
+        self.addCleanup(peer.scheduler.stop)
+        peer.announce('started')
+        peer.start_announcing()
+        self.assertEqual(peer.announce_call.interval, 7)
+        server.tracker.interval = 12
+        peer.announce()
+        self.assertEqual(peer.announce_call.interval, 12)
+
+    def test_duplicate_connection_keeps_lower_id_dial(self):
+        peer = self.make_peer(3)
+        inbound, outbound = FakeSocket(), FakeSocket()
+        # peer 2 dialed us and we dialed peer 2: keep the one peer 2 made
+        self.assertTrue(peer._register_neighbor(2, outbound, outbound=True))
+        self.assertTrue(peer._register_neighbor(2, inbound, outbound=False))
+        self.assertIs(peer.connections[2].socket, inbound)
+        self.assertFalse(peer._register_neighbor(2, FakeSocket(), outbound=True))
+
+    def test_replaced_connection_is_torn_down(self):
+        peer = self.make_peer(2)
+        inbound, outbound = FakeSocket(), FakeSocket()
+        self.assertTrue(peer._register_neighbor(4, inbound, outbound=False))
+        peer.process_message(peerProcess.BITFIELD, b'\xff', 4, inbound)
+        peer.in_flight.claim(3, 4, 0.0)
+        # we dialed 4 as well, and the lower id's dial wins
+        self.assertTrue(peer._register_neighbor(4, outbound, outbound=True))
+        self.assertEqual(peer.availability, [0] * self.NUM_PIECES)
+        self.assertNotIn(3, peer.in_flight)
+        peer.process_message(peerProcess.BITFIELD, b'\xff', 4, outbound)
+        self.assertEqual(peer.availability, [1] * self.NUM_PIECES)
+        # the old connection's reader thread ends after ours replaced it
+        peer._remove_neighbor(4, inbound)
+        peer._remove_neighbor(4, outbound)
+        self.assertEqual(peer.availability, [0] * self.NUM_PIECES)
+        self.assertEqual(peer.in_flight.pending(4), [])
+
+    def test_max_connections_caps_dialing(self):
+        keep_config(self, 'MAX_CONNECTIONS')
+        P2P_init.MAX_CONNECTIONS = 2
+        peer = self.make_peer(3)
+        self.add_neighbor(peer, 1)
+        # one slot stays open for peers that dial us
+        self.assertTrue(peer._at_connection_cap(dialing=True))
+        self.assertFalse(peer._at_connection_cap())
+        dialed = []
+        peer._dial = lambda *args: dialed.append(args)
+        peer._connect_to_tracker_peers({'peers': [{'peer_id': 4, 'host': 'localhost', 'port': 1}]})
+        self.assertEqual(dialed, [])
+
+class TestPeerExchange(PeerTestCase):
+    def test_pex_round_trip(self):
+        added = [(7, 'host-a', 6007, peerProcess.PEX_FLAG_SEED), (8, 'localhost', 6008, 0)]
+        msg = peerProcess.create_pex(added, [9, 10])
+        mtype, payload = peerProcess.parse_message(msg)
+        self.assertEqual(mtype, peerProcess.PEX)
+        self.assertEqual(peerProcess.parse_pex(payload), (added, [9, 10]))
+
+    def test_receiving_pex_learns_addresses_and_seeds(self):
+        peer = self.make_peer(2)
+        sock = self.add_neighbor(peer, 3)
+        payload = peerProcess.create_pex([(42, 'far-host', 6042, peerProcess.PEX_FLAG_SEED),
+                                          (2, 'localhost', 7002, 0)], [])[5:]
+        peer.process_message(peerProcess.PEX, payload, 3, sock)
+        self.assertEqual(peer.known_peers[42], ('far-host', 6042))
+        self.assertIn(42, peer.finished_peers)
+        # we dial it, but don't wait for it before stopping
+        self.assertNotIn(42, peer.total_peers)
+        self.assertNotIn(2, peer.known_peers)
+
+    def test_send_pex_only_sends_changes(self):
+        peer = self.make_peer(2)
+        sock3 = self.add_neighbor(peer, 3)
+        sock4 = self.add_neighbor(peer, 4)
+        peer.send_pex()
+        added, dropped = peerProcess.parse_pex(sock3.frames()[0][1])
+        # seeder 1 is listed as finished although it is not our neighbor
+        self.assertEqual(sorted(e[0] for e in added), [1, 2, 4])
+        peer.send_pex()
+        self.assertEqual(len(sock3.sent), 1)
+        del peer.connections[4]
+        peer.send_pex()
+        added, dropped = peerProcess.parse_pex(sock3.frames()[1][1])
+        self.assertEqual((added, dropped), ([], [4]))
+
+    def test_completion_reaches_peers_that_are_not_connected(self):
+        # 1 - 2 - 3 - 4: each peer only talks to the ones next to it
+        keep_config(self, 'PEX_INTERVAL')
+        P2P_init.PEX_INTERVAL = 1
+        P2P_init.peer_info.clear()
+        for pid in range(1, 5):
+            P2P_init.peer_info[pid] = ('localhost', 7000 + pid, pid == 1)
+        peers = {pid: self.make_peer(pid) for pid in range(1, 5)}
+        inbox = []
+
+        class Link(FakeSocket):
+            def __init__(self, src, dst):
+                super().__init__()
+                self.src, self.dst = src, dst
+
+            def sendall(self, data):
+                inbox.append((self, bytes(data)))
+
+        links = {}
+        for a, b in ((1, 2), (2, 3), (3, 4)):
+            links[a, b], links[b, a] = Link(a, b), Link(b, a)
+            peers[a].connections[b] = peers[a]._new_neighbor_state(links[a, b])
+            peers[b].connections[a] = peers[b]._new_neighbor_state(links[b, a])
+
+        def deliver():
+            while inbox:
+                link, data = inbox.pop(0)
+                peer = peers[link.dst]
+                if not peer.stopped:
+                    mtype, payload = peerProcess.parse_message(data)
+                    peer.process_message(mtype, payload, link.src, links[link.dst, link.src])
+
+        def finish(pid):
+            peers[pid].bitfield = peerProcess.Bitfield(self.NUM_PIECES, True)
+            peers[pid]._check_download_complete()
+            deliver()
+
+        for pid in (2, 3):
+            finish(pid)
+        for peer in peers.values():
+            peer.send_pex()
+        deliver()
+        self.assertFalse(any(peer.stopped for peer in peers.values()))
+        # 4 finishing last only reaches 3 directly; 3 passes it on before stopping
+        finish(4)
+        self.assertEqual([pid for pid, peer in peers.items() if not peer.stopped], [])
+
+    def test_prunes_slowest_when_over_budget(self):
+        keep_config(self, 'MAX_CONNECTIONS')
+        P2P_init.MAX_CONNECTIONS = 2
+        peer = self.make_peer(2)
+        closed = []
+        for pid, rate in ((1, 500.0), (3, 10.0), (4, 100.0)):
+            sock = self.add_neighbor(peer, pid)
+            sock.close = lambda pid=pid: closed.append(pid)
+            peer.connections[pid].throughput = rate
+        peer.maintain_neighbors()
+        self.assertEqual(closed, [3])
+
+class TestSuperSeeding(PeerTestCase):
+    def setUp(self):
+        super().setUp()
+        P2P_init.SUPER_SEEDING = True
+        self.addCleanup(setattr, P2P_init, 'SUPER_SEEDING', False)
+
+    def test_seeder_reveals_one_piece_and_serves_only_that(self):
+        seeder = self.make_peer(1)
+        sock = self.add_neighbor(seeder, 3)
+        seeder._send_initial_messages(3, sock)
+        frames = sock.frames()
+        self.assertEqual(frames[0], (peerProcess.BITFIELD, bytes(1)))
+        self.assertEqual(frames[1][0], peerProcess.HAVE)
+        revealed = struct.unpack('>I', frames[1][1])[0]
+        hidden = (revealed + 1) % self.NUM_PIECES
+        sent = len(sock.sent)
+        seeder.process_message(peerProcess.REQUEST, struct.pack('>I', hidden), 3, sock)
+        self.assertEqual(len(sock.sent), sent)
+
+    def test_next_piece_revealed_after_it_propagates(self):
+        seeder = self.make_peer(1)
+        sock3 = self.add_neighbor(seeder, 3)
+        sock4 = self.add_neighbor(seeder, 4)
+        seeder._send_initial_messages(3, sock3)
+        seeder._send_initial_messages(4, sock4)
+        first = seeder.super_seed_offers[3]
+        self.assertNotEqual(first, seeder.super_seed_offers[4])
+        # 3 downloads its piece: nothing new yet, 4 could still want it
+        seeder.process_message(peerProcess.HAVE, struct.pack('>I', first), 3, sock3)
+        self.assertEqual(seeder.super_seed_offers[3], first)
+        # the piece shows up at 4, so 3 passed it on
+        seeder.process_message(peerProcess.HAVE, struct.pack('>I', first), 4, sock4)
+        self.assertNotEqual(seeder.super_seed_offers[3], first)
+
+    def test_super_seeding_uploads_less_before_first_copy(self):
+        uploads = {}
+        keep_sim_config(self)
+        for mode in (False, True):
+            swarm_sim.configure(num_pieces=32, piece_size=4096, super_seeding=mode)
+            sim = swarm_sim.SwarmSimulator(40, degree=8, bandwidth=200_000,
+                                           upload_bandwidth=200_000, seed=3)
+            sim.build()
+            result = sim.run(max_time=900)
+            self.assertEqual(result['completed'], 39)
+            uploads[mode] = result['seeder_upload_first_copy']
+        self.assertLess(uploads[True], uploads[False])
+
+class TestStreamingMode(PeerTestCase):
+    def setUp(self):
+        super().setUp()
+        P2P_init.STREAMING_WINDOW = 3
+        self.addCleanup(setattr, P2P_init, 'STREAMING_WINDOW', 0)
+
+    def requested(self, sock):
+        return [struct.unpack('>I', p)[0] for t, p in sock.frames() if t == peerProcess.REQUEST]
+
+    def test_window_pieces_requested_in_order(self):
+        peer = self.make_peer()
+        peer.read_cursor = 2
+        socks = [self.add_neighbor(peer, pid, pieces=range(self.NUM_PIECES)) for pid in (3, 4, 5)]
+        for pid, sock in zip((3, 4, 5), socks):
+            peer.send_request(pid, sock)
+        self.assertEqual([self.requested(s) for s in socks], [[2], [3], [4]])
+
+    def test_at_risk_piece_requested_twice(self):
+        peer = self.make_peer()
+        now = [0.0]
+        peer.clock = lambda: now[0]
+        sock3 = self.add_neighbor(peer, 3, pieces=[0])
+        sock4 = self.add_neighbor(peer, 4, pieces=[0])
+        peer.send_request(3, sock3)
+        self.assertEqual(self.requested(sock3), [0])
+        # neighbor 3 is known to take 10s per piece, the reader needs it in 2s
+        peer.connections[3].srtt = 10.0
+        peer.connections[4].peer_choking_me = False
+        peer.expire_requests()
+        self.assertEqual(self.requested(sock4), [0])
+        self.assertFalse(peer._is_idle(4, peer.connections[4]))
+
+    def test_reader_blocks_until_pieces_land(self):
+        peer = self.make_peer()
+        content = bytes(range(256)) * 2
+        reader = peer.open_stream()
+        got = []
+        t = threading.Thread(target=lambda: got.append(reader.read(3 * self.PIECE_SIZE, timeout=5)))
+        t.start()
+        for i in (1, 0, 2):
+            peer.save_piece(i, content[i * self.PIECE_SIZE:(i + 1) * self.PIECE_SIZE], 1)
+        t.join(5)
+        self.assertEqual(got, [content[:3 * self.PIECE_SIZE]])
+        self.assertEqual(reader.read(10, timeout=0.05), b'')
+
+class TestPartialDownload(PeerTestCase):
+    PIECE_SIZE = 16384   # big enough for file system blocks to show the holes
+
+    def test_parse_range(self):
+        self.assertEqual(peerProcess.parse_range('0-99:high'), (0, 100, peerProcess.PRIORITY_HIGH))
+        self.assertEqual(peerProcess.parse_range('100-'), (100, P2P_init.FILE_SIZE, peerProcess.PRIORITY_NORMAL))
+        self.assertRaises(ValueError, peerProcess.parse_range, '5-1')
+        self.assertRaises(ValueError, peerProcess.parse_range, '0-9:urgent')
+
+    def test_only_wanted_pieces_requested_high_first(self):
+        peer = self.make_peer()
+        # a range straddling pieces 1 and 2; piece 6 is high priority
+        peer.want_ranges([(self.PIECE_SIZE + 10, 2 * self.PIECE_SIZE + 10, peerProcess.PRIORITY_NORMAL),
+                          (6 * self.PIECE_SIZE, 6 * self.PIECE_SIZE + 1, peerProcess.PRIORITY_HIGH)])
+        self.assertEqual(peer.num_wanted(), 3)
+        self.assertEqual(peer.bytes_left(), 3 * self.PIECE_SIZE)
+        sock = self.add_neighbor(peer, 3, pieces=range(self.NUM_PIECES))
+        peer.connections[3].peer_choking_me = False
+        for _ in range(4):
+            peer.send_request(3, sock)
+        requested = [struct.unpack('>I', p)[0] for t, p in sock.frames() if t == peerProcess.REQUEST]
+        self.assertEqual(requested[0], 6)
+        self.assertEqual(sorted(requested), [1, 2, 6])
+
+    def test_done_once_wanted_pieces_arrive(self):
+        peer = self.make_peer()
+        peer.want_ranges([(0, self.PIECE_SIZE, peerProcess.PRIORITY_NORMAL)])
+        sock = self.add_neighbor(peer, 3, pieces=[5])
+        peer.process_message(peerProcess.BITFIELD, peer.connections[3].bitfield.to_bytes(), 3, sock)
+        self.assertEqual(sock.frames()[-1][0], peerProcess.NOT_INTERESTED)
+        peer.save_piece(0, bytes(self.PIECE_SIZE), 1)
+        self.assertTrue(peer.done_broadcast_sent)
+        self.assertFalse(peer.bitfield.is_complete())
+        self.assertIn((peerProcess.DONE, b''), sock.frames())
+        # the rest of the file stays a hole
+        self.assertLess(os.stat(peer.file_path).st_blocks * 512, P2P_init.FILE_SIZE)
+
+class TestDiskIO(PeerTestCase):
+    def setUp(self):
+        super().setUp()
+        P2P_init.DISK_IO_THREADS = 1
+        self.addCleanup(setattr, P2P_init, 'DISK_IO_THREADS', 0)
+
+    def make_peer(self, peer_id=2):
+        # Hold every write until self.gate is set, recording (piece, length)
+        peer = super().make_peer(peer_id)
+        self.addCleanup(peer.disk.close)
+        self.gate = threading.Event()
+        self.writes = []
+        write = peer._write_piece
+
+        def gated_write(piece_index, data):
+            self.gate.wait(5)
+            self.writes.append((piece_index, len(data)))
+            write(piece_index, data)
+        peer._write_piece = gated_write
+        return peer
+
+    def test_have_only_after_write_and_adjacent_pieces_merged(self):
+        peer = self.make_peer()
+        sock = self.add_neighbor(peer, 3)
+        data = bytes(self.PIECE_SIZE)
+        for i in (0, 3, 4, 5):
+            peer.save_piece(i, data, 1)
+        self.assertFalse(peer.bitfield.has_piece(0))
+        self.assertEqual(sock.frames(), [])
+        self.assertIn(4, peer.disk)
+        # a second copy of a piece still being written is a duplicate
+        peer.save_piece(4, data, 3)
+        self.assertEqual(peer.in_flight.duplicate_pieces, 1)
+        self.gate.set()
+        self.assertTrue(peer.disk.flush(5))
+        self.assertEqual(self.writes, [(0, self.PIECE_SIZE), (3, 3 * self.PIECE_SIZE)])
+        haves = sorted(struct.unpack('>I', p)[0] for t, p in sock.frames() if t == peerProcess.HAVE)
+        self.assertEqual(haves, [0, 3, 4, 5])
+
+    def test_full_queue_blocks_the_caller(self):
+        peer = self.make_peer()
+        peer.disk = peerProcess.DiskIO(peer, threads=1, max_queued=1)
+        self.addCleanup(peer.disk.close)
+        data = bytes(self.PIECE_SIZE)
+        peer.save_piece(0, data, 1)
+        t = threading.Thread(target=peer.save_piece, args=(1, data, 1))
+        t.start()
+        t.join(0.2)
+        self.assertTrue(t.is_alive())
+        self.gate.set()
+        t.join(5)
+        self.assertTrue(peer.disk.flush(5))
+        self.assertTrue(peer.bitfield.has_piece(1))
+
+    def test_request_served_from_worker(self):
+        os.makedirs('peer_1')
+        with open(os.path.join('peer_1', 'thefile'), 'wb') as f:
+            f.write(bytes(P2P_init.FILE_SIZE))
+        peer = self.make_peer(1)
+        sock = self.add_neighbor(peer, 3)
+        peer.process_message(peerProcess.REQUEST, struct.pack('>I', 2), 3, sock)
+        deadline = time.time() + 5
+        while not sock.sent and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(sock.frames()[0][0], peerProcess.PIECE)
+        self.assertEqual(peer.connections[3].uploaded_bytes, self.PIECE_SIZE)
+
+class TestScheduler(PeerTestCase):
+    def test_jobs_run_in_time_order_and_repeat(self):
+        now = [0.0]
+        sched = peerProcess.Scheduler(clock=lambda: now[0], threaded=False)
+        ran = []
+        sched.call_every(2, ran.append, 'every2')
+        sched.call_later(1, ran.append, 'once')
+        cancelled = sched.call_later(1.5, ran.append, 'cancelled')
+        sched.cancel(cancelled)
+        for t in (1, 2, 3, 4):
+            now[0] = t
+            sched.run_pending()
+        self.assertEqual(ran, ['once', 'every2', 'every2'])
+
+    def test_failing_job_keeps_its_schedule(self):
+        now = [0.0]
+        errors = []
+        sched = peerProcess.Scheduler(clock=lambda: now[0], threaded=False,
+                                      on_error=lambda call, e: errors.append(e))
+        sched.call_every(1, lambda: 1 / 0)
+        for t in (1, 2):
+            now[0] = t
+            sched.run_pending()
+        self.assertEqual(len(errors), 2)
+
+    def test_stop_wakes_the_peer_at_once(self):
+        peer = self.make_peer()
+        peer.scheduler.call_every(60, peer.update_preferred_neighbors)
+        thread = peer.scheduler.thread
+        start = time.monotonic()
+        threading.Timer(0.05, peer.stop).start()
+        self.assertTrue(peer.stop_event.wait(5))
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertLess(time.monotonic() - start, 2)
+
+    def test_seeder_says_done_to_new_neighbors(self):
+        seeder = self.make_peer(1)
+        sock = self.add_neighbor(seeder, 3)
+        seeder._send_initial_messages(3, sock)
+        self.assertEqual([t for t, _ in sock.frames()], [peerProcess.BITFIELD, peerProcess.DONE])
+
+class TestKeepAlive(PeerTestCase):
+    def test_keep_alive_is_an_empty_frame(self):
+        peer = self.make_peer()
+        sock = self.add_neighbor(peer, 3)
+        peer.send_keep_alives()
+        self.assertEqual(sock.frames(), [(peerProcess.KEEP_ALIVE, b'')])
+
+    def test_silent_neighbor_reaped_and_cleaned_up(self):
+        peer = self.make_peer()
+        now = [0.0]
+        peer.clock = lambda: now[0]
+        sock3 = self.add_neighbor(peer, 3)
+        sock4 = self.add_neighbor(peer, 4)
+        bits = peerProcess.Bitfield(self.NUM_PIECES)
+        bits.set_piece(0)
+        bits.set_piece(1)
+        peer.process_message(peerProcess.BITFIELD, bits.to_bytes(), 3, sock3)
+        peer.connections[3].peer_choking_me = False
+        peer.send_request(3, sock3)
+        peer.preferred_neighbors = {3}
+        peer.optimistic_neighbor = 3
+        # 4 only sends keep-alives, which is enough
+        now[0] = P2P_init.IDLE_TIMEOUT - 10
+        peer.process_message(peerProcess.KEEP_ALIVE, b'', 4, sock4)
+        now[0] = P2P_init.IDLE_TIMEOUT + 1
+        peer.reap_idle_neighbors()
+        self.assertEqual(list(peer.connections), [4])
+        self.assertTrue(sock3.was_shut_down)
+        self.assertEqual(peer.availability[:2], [0, 0])
+        self.assertEqual(len(peer.in_flight), 0)
+        self.assertNotIn(3, peer.preferred_neighbors)
+        self.assertNotEqual(peer.optimistic_neighbor, 3)
+
+class TestUdpTransport(unittest.TestCase):
+    def transfer(self, data, close_endpoint=False, **impairment):
+        """Send data over a loopback UDP connection, return what the other side read."""
+        a = udp_transport.UdpEndpoint('127.0.0.1', 0, seed=1, **impairment)
+        b = udp_transport.UdpEndpoint('127.0.0.1', 0, seed=2, **impairment)
+        self.addCleanup(a.close)
+        self.addCleanup(b.close)
+        got = bytearray()
+
+        def serve():
+            conn, _ = b.accept()
+            while True:
+                chunk = conn.recv(65536)
+                if not chunk:
+                    return
+                got.extend(chunk)
+        t = threading.Thread(target=serve, daemon=True)
+        t.start()
+        conn = a.connect(b.getsockname())
+        conn.sendall(data)
+        conn.close()
+        if close_endpoint:
+            # As Peer.stop does: closing the endpoint resets its connections
+            self.assertTrue(conn.wait_closed(10))
+            a.close()
+        t.join(30)
+        return bytes(got)
+
+    def test_stream_arrives_in_order(self):
+        data = os.urandom(300_000)
+        self.assertEqual(self.transfer(data), data)
+
+    def test_stream_survives_loss_and_delay(self):
+        data = os.urandom(40_000)
+        self.assertEqual(self.transfer(data, loss=0.05, delay=0.02), data)
+
+    def test_closed_connection_delivers_before_endpoint_closes(self):
+        data = os.urandom(40_000)
+        self.assertEqual(self.transfer(data, close_endpoint=True, delay=0.02), data)
+
+    def test_ledbat_backs_off_as_queuing_delay_grows(self):
+        ledbat = udp_transport.Ledbat(clock=lambda: 0.0)
+        for _ in range(50):
+            ledbat.on_ack(udp_transport.MSS, delay=0.010)
+        grown = ledbat.cwnd
+        self.assertGreater(grown, udp_transport.MIN_CWND)
+        # same base delay, but now 150 ms of it is queuing: over TARGET
+        for _ in range(10):
+            ledbat.on_ack(udp_transport.MSS, delay=0.160)
+        self.assertLess(ledbat.cwnd, grown)
+
+    def test_connect_to_nobody_times_out(self):
+        a = udp_transport.UdpEndpoint('127.0.0.1', 0)
+        self.addCleanup(a.close)
+        silent = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        silent.bind(('127.0.0.1', 0))
+        self.addCleanup(silent.close)
+        self.assertRaises(TimeoutError, a.connect, silent.getsockname(), timeout=0.3)
+
+class TestInstrumentation(PeerTestCase):
+    def test_histogram_percentiles(self):
+        h = instrumentation.Histogram()
+        for _ in range(99):
+            h.record(0.000_010)
+        h.record(0.5)
+        self.assertEqual(h.count, 100)
+        self.assertLessEqual(h.percentile(0.5), 0.000_016)
+        self.assertEqual(h.max, 0.5)
+
+    def test_messages_and_storage_are_timed(self):
+        peer = self.make_peer()
+        sock = self.add_neighbor(peer, 3)
+        peer.process_message(peerProcess.HAVE, struct.pack('>I', 1), 3, sock)
+        peer.process_message(peerProcess.KEEP_ALIVE, b'', 3, sock)
+        peer.save_piece(1, bytes(self.PIECE_SIZE), 3)
+        peer.update_preferred_neighbors()
+        for name in ('msg.HAVE', 'msg.KEEP_ALIVE', 'disk.write', 'choke.preferred'):
+            self.assertEqual(peer.metrics.histograms[name].count, 1, name)
+        peer.flush_metrics()
+        with open('metrics_peer_2.log') as f:
+            self.assertIn('msg.HAVE', f.read())
+
+    def test_profiler_merges_threads(self):
+        profiler = instrumentation.ThreadProfiler()
+        profiler.start()
+
+        def busy_thread():
+            profiler.checkpoint()
+            sorted(range(10000), key=lambda x: -x)
+            time.sleep(0.1)
+            profiler.checkpoint()
+        t = threading.Thread(target=busy_thread)
+        t.start()
+        time.sleep(0.05)
+        included, late = profiler.stop('out.prof', wait=5)
+        t.join()
+        self.assertEqual((included, late), (1, 0))
+        functions = [f[2] for f in pstats.Stats('out.prof').stats]
+        self.assertIn('<lambda>', functions)
+
+    def test_tracemalloc_toggle_writes_snapshot(self):
+        self.assertIsNone(instrumentation.toggle_tracemalloc('mem'))
+        junk = [bytes(1000) for _ in range(100)]
+        self.assertEqual(instrumentation.toggle_tracemalloc('mem'), 'mem.txt')
+        self.assertTrue(os.path.exists('mem.snapshot'))
+        self.assertTrue(junk)
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """Serves server.content with single-range support over keep-alive HTTP/1.1."""
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def do_GET(self):
+        content = self.server.content
+        if self.server.fail:
+            self.send_error(503)
+            return
+        start, end = (int(x) for x in self.headers['Range'].split('=')[1].split('-'))
+        body = content[start:end + 1]
+        self.send_response(206)
+        self.send_header('Content-Range', f"bytes {start}-{end}/{len(content)}")
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestWebSeed(PeerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.content = os.urandom(self.NUM_PIECES * self.PIECE_SIZE)
+        self.server = ThreadingHTTPServer(('localhost', 0), RangeHandler)
+        self.server.content = self.content
+        self.server.connections = 0
+        self.server.fail = False
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        P2P_init.WEB_SEED_URL = f"http://localhost:{self.server.server_address[1]}/thefile"
+        self.addCleanup(setattr, P2P_init, 'WEB_SEED_URL', '')
+        self.addCleanup(setattr, P2P_init, 'UNCHOKING_INTERVAL', P2P_init.UNCHOKING_INTERVAL)
+        P2P_init.UNCHOKING_INTERVAL = 0
+
+    def test_downloads_everything_over_one_connection(self):
+        peer = self.make_peer()
+        self.addCleanup(peer.stop)
+        peer.start_web_seed()
+        deadline = time.monotonic() + 5
+        while not peer.bitfield.is_complete() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        with open(peer.file_path, 'rb') as f:
+            self.assertEqual(f.read(), self.content)
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(peer.web_seed.fetched_bytes, len(self.content))
+        self.assertIsNotNone(peer.connections[peerProcess.WEB_SEED_ID].srtt)
+
+    def test_only_pieces_peers_cannot_serve(self):
+        peer = self.make_peer()
+        self.add_neighbor(peer, 3, pieces=range(4))
+        self.add_neighbor(peer, 4, pieces=range(4, 8))
+        peer.connections[3].peer_choking_me = False
+        # 4 is choking us; piece 1 missed its deadline at 3
+        peer.connections[3].overdue.add(1)
+        peer.availability[5] = 2
+        missing = peer._wanted_missing(peerProcess.Bitfield(self.NUM_PIECES, True))
+        self.assertEqual(peer._web_seed_pieces(missing), [1, 4, 6, 7, 5])
+
+    def test_http_error_chokes_web_seed(self):
+        self.server.fail = True
+        peer = self.make_peer()
+        self.addCleanup(peer.stop)
+        failed = threading.Event()
+        log = peer.log
+        peer.log = lambda msg: (log(msg), 'failed on piece' in msg and failed.set())
+        peer.start_web_seed()
+        self.assertTrue(failed.wait(5))
+        time.sleep(0.05)
+        self.assertTrue(peer.connections[peerProcess.WEB_SEED_ID].peer_choking_me)
+        self.assertEqual(len(peer.in_flight), 0)
+
+class TestDeltaSync(PeerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.new = os.urandom(self.NUM_PIECES * self.PIECE_SIZE)
+        ps = self.PIECE_SIZE
+        # Yesterday's copy: 5 bytes inserted up front and piece 3 different
+        self.old = os.urandom(5) + self.new[:3 * ps] + os.urandom(ps) + self.new[4 * ps:]
+        os.makedirs('peer_1')
+        with open('peer_1/thefile', 'wb') as f:
+            f.write(self.new)
+        os.makedirs('peer_2')
+        with open('peer_2/thefile', 'wb') as f:
+            f.write(self.old)
+        P2P_init.DELTA_MANIFEST = 'thefile.manifest'
+        self.addCleanup(setattr, P2P_init, 'DELTA_MANIFEST', '')
+
+    def test_finds_shifted_pieces(self):
+        manifest = delta_sync.build_manifest('peer_1/thefile', self.PIECE_SIZE)
+        for workers in (1, 2):
+            matches = delta_sync.find_matches('peer_2/thefile', manifest, workers)
+            self.assertEqual(sorted(matches), [0, 1, 2, 4, 5, 6, 7])
+            self.assertEqual(matches[4], 5 + 4 * self.PIECE_SIZE)
+
+    def test_leecher_starts_with_reused_pieces(self):
+        self.make_peer(1)
+        self.assertTrue(os.path.exists('thefile.manifest'))
+        peer = self.make_peer(2)
+        self.assertEqual([i for i in range(self.NUM_PIECES) if not peer.bitfield.has_piece(i)], [3])
+        with open('peer_2/thefile', 'rb') as f:
+            data = f.read()
+        ps = self.PIECE_SIZE
+        self.assertEqual(len(data), len(self.new))
+        self.assertEqual(data[4 * ps:], self.new[4 * ps:])
+        self.assertEqual(peer.bytes_left(), ps)
+
+class TestFrameTrace(PeerTestCase):
+    def test_sent_and_received_frames_are_recorded(self):
+        recorder = frame_trace.TraceRecorder('trace.bin', 2, self.NUM_PIECES)
+        sock = frame_trace.TracedSocket(FakeSocket(), recorder, 3)
+        sock.sendall(peerProcess.create_request(5) + peerProcess.create_interested())
+        recorder.record(frame_trace.RECV, 3, peerProcess.PIECE, struct.pack('>I', 5) + bytes(60))
+        recorder.close()
+        self.assertEqual(len(sock.sent), 1)
+        trace = frame_trace.load_trace('trace.bin')
+        self.assertEqual(trace.peer_id, 2)
+        self.assertEqual([r[1:] for r in trace.records], [
+            (frame_trace.SEND, 3, peerProcess.REQUEST, 5, 4),
+            (frame_trace.SEND, 3, peerProcess.INTERESTED, frame_trace.NO_PIECE, 0),
+            (frame_trace.RECV, 3, peerProcess.PIECE, 5, 64),
+        ])
+
+    def test_analyzer_merges_swarm(self):
+        S, R, PIECE, REQ = frame_trace.SEND, frame_trace.RECV, peerProcess.PIECE, peerProcess.REQUEST
+        # 1 seeds piece 0; 2 gets it from 1, then 3 gets it from 2
+        seed = frame_trace.Trace(1, 1, [(0.0, R, 2, REQ, 0, 4), (0.0, S, 2, PIECE, 0, 64)])
+        mid = frame_trace.Trace(2, 1, [(0.0, S, 1, REQ, 0, 4), (0.5, R, 1, PIECE, 0, 64),
+                                       (1.0, R, 3, REQ, 0, 4), (1.0, S, 3, PIECE, 0, 64)])
+        leaf = frame_trace.Trace(3, 1, [(1.0, S, 2, REQ, 0, 4), (1.25, R, 2, PIECE, 0, 64),
+                                        (1.25, S, 2, peerProcess.DONE, -1, 0)])
+        traces = [seed, mid, leaf]
+        tree = frame_trace.propagation(traces)[0]
+        self.assertEqual({peer: parent for peer, (parent, _) in tree.items()}, {2: 1, 3: 2})
+        self.assertEqual(frame_trace.tree_depths(tree), {2: 1, 3: 2})
+        self.assertEqual(sorted(s for *_, s in frame_trace.request_latencies(traces)), [0.25, 0.5])
+        self.assertEqual(frame_trace.completion(traces)[3]['done'], 1.25)
+        self.assertIn('3 peers', frame_trace.report(traces))
+
+    def test_idle_link_time(self):
+        S, R = frame_trace.SEND, frame_trace.RECV
+        trace = frame_trace.Trace(2, 2, [
+            (0.0, S, 1, peerProcess.REQUEST, 0, 4), (1.0, R, 1, peerProcess.PIECE, 0, 64),
+            (3.0, S, 1, peerProcess.REQUEST, 1, 4), (4.0, R, 1, peerProcess.PIECE, 1, 64)])
+        self.assertEqual(frame_trace.idle_links([trace]), {(2, 1): (4.0, 2.0)})
+
+    def test_peer_traces_its_connections(self):
+        keep_config(self, 'TRACE_FRAMES')
+        P2P_init.TRACE_FRAMES = True
+        peer = self.make_peer()
+        sock = peer._traced(FakeSocket(), 3)
+        peer.connections[3] = peer._new_neighbor_state(sock)
+        peer._send_initial_messages(3, sock)
+        peer.stop()
+        peer.trace.close()
+        types = [r[3] for r in frame_trace.load_trace('trace_peer_2.bin').records]
+        self.assertEqual(types, [peerProcess.BITFIELD])
+
+class SlowSocket(FakeSocket):
+    """Writes a few bytes at a time, yielding in between, like a busy TCP socket."""
+    def __init__(self):
+        super().__init__()
+        self.stream = bytearray()
+
+    def sendall(self, data):
+        for i in range(0, len(data), 3):
+            self.stream += data[i:i + 3]
+            time.sleep(0)
+
+    def frames(self):
+        out, pos = [], 0
+        while pos < len(self.stream):
+            length, message_type = struct.unpack('>IB', self.stream[pos:pos + 5])
+            out.append((message_type, bytes(self.stream[pos + 5:pos + 5 + length])))
+            pos += 5 + length
+        return out
+
+
+class TestConcurrency(PeerTestCase):
+    NUM_PIECES = 64
+    NEIGHBORS = 16
+
+    def setUp(self):
+        super().setUp()
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-5)   # switch threads as often as possible
+        self.addCleanup(sys.setswitchinterval, interval)
+
+    def test_piece_locks_cover_every_piece_once(self):
+        locks = peerProcess.PieceLocks(self.NUM_PIECES)
+        covered = [i for _, pieces in locks.ranges(self.NUM_PIECES) for i in pieces]
+        self.assertEqual(covered, list(range(self.NUM_PIECES)))
+        self.assertIs(locks(0), locks(1))
+        self.assertIsNot(locks(0), locks(self.NUM_PIECES - 1))
+
+    def test_frames_racing_removal_do_not_count(self):
+        peer = self.make_peer()
+        sock = self.add_neighbor(peer, 3)
+        peer.process_message(peerProcess.BITFIELD, bytes([0x80]), 3, sock)
+        self.assertEqual(peer.availability[0], 1)
+        state = peer.connections[3]
+        # The reader thread looked the neighbor up just before the reaper dropped it
+        peer._remove_neighbor(3, sock)
+        peer._apply_have(state, 5)
+        peer._apply_bitfield(state, peerProcess.Bitfield(self.NUM_PIECES, True))
+        self.assertEqual(peer.availability, [0] * self.NUM_PIECES)
+
+    def test_many_neighbors_at_once(self):
+        peer = self.make_peer()
+        socks = {}
+        for pid in range(100, 100 + self.NEIGHBORS):
+            socks[pid] = SlowSocket()
+            peer.connections[pid] = peer._new_neighbor_state(socks[pid])
+        dropped = set(range(100, 100 + self.NEIGHBORS, 4))
+        redials = {pid: SlowSocket() for pid in range(102, 100 + self.NEIGHBORS, 4)}
+        data = bytes(self.PIECE_SIZE)
+        errors = []
+
+        def neighbor(pid):
+            rng = random.Random(pid)
+            sock = socks[pid]
+            try:
+                bits = peerProcess.Bitfield(self.NUM_PIECES)
+                for i in rng.sample(range(self.NUM_PIECES), 8):
+                    bits.set_piece(i)
+                peer.process_message(peerProcess.BITFIELD, bits.to_bytes(), pid, sock)
+                peer.process_message(peerProcess.INTERESTED, b'', pid, sock)
+                for i in rng.sample(range(self.NUM_PIECES), 40):
+                    peer.process_message(peerProcess.HAVE, struct.pack('>I', i), pid, sock)
+                    # Every neighbor delivers every piece, so they all race in save_piece
+                    peer.process_message(peerProcess.PIECE, struct.pack('>I', i) + data, pid, sock)
+            except Exception as e:
+                errors.append(e)
+
+        def reaper():
+            # Drop neighbors while their frames are still being handled
+            for pid in sorted(dropped):
+                while not socks[pid].stream:
+                    time.sleep(0)
+                peer._remove_neighbor(pid, socks[pid])
+
+        def dialer():
+            # Our own dial completes while the connection the neighbor made
+            # is busy; ours wins, and the accepted one's frames stop counting
+            for pid in sorted(redials):
+                while not socks[pid].stream:
+                    time.sleep(0)
+                peer._register_neighbor(pid, redials[pid], outbound=True)
+                peer.process_message(peerProcess.BITFIELD, bytes([0x0f] * (self.NUM_PIECES // 8)),
+                                     pid, redials[pid])
+
+        def choker():
+            for _ in range(50):
+                peer.update_preferred_neighbors()
+                peer.update_optimistic_neighbor()
+
+        threads = [threading.Thread(target=neighbor, args=(pid,)) for pid in socks]
+        threads.append(threading.Thread(target=choker))
+        threads.append(threading.Thread(target=reaper))
+        threads.append(threading.Thread(target=dialer))
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(30)
+        self.assertEqual(errors, [])
+
+        remaining = dict(peer._neighbors())
+        self.assertEqual(set(remaining), set(socks) - dropped)
+        for pid, sock in redials.items():
+            self.assertIs(remaining[pid].socket, sock)
+        # Availability matches the bitfields of the neighbors still connected
+        for i in range(self.NUM_PIECES):
+            self.assertEqual(peer.availability[i],
+                             sum(state.bitfield.bits[i] for state in remaining.values()), i)
+        self.assertTrue(peer.preferred_neighbors <= set(remaining))
+        self.assertEqual(peer.pieces_saving, set())
+        for pid, sock in socks.items():
+            # Frames from different threads never interleave on the wire
+            frames = sock.frames()
+            if pid in redials:
+                frames += redials[pid].frames()
+            haves = [struct.unpack('>I', p)[0] for t, p in frames if t == peerProcess.HAVE]
+            self.assertEqual(len(haves), len(set(haves)), pid)
+            if pid not in dropped:
+                stored = [i for i in range(self.NUM_PIECES) if peer.bitfield.has_piece(i)]
+                self.assertEqual(sorted(haves), stored)
+                self.assertIn(peerProcess.DONE, [t for t, _ in frames])
+
+
+def _mark_in_child(shm_name, locks, num_pieces, pieces):
+    """Runs in a spawned process: mark pieces the way a worker would."""
+    shared = sharding.SharedPieceState(num_pieces, shm_name, locks)
+    for i in pieces:
+        with locks[0]:
+            shared.bits[i] = True
+            shared.availability[i] += 1
+    shared.close()
+
+
+class TestSharding(PeerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.shared = sharding.SharedPieceState(self.NUM_PIECES)
+        self.addCleanup(self.shared.close, True)
+
+    def make_worker(self, index=0, count=2):
+        self.master_end, child_end = multiprocessing.Pipe()
+        link = sharding.WorkerLink(index, count, self.shared.name, self.shared.locks, child_end)
+        # The master creates the file; workers only open it
+        os.makedirs('peer_2')
+        with open(os.path.join('peer_2', 'thefile'), 'wb') as f:
+            f.truncate(P2P_init.FILE_SIZE)
+        peer = peerProcess.Peer(2, link)
+        self.addCleanup(self.stop_worker, peer, link)
+        return peer, link
+
+    def stop_worker(self, peer, link):
+        # Runs before PeerTestCase leaves the scratch directory, so the
+        # worker logs its shutdown there. Closing our end makes its master
+        # reader thread exit too, instead of stopping the peer later.
+        peer.stop()
+        link.shared.close()
+        self.master_end.close()
+
+    def recv(self):
+        self.assertTrue(self.master_end.poll(5))
+        return self.master_end.recv()
+
+    def test_state_is_shared_between_processes(self):
+        proc = multiprocessing.get_context('spawn').Process(
+            target=_mark_in_child, args=(self.shared.name, self.shared.locks, self.NUM_PIECES, [1, 6]))
+        proc.start()
+        proc.join(30)
+        self.assertEqual(proc.exitcode, 0)
+        self.assertEqual([i for i in range(self.NUM_PIECES) if self.shared.bits[i]], [1, 6])
+        self.assertEqual(self.shared.availability[6], 1)
+
+    def test_worker_uses_shared_bitfield_and_relays_pieces(self):
+        peer, link = self.make_worker()
+        self.assertTrue(link.owns(4))
+        self.assertFalse(link.owns(3))
+        sock = self.add_neighbor(peer, 3)
+        peer.process_message(peerProcess.BITFIELD, bytes([0xc0]), 3, sock)
+        self.assertEqual(list(self.shared.availability[:3]), [1, 1, 0])
+        peer.save_piece(0, bytes(self.PIECE_SIZE), 3)
+        self.assertTrue(self.shared.bits[0])
+        self.assertEqual(self.recv(), ('have', 0))
+        link.start()
+        # A piece stored by another worker goes out as HAVE from this one
+        self.shared.bits[5] = True
+        self.master_end.send(('have', 5))
+        deadline = time.time() + 5
+        while (peerProcess.HAVE, struct.pack('>I', 5)) not in sock.frames() and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertIn((peerProcess.HAVE, struct.pack('>I', 5)), sock.frames())
+
+    def test_master_drives_choking(self):
+        peer, link = self.make_worker()
+        sock = self.add_neighbor(peer, 3)
+        peer.process_message(peerProcess.INTERESTED, b'', 3, sock)
+        link.start()
+        self.master_end.send(('report',))
+        self.assertEqual(self.recv(), ('stats', 0, [(3, True, True, 0)], 0))
+        self.master_end.send(('preferred', [3, 5]))
+        self.master_end.send(('report',))
+        self.assertEqual(self.recv(), ('stats', 0, [(3, True, False, 0)], 0))
+        self.assertEqual(peer.preferred_neighbors, {3})
+        self.assertEqual(sock.frames()[-1][0], peerProcess.UNCHOKE)
+        self.master_end.send(('done', 4))
+        self.master_end.send(('report',))
+        self.recv()
+        self.assertIn(4, peer.finished_peers)
+
+
+class TestLargeFiles(PeerTestCase):
+    # A little over 5 GiB of 1 MiB pieces: offsets past 4 GiB, sparse on disk
+    NUM_PIECES = 5 * 1024 + 1
+    PIECE_SIZE = 1024 * 1024
+    FAR_PIECE = 4 * 1024 + 7
+
+    def setUp(self):
+        super().setUp()
+        P2P_init.PIECE_CHUNK_SIZE = 64 * 1024
+        self.addCleanup(setattr, P2P_init, 'PIECE_CHUNK_SIZE', 0)
+        P2P_init.FILE_SIZE -= 1000   # short last piece
+        self.data = random.Random(44).randbytes(self.PIECE_SIZE)
+
+    def socket_pair(self):
+        a, b = socket.socketpair()
+        self.addCleanup(a.close)
+        self.addCleanup(b.close)
+        return a, b
+
+    def send_in_background(self, sock, data):
+        t = threading.Thread(target=sock.sendall, args=(data,))
+        t.start()
+        self.addCleanup(t.join, 5)
+
+    def test_piece_past_4gib_streamed_to_disk(self):
+        peer = self.make_peer(2)
+        self.assertTrue(peer._streams(self.PIECE_SIZE))
+        neighbor_sock = self.add_neighbor(peer, 3, pieces=[self.FAR_PIECE])
+        ours, theirs = self.socket_pair()
+        self.send_in_background(theirs, struct.pack('>I', self.FAR_PIECE) + self.data)
+        peer._receive_piece_streamed(ours, 3, self.PIECE_SIZE)
+        self.assertTrue(peer.bitfield.has_piece(self.FAR_PIECE))
+        with open(peer.file_path, 'rb') as f:
+            f.seek(self.FAR_PIECE * self.PIECE_SIZE)
+            self.assertEqual(f.read(self.PIECE_SIZE), self.data)
+        self.assertIn((peerProcess.HAVE, struct.pack('>I', self.FAR_PIECE)), neighbor_sock.frames())
+
+    def test_wrong_size_piece_is_read_and_dropped(self):
+        peer = self.make_peer(2)
+        self.add_neighbor(peer, 3)
+        ours, theirs = self.socket_pair()
+        # The short last piece sent at full size, then the next frame
+        last = self.NUM_PIECES - 1
+        self.send_in_background(theirs, struct.pack('>I', last) + self.data + b'next')
+        peer._receive_piece_streamed(ours, 3, self.PIECE_SIZE)
+        self.assertFalse(peer.bitfield.has_piece(last))
+        self.assertEqual(peer.recv_exact(ours, 4), b'next')
+
+    def test_piece_past_4gib_streamed_from_disk(self):
+        os.makedirs('peer_1')
+        with open(os.path.join('peer_1', 'thefile'), 'wb') as f:
+            f.truncate(P2P_init.FILE_SIZE)
+            f.seek(self.FAR_PIECE * self.PIECE_SIZE)
+            f.write(self.data)
+        peer = self.make_peer(1)
+        ours, theirs = self.socket_pair()
+        neighbor = peer._new_neighbor_state(ours)
+        peer.connections[3] = neighbor
+        t = threading.Thread(target=peer._send_piece_streamed, args=(neighbor, self.FAR_PIECE))
+        t.start()
+        length, msg_type = struct.unpack('>IB', peer.recv_exact(theirs, 5))
+        self.assertEqual((length, msg_type), (4 + self.PIECE_SIZE, peerProcess.PIECE))
+        # Nobody reads the rest yet: a frame sent now is queued, not blocked on
+        sender = threading.Thread(target=neighbor.send, args=(peerProcess.create_not_interested(),))
+        sender.start()
+        sender.join(5)
+        self.assertFalse(sender.is_alive())
+        payload = peer.recv_exact(theirs, length)
+        t.join(5)
+        self.assertEqual(struct.unpack('>I', payload[:4])[0], self.FAR_PIECE)
+        self.assertEqual(payload[4:], self.data)
+        self.assertEqual(peer.recv_exact(theirs, 5), peerProcess.create_not_interested())
+        self.assertEqual(neighbor.uploaded_bytes, self.PIECE_SIZE)
+        self.assertEqual(neighbor.uploads, 0)
+
+    def test_streamed_uploads_run_one_at_a_time(self):
+        os.makedirs('peer_1')
+        with open(os.path.join('peer_1', 'thefile'), 'wb') as f:
+            f.truncate(P2P_init.FILE_SIZE)
+        peer = self.make_peer(1)
+        sock = self.add_neighbor(peer, 3)
+        neighbor = peer.connections[3]
+        gate = threading.Event()
+        sent, running = [], []
+
+        def send_piece_streamed(state, piece_index):
+            running.append(piece_index)
+            gate.wait(5)
+            sent.append((piece_index, len(running)))
+            running.remove(piece_index)
+        peer._send_piece_streamed = send_piece_streamed
+        threads = threading.active_count()
+        for i in (5, 9, self.FAR_PIECE):
+            peer.process_message(peerProcess.REQUEST, struct.pack('>I', i), 3, sock)
+        # A burst of requests gets one upload thread, not one each
+        self.assertEqual(threading.active_count(), threads + 1)
+        gate.set()
+        deadline = time.monotonic() + 5
+        while neighbor.streaming and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(sent, [(5, 1), (9, 1), (self.FAR_PIECE, 1)])
+
+    def test_piece_count_uses_integer_arithmetic(self):
+        with open('Common.cfg', 'w') as f:
+            f.write(f"FileName thefile\nFileSize {2**53 + 1}\nPieceSize 1\n")
+        self.addCleanup(setattr, P2P_init, 'FILE_SIZE', P2P_init.FILE_SIZE)
+        self.addCleanup(setattr, P2P_init, 'PIECE_SIZE', P2P_init.PIECE_SIZE)
+        self.addCleanup(setattr, P2P_init, 'NUM_PIECES', P2P_init.NUM_PIECES)
+        # Too many pieces for a 32-bit index
+        with self.assertRaises(ValueError):
+            P2P_init.init_Common()
+        with open('Common.cfg', 'w') as f:
+            f.write(f"FileName thefile\nFileSize {2**53 + 1}\nPieceSize {2**31}\n")
+        P2P_init.init_Common()
+        self.assertEqual(P2P_init.NUM_PIECES, 2**22 + 1)
+        with open('Common.cfg', 'w') as f:
+            f.write(f"FileName thefile\nFileSize {2**40}\nPieceSize {2**32}\n")
+        # A piece too large for one frame
+        with self.assertRaises(ValueError):
+            P2P_init.init_Common()
+
+
+class TestCompactBitfields(PeerTestCase):
+    NUM_PIECES = 1001
+
+    def random_bitfield(self, density):
+        bitfield = peerProcess.Bitfield(self.NUM_PIECES)
+        rng = random.Random(45)
+        bitfield.bits = [rng.random() < density for _ in range(self.NUM_PIECES)]
+        return bitfield
+
+    def test_encodings_round_trip(self):
+        for density in (0.0, 0.01, 0.5, 1.0):
+            bitfield = self.random_bitfield(density)
+            expected = bytearray(bitfield.num_bytes)
+            for i, has in enumerate(bitfield.bits):
+                if has:
+                    expected[i // 8] |= 0x80 >> (i % 8)
+            self.assertEqual(bitfield.to_bytes(), bytes(expected))
+            for message_type, payload in ((peerProcess.BITFIELD, bitfield.to_bytes()),
+                                          (peerProcess.BITFIELD_RLE, bitfield.to_rle())):
+                self.assertEqual(peerProcess.decode_bitfield(message_type, payload).bits, bitfield.bits)
+        self.assertTrue(all(peerProcess.decode_bitfield(peerProcess.HAVE_ALL, b'').bits))
+        self.assertFalse(any(peerProcess.decode_bitfield(peerProcess.HAVE_NONE, b'').bits))
+
+    def test_malformed_rle_rejected(self):
+        bitfield = self.random_bitfield(0.01)
+        rle = bitfield.to_rle()
+        for bad in (b'', b'\x02\x01', rle[:-1], rle + b'\x01', b'\x00\x80'):
+            with self.assertRaises(ValueError):
+                peerProcess.decode_bitfield(peerProcess.BITFIELD_RLE, bad)
+
+    def test_negotiated_in_handshake(self):
+        hs = P2P_init.handshake(7, peerProcess.FEATURES)
+        self.assertEqual(peerProcess.parse_handshake(hs), 7)
+        self.assertEqual(peerProcess.parse_handshake_features(hs), peerProcess.FEATURES)
+        self.assertEqual(peerProcess.parse_handshake_features(P2P_init.handshake(7)), 0)
+        peer = self.make_peer()
+        peer._register_neighbor(3, FakeSocket(), outbound=True, features=peerProcess.FEATURES)
+        peer._register_neighbor(4, FakeSocket(), outbound=True, features=0)
+        self.assertTrue(peer.connections[3].compact_bitfield)
+        self.assertFalse(peer.connections[4].compact_bitfield)
+
+    def test_shortest_announcement_sent(self):
+        peer = self.make_peer()
+        sock = self.add_neighbor(peer, 3)
+        state = peer.connections[3]
+        self.assertEqual(peer._bitfield_message(state, peer.bitfield),
+                         peerProcess.create_bitfield(bytes(peer.bitfield.num_bytes)))
+        state.compact_bitfield = True
+        self.assertEqual(peer._bitfield_message(state, peer.bitfield), peerProcess.create_have_none())
+        for i in (3, 500):
+            peer.bitfield.set_piece(i)
+        self.assertEqual(peer._bitfield_message(state, peer.bitfield)[4], peerProcess.BITFIELD_RLE)
+        self.assertEqual(peer._bitfield_message(state, self.random_bitfield(0.5))[4], peerProcess.BITFIELD)
+        self.assertEqual(peer._bitfield_message(state, self.random_bitfield(1.0)), peerProcess.create_have_all())
+        peer.process_message(peerProcess.HAVE_ALL, b'', 3, sock)
+        self.assertEqual(set(peer.availability), {1})
+        self.assertEqual(sock.frames()[-1][0], peerProcess.INTERESTED)
+        peer.process_message(peerProcess.BITFIELD_RLE, peer.bitfield.to_rle(), 3, sock)
+        self.assertEqual([i for i, n in enumerate(peer.availability) if n], [3, 500])
+
+
+class TestUploadSlots(PeerTestCase):
+    def test_slots_follow_capacity(self):
+        control = peerProcess.UploadSlotController(2, 1, 4)
+        # Each neighbor gets 100 B/s until the link tops out at 300 B/s
+        def rate(slots):
+            return min(100.0 * slots, 300.0)
+        history = []
+        for _ in range(12):
+            control.update(rate(control.slots), control.slots)
+            history.append(control.slots)
+        # Grows to 3, tries 4, takes it back and stays there
+        self.assertEqual(history[:4], [3, 4, 3, 3])
+        self.assertEqual(set(history[3:]), {3})
+        # Too few interested neighbors to fill the slots: no change
+        self.assertIsNone(control.update(100.0, 1))
+        # The link collapses to a tenth: slots are dropped down to the minimum
+        for _ in range(12):
+            control.update(30.0, control.slots)
+        self.assertEqual(control.slots, 1)
+        self.assertEqual(peerProcess.UploadSlotController(9, 1, 4).slots, 4)
+
+    def test_peer_retunes_preferred_neighbors(self):
+        P2P_init.ADAPTIVE_UPLOAD_SLOTS = True
+        self.addCleanup(setattr, P2P_init, 'ADAPTIVE_UPLOAD_SLOTS', False)
+        peer = self.make_peer()
+        now = [0.0]
+        peer.clock = lambda: now[0]
+        for pid in (1, 3, 4, 5):
+            sock = self.add_neighbor(peer, pid)
+            peer.process_message(peerProcess.INTERESTED, b'', pid, sock)
+        peer.update_preferred_neighbors()
+        self.assertEqual(len(peer.preferred_neighbors), 2)
+        now[0] = 5.0
+        peer.uploaded_bytes = 1000
+        peer.update_preferred_neighbors()
+        self.assertEqual(peer.upload_slots, 3)
+        self.assertEqual(len(peer.preferred_neighbors), 3)
+        with open('log_peer_2.log') as f:
+            self.assertIn("now unchokes 3 preferred neighbors", f.read())
+
+
+class TestProximity(PeerTestCase):
+    def setUp(self):
+        super().setUp()
+        P2P_init.PROXIMITY_WEIGHT = 1.0
+        self.addCleanup(setattr, P2P_init, 'PROXIMITY_WEIGHT', 0.0)
+
+    def test_address_locality(self):
+        self.assertEqual(peerProcess.address_locality('10.1.2.3', '10.1.2.3'), 1.0)
+        self.assertEqual(peerProcess.address_locality('10.1.2.3', '127.0.0.1'), 1.0)
+        self.assertEqual(peerProcess.address_locality('10.1.2.3', '10.1.2.99'), 0.5)
+        self.assertEqual(peerProcess.address_locality('10.1.2.3', '10.1.3.3'), 0.0)
+        self.assertEqual(peerProcess.address_locality('fd00::1', 'fd00::2'), 0.5)
+        self.assertEqual(peerProcess.address_locality('10.1.2.3', 'fd00::2'), 0.0)
+        peer = self.make_peer()
+        P2P_init.peer_info[3] = ('LOCALHOST', 7003, False)
+        self.assertEqual(peer._locality(3, FakeSocket()), 1.0)
+        P2P_init.peer_info[3] = ('elsewhere', 7003, False)
+        self.assertEqual(peer._locality(3, FakeSocket()), 0.0)
+
+    def test_ping_measures_rtt(self):
+        peer = self.make_peer()
+        now = [10.0]
+        peer.clock = lambda: now[0]
+        sock = self.add_neighbor(peer, 3)
+        state = peer.connections[3]
+        # Without the feature, tokens are neither sent nor answered
+        peer.send_keep_alives()
+        peer.process_message(peerProcess.KEEP_ALIVE, b'\0\0\0\1', 3, sock)
+        self.assertEqual(sock.frames(), [(peerProcess.KEEP_ALIVE, b'')])
+        state.pings = True
+        peer.process_message(peerProcess.KEEP_ALIVE, b'\0\0\0\1', 3, sock)
+        self.assertEqual(sock.frames()[-1], (peerProcess.PONG, b'\0\0\0\1'))
+        for rtt in (0.2, 0.1):
+            peer.send_keep_alives()
+            message_type, token = sock.frames()[-1]
+            self.assertEqual(message_type, peerProcess.KEEP_ALIVE)
+            now[0] += rtt
+            peer.process_message(peerProcess.PONG, b'\xff' + token[1:], 3, sock)   # not ours
+            peer.process_message(peerProcess.PONG, token, 3, sock)
+            peer.process_message(peerProcess.PONG, token, 3, sock)   # duplicate
+        self.assertAlmostEqual(state.rtt, 0.875 * 0.2 + 0.125 * 0.1)
+
+    def test_nearby_neighbors_preferred(self):
+        peer = self.make_peer()
+        socks = {}
+        for pid, rtt, locality in ((3, 0.2, 0.0), (4, 0.01, 1.0), (5, 0.05, 0.5)):
+            socks[pid] = self.add_neighbor(peer, pid, pieces=range(self.NUM_PIECES))
+            state = peer.connections[pid]
+            state.rtt, state.locality = rtt, locality
+            state.peer_choking_me = False
+        # Equal rates: the nearest win the unchoke slots
+        self.assertEqual(peer.choose_preferred_neighbors([(3, 100), (4, 100), (5, 100)]), [4, 5])
+        # A large enough rate still beats proximity
+        self.assertEqual(peer.choose_preferred_neighbors([(3, 1000), (4, 100), (5, 100)])[0], 3)
+        self.assertEqual([pid for pid, _ in peer._request_candidates()], [4, 5, 3])
+        # The far neighbor is asked for pieces the nearer ones don't have
+        for pid in (4, 5):
+            peer.connections[pid].bitfield.bits[6] = False
+        peer.send_request(3, socks[3])
+        self.assertEqual(socks[3].frames()[-1], (peerProcess.REQUEST, struct.pack('>I', 6)))
+
+
+class TestPieceStore(PeerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.data = os.urandom(self.NUM_PIECES * self.PIECE_SIZE)
+        os.makedirs('peer_1')
+        with open('peer_1/thefile', 'wb') as f:
+            f.write(self.data)
+        P2P_init.DELTA_MANIFEST = 'thefile.manifest'
+        P2P_init.PIECE_STORE = 'store'
+        self.addCleanup(setattr, P2P_init, 'DELTA_MANIFEST', '')
+        self.addCleanup(setattr, P2P_init, 'PIECE_STORE', '')
+
+    def wait_for_entries(self, count):
+        deadline = time.monotonic() + 5
+        while len(piece_store.PieceStore('store').entries()) < count and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return piece_store.PieceStore('store')
+
+    def test_leecher_starts_with_pieces_the_seeder_stored(self):
+        self.make_peer(1)
+        self.assertEqual(self.wait_for_entries(self.NUM_PIECES).size, len(self.data))
+        peer = self.make_peer(2)
+        self.assertTrue(peer.bitfield.is_complete())
+        self.assertTrue(peer.done_broadcast_sent)
+        with open('peer_2/thefile', 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+
+    def test_pieces_stored_meanwhile_are_not_requested(self):
+        delta_sync.write_manifest(delta_sync.build_manifest('peer_1/thefile', self.PIECE_SIZE),
+                                  'thefile.manifest')
+        peer = self.make_peer(2)
+        self.assertEqual(peer.bitfield.count(), 0)
+        # Another local peer downloads everything but piece 5
+        with open('peer_1/thefile', 'rb') as f:
+            for i in range(self.NUM_PIECES):
+                if i != 5:
+                    peer.store.add(peer.piece_hashes[i], f, i * self.PIECE_SIZE, self.PIECE_SIZE)
+        sock = self.add_neighbor(peer, 3, pieces=range(self.NUM_PIECES))
+        peer.connections[3].peer_choking_me = False
+        for _ in range(self.NUM_PIECES):
+            peer.send_request(3, sock)
+        self.assertEqual(peer.bitfield.count(), self.NUM_PIECES - 1)
+        self.assertEqual([f for f in sock.frames() if f[0] == peerProcess.REQUEST],
+                         [(peerProcess.REQUEST, struct.pack('>I', 5))])
+        # The downloaded piece goes in, a corrupt one doesn't
+        peer.save_piece(5, os.urandom(self.PIECE_SIZE), 3)
+        self.assertFalse(peer.store.has(peer.piece_hashes[5]))
+        peer.bitfield.bits[4] = False
+        peer.save_piece(4, self.data[4 * self.PIECE_SIZE:5 * self.PIECE_SIZE], 3)
+        self.assertEqual(len(peer.store.entries()), self.NUM_PIECES - 1)
+
+    def test_gc_deletes_least_recently_used(self):
+        store = piece_store.PieceStore('store', budget=3 * self.PIECE_SIZE)
+        digests = []
+        with open('peer_1/thefile', 'rb') as f:
+            for i in range(3):
+                piece = self.data[i * self.PIECE_SIZE:(i + 1) * self.PIECE_SIZE]
+                digests.append(delta_sync.strong_checksum(piece))
+                self.assertTrue(store.add(digests[i], f, i * self.PIECE_SIZE, self.PIECE_SIZE))
+                os.utime(store.path(digests[i]), (1000 + i, 1000 + i))
+            self.assertFalse(store.add('0' * 40, f, 0, self.PIECE_SIZE))
+            # Reading piece 0 makes piece 1 the oldest
+            with open('copy', 'wb') as out:
+                self.assertTrue(store.copy_out(digests[0], out, 0, self.PIECE_SIZE))
+            piece = self.data[3 * self.PIECE_SIZE:4 * self.PIECE_SIZE]
+            self.assertTrue(store.add(delta_sync.strong_checksum(piece), f, 3 * self.PIECE_SIZE, self.PIECE_SIZE))
+        self.assertEqual(store.size, 3 * self.PIECE_SIZE)
+        self.assertFalse(store.has(digests[1]))
+        self.assertTrue(store.has(digests[0]) and store.has(digests[2]))
+        self.assertEqual(store.gc(0), 3 * self.PIECE_SIZE)
+        self.assertEqual(store.entries(), [])
+
+
+class TestSocketTuning(PeerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(setattr, P2P_init, 'TCP_NODELAY', P2P_init.TCP_NODELAY)
+        self.addCleanup(setattr, P2P_init, 'SOCKET_BUFFER_MAX', 0)
+
+    def tcp_pair(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen()
+        client = socket.create_connection(listener.getsockname())
+        server, _ = listener.accept()
+        listener.close()
+        for sock in (client, server):
+            self.addCleanup(sock.close)
+        return client, server
+
+    def test_request_loop_is_not_held_back(self):
+        keep_config(self, 'NUM_PIECES', 'TCP_NODELAY')
+        times = socket_bench.run(True, 20, 4096)
+        # Nagle plus delayed ACKs cost ~40 ms a round; without them it is well under 1 ms
+        self.assertLess(socket_bench.summary(times)['p50_ms'], 20)
+
+    @unittest.skipUnless(hasattr(socket, 'TCP_CORK'), "TCP_CORK is Linux only")
+    def test_piece_sent_corked(self):
+        P2P_init.TCP_NODELAY = True
+        client, server = self.tcp_pair()
+        peerProcess.tune_socket(client)
+        self.assertEqual(client.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY), 1)
+        neighbor = peerProcess.NeighborState(client, 0.0)
+        data = os.urandom(100000)
+        header = struct.pack('>IBI', 4 + len(data), peerProcess.PIECE, 7)
+        neighbor.send_piece(header, data)
+        self.assertEqual(client.getsockopt(socket.IPPROTO_TCP, socket.TCP_CORK), 0)
+        self.assertEqual(socket_bench.recv_frame(server), (peerProcess.PIECE, struct.pack('>I', 7) + data))
+        # Queued behind an upload like any other frame
+        neighbor.uploads = 1
+        neighbor.send_piece(header, data)
+        self.assertEqual(neighbor.queued, [header + data])
+
+    def test_buffers_grow_with_bandwidth_delay_product(self):
+        self.assertEqual(peerProcess.socket_buffer_size(1e6, 0.1, 1 << 20), 200000)
+        self.assertEqual(peerProcess.socket_buffer_size(1e9, 0.1, 1 << 20), 1 << 20)
+        self.assertEqual(peerProcess.socket_buffer_size(10, 0.1, 1 << 20), peerProcess.SOCKET_BUFFER_MIN)
+        P2P_init.SOCKET_BUFFER_MAX = 8 << 20
+        peer = self.make_peer()
+        now = [0.0]
+        peer.clock = lambda: now[0]
+        sizes = {}
+        for pid, rate in ((3, 10e6), (4, 0.0)):
+            sock = self.tcp_pair()[0]
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 16384)
+            state = peer._new_neighbor_state(sock)
+            state.rtt, state.throughput = 0.1, rate
+            peer.connections[pid] = state
+            sizes[pid] = sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
+        peer.tune_socket_buffers()   # first round only takes the upload mark
+        now[0] += 5
+        peer.tune_socket_buffers()
+        sndbuf = lambda pid: peer.connections[pid].socket.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
+        self.assertGreater(sndbuf(3), sizes[3])
+        self.assertEqual(sndbuf(4), sizes[4])
+
+
 if __name__ == '__main__':
     # run with verbosity on the project root
     unittest.main(verbosity=2)
\ No newline at end of file
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Local tracker for the P2P file sharing swarm
+Peers announce themselves (id, address, bytes left) over HTTP and get back a
+bounded random subset of the other peers, instead of every peer reading the
+whole PeerInfo.cfg and dialing everyone.
+
+    GET /announce?peer_id=1002&host=localhost&port=6002&left=1234&event=started&numwant=30
+    GET /scrape
+
+Both answer with JSON. Run with: python tracker.py --port 6969
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+DEFAULT_INTERVAL = 30     # seconds between re-announces we ask peers for
+DEFAULT_NUMWANT = 30
+MAX_NUMWANT = 200
+
+
+class Tracker:
+    """Swarm membership table. Peers that stop announcing expire after two intervals."""
+
+    def __init__(self, interval=DEFAULT_INTERVAL, clock=time.monotonic):
+        self.interval = interval
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._peers = {}   # peer_id -> {'host', 'port', 'left', 'last_seen'}
+
+    def announce(self, peer_id, host, port, left, event=None, numwant=DEFAULT_NUMWANT):
+        """Record a peer's announce and return the response dict."""
+        now = self.clock()
+        with self._lock:
+            self._expire(now)
+            if event == 'stopped':
+                self._peers.pop(peer_id, None)
+            else:
+                self._peers[peer_id] = {'host': host, 'port': port,
+                                        'left': left, 'last_seen': now}
+            others = [pid for pid in self._peers if pid != peer_id]
+            chosen = random.sample(others, min(len(others), max(0, min(numwant, MAX_NUMWANT))))
+            peers = [{'peer_id': pid,
+                      'host': self._peers[pid]['host'],
+                      'port': self._peers[pid]['port']} for pid in chosen]
+            response = {'interval': self.interval, 'peers': peers}
+            response.update(self._counts())
+        return response
+
+    def scrape(self):
+        with self._lock:
+            self._expire(self.clock())
+            return self._counts()
+
+    def _counts(self):
+        complete = sum(1 for p in self._peers.values() if p['left'] == 0)
+        return {'complete': complete, 'incomplete': len(self._peers) - complete}
+
+    def _expire(self, now):
+        cutoff = now - 2 * self.interval
+        for pid in [pid for pid, p in self._peers.items() if p['last_seen'] < cutoff]:
+            del self._peers[pid]
+
+
+class TrackerRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        try:
+            if url.path == '/announce':
+                body = self.server.tracker.announce(
+                    int(query['peer_id']),
+                    query.get('host') or self.client_address[0],
+                    int(query['port']),
+                    int(query.get('left', 0)),
+                    query.get('event'),
+                    int(query.get('numwant', DEFAULT_NUMWANT)))
+            elif url.path == '/scrape':
+                body = self.server.tracker.scrape()
+            else:
+                self.send_error(404)
+                return
+        except (KeyError, ValueError) as e:
+            self.send_error(400, f"bad request: {e}")
+            return
+
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        # Peers re-announce constantly; keep stderr quiet
+        pass
+
+
+class TrackerServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, tracker=None):
+        super().__init__(address, TrackerRequestHandler)
+        self.tracker = tracker or Tracker()
+
+
+def start_tracker(host='localhost', port=0, interval=DEFAULT_INTERVAL):
+    """Start a tracker on a background thread. Returns the server (see server_address)."""
+    server = TrackerServer((host, port), Tracker(interval))
+    t = threading.Thread(target=server.serve_forever, daemon=True)
+    t.start()
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Local HTTP tracker for the P2P swarm.")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=6969)
+    parser.add_argument('--interval', type=int, default=DEFAULT_INTERVAL)
+    args = parser.parse_args(argv)
+
+    server = TrackerServer((args.host, args.port), Tracker(args.interval))
+    print(f"Tracker listening on http://{args.host}:{args.port}/announce")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,529 @@
+#!/usr/bin/env python3
+"""
+UDP transport for the P2P swarm
+A reliable, ordered byte stream over UDP whose send window follows LEDBAT
+(RFC 6817) instead of TCP's loss-based control. Every packet carries a
+send timestamp and the receiver echoes back the one-way delay it saw. The
+sender keeps the lowest delay as the base and treats anything above it as
+queuing. It grows its window while queuing delay is under TARGET and
+shrinks it as delay approaches or passes TARGET, so bulk piece traffic
+backs off before router buffers fill up.
+
+UdpEndpoint owns one UDP socket and stands in for the listening TCP socket
+(accept, close). UdpConnection stands in for a connected TCP socket (recv,
+sendall, shutdown, close), so Peer uses it unchanged. Select it for the
+whole swarm with "Transport udp" in Common.cfg.
+
+Packet header (25 bytes, big endian):
+    type(1) conn_id(4) seq(4) ack(4) timestamp_us(4) timestamp_diff_us(4) window(4)
+"""
+
+import collections
+import heapq
+import itertools
+import random
+import socket
+import struct
+import threading
+import time
+
+ST_DATA = 0
+ST_FIN = 1
+ST_STATE = 2   # ack only
+ST_RESET = 3
+ST_SYN = 4
+
+HEADER = struct.Struct('>BIIIIII')
+MSS = 1200                 # payload bytes per packet, below common path MTUs
+MASK32 = 0xffffffff
+
+# LEDBAT
+TARGET = 0.100             # seconds of queuing delay we allow ourselves
+GAIN = 1.0
+MIN_CWND = 2 * MSS
+MAX_CWND = 1 << 20
+BASE_HISTORY = 10          # one-minute minima kept for the base delay
+CURRENT_FILTER = 4         # recent samples whose minimum is the current delay
+
+# Retransmission
+INIT_RTO = 1.0
+MIN_RTO = 0.2
+MAX_RTO = 10.0
+MAX_RETRANSMITS = 8        # then the connection is given up
+DUP_ACK_THRESHOLD = 3
+
+RECV_WINDOW = 1 << 20      # bytes buffered for the reader before we advertise 0
+TICK = 0.01                # timer resolution of the endpoint thread
+
+
+class Ledbat:
+    """Congestion window driven by one-way queuing delay (RFC 6817)."""
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.cwnd = MIN_CWND
+        self.base_delays = collections.deque(maxlen=BASE_HISTORY)   # [minute, min delay]
+        self.current_delays = collections.deque(maxlen=CURRENT_FILTER)
+
+    def add_delay_sample(self, delay):
+        """delay: one-way delay in seconds, plus any constant clock offset."""
+        minute = int(self.clock() // 60)
+        if not self.base_delays or self.base_delays[-1][0] != minute:
+            self.base_delays.append([minute, delay])
+        elif delay < self.base_delays[-1][1]:
+            self.base_delays[-1][1] = delay
+        self.current_delays.append(delay)
+
+    def queuing_delay(self):
+        if not self.current_delays:
+            return 0.0
+        base = min(d for _, d in self.base_delays)
+        return min(self.current_delays) - base
+
+    def on_ack(self, bytes_acked, delay=None):
+        if delay is not None:
+            self.add_delay_sample(delay)
+        off_target = (TARGET - self.queuing_delay()) / TARGET
+        self.cwnd += GAIN * off_target * bytes_acked * MSS / self.cwnd
+        self.cwnd = max(MIN_CWND, min(MAX_CWND, self.cwnd))
+
+    def on_loss(self):
+        self.cwnd = max(MIN_CWND, self.cwnd / 2)
+
+    def on_timeout(self):
+        self.cwnd = MIN_CWND
+
+
+def _timestamp_us(now):
+    return int(now * 1_000_000) & MASK32
+
+
+def _signed32(value):
+    return ((value + (1 << 31)) & MASK32) - (1 << 31)
+
+
+class UdpConnection:
+    """
+    One reliable stream to a remote endpoint. sendall blocks while the
+    congestion (or the receiver's) window is full; recv blocks until data
+    arrives and returns b'' once the remote side has closed.
+    """
+
+    def __init__(self, endpoint, addr, recv_id, send_id, recv_next=None):
+        self.endpoint = endpoint
+        self.addr = addr
+        self.recv_id = recv_id
+        self.send_id = send_id
+        self.cond = threading.Condition()
+        self.send_lock = threading.Lock()   # keeps one sendall's packets together
+
+        # Sending
+        self.next_seq = 1
+        self.unacked = collections.OrderedDict()  # seq -> [type, payload, sent_at, retransmits]
+        self.inflight = 0
+        self.peer_window = RECV_WINDOW
+        self.last_ack = 0
+        self.dup_acks = 0
+        self.recovery_point = None    # highest seq sent when we last saw a loss
+        self.ledbat = Ledbat(endpoint.clock)
+        self.delay_origin = None
+
+        # Receiving
+        self.recv_next = recv_next    # next in-order seq we expect (None until SYN seen)
+        self.out_of_order = {}
+        self.recv_buf = bytearray()
+        self.reply_ts_diff = 0
+
+        # RTT / RTO (as TCP)
+        self.srtt = None
+        self.rttvar = 0.0
+        self.rto = INIT_RTO
+        self.rto_deadline = None
+
+        self.connected = threading.Event()
+        self.eof = False        # remote sent FIN (or we shut down reading)
+        self.closed = False     # we closed, FIN queued
+        self.error = None
+
+    # ----------------------------------------------------- socket interface
+
+    def sendall(self, data):
+        view = memoryview(data).cast('B')
+        with self.send_lock:
+            for offset in range(0, len(view), MSS):
+                self._queue(ST_DATA, bytes(view[offset:offset + MSS]))
+
+    def recv(self, bufsize):
+        with self.cond:
+            self.cond.wait_for(lambda: self.recv_buf or self.eof or self.error or self.closed)
+            if self.recv_buf:
+                was_full = len(self.recv_buf) >= RECV_WINDOW // 2
+                data = bytes(self.recv_buf[:bufsize])
+                del self.recv_buf[:bufsize]
+                update = was_full and len(self.recv_buf) < RECV_WINDOW // 2
+            elif self.error and not self.eof:
+                raise self.error
+            else:
+                return b''
+        if update:
+            # Let a sender stalled on our window know there is room again
+            self._send_state()
+        return data
+
+    def shutdown(self, how=socket.SHUT_RDWR):
+        with self.cond:
+            self.eof = True
+            self.cond.notify_all()
+        self.close()
+
+    def close(self):
+        with self.cond:
+            if self.closed or self.error:
+                self.closed = True
+                self.cond.notify_all()
+                return
+            self.closed = True
+            self.cond.notify_all()
+        try:
+            self._queue(ST_FIN, b'', force=True)
+        except OSError:
+            pass
+
+    def wait_closed(self, timeout=None):
+        """
+        After close(): wait until the remote side has acked everything we
+        sent, FIN included. False if timeout passed first.
+        """
+        with self.cond:
+            return self.cond.wait_for(self._finished, timeout)
+
+    def settimeout(self, timeout):
+        # Blocking only; accepted so callers written for TCP sockets work
+        pass
+
+    # ------------------------------------------------------------- sending
+
+    def _window(self):
+        return min(self.ledbat.cwnd, self.peer_window)
+
+    def _queue(self, packet_type, payload, force=False):
+        """Assign the next sequence number to a packet and send it when the window allows."""
+        with self.cond:
+            # One packet may always be out, which doubles as a zero-window
+            # probe. FIN goes out regardless so close() never waits.
+            self.cond.wait_for(lambda: force or self.error or self.closed or not self.unacked
+                               or self.inflight + len(payload) <= self._window())
+            if self.error:
+                raise self.error
+            if self.closed and not force:
+                raise OSError("connection closed")
+            seq = self.next_seq
+            self.next_seq += 1
+            now = self.endpoint.clock()
+            self.unacked[seq] = [packet_type, payload, now, 0]
+            self.inflight += len(payload)
+            if self.rto_deadline is None:
+                self.rto_deadline = now + self.rto
+        self.endpoint._send_packet(self, packet_type, seq, payload)
+
+    def _send_state(self):
+        self.endpoint._send_packet(self, ST_STATE, self.next_seq, b'')
+
+    def _retransmit_first(self, now):
+        """Resend the oldest unacked packet (caller holds cond)."""
+        seq, entry = next(iter(self.unacked.items()))
+        entry[2] = now
+        entry[3] += 1
+        return seq, entry
+
+    # ----------------------------------------------------------- receiving
+
+    def _on_packet(self, packet_type, seq, ack, ts, ts_diff, window, payload):
+        """Called by the endpoint thread for every packet of this connection."""
+        now = self.endpoint.clock()
+        resend = None
+        send_ack = False
+        with self.cond:
+            if packet_type == ST_RESET:
+                self.error = ConnectionResetError("connection reset by peer")
+                self.cond.notify_all()
+                return
+            self.reply_ts_diff = (_timestamp_us(now) - ts) & MASK32
+            self.peer_window = window
+            resend = self._on_ack(packet_type, ack, ts_diff, now)
+
+            if packet_type in (ST_DATA, ST_FIN, ST_SYN):
+                send_ack = True
+                if packet_type != ST_SYN and seq >= self.recv_next and seq not in self.out_of_order:
+                    self.out_of_order[seq] = (packet_type, payload)
+                    while self.recv_next in self.out_of_order:
+                        t, data = self.out_of_order.pop(self.recv_next)
+                        if t == ST_FIN:
+                            self.eof = True
+                        else:
+                            self.recv_buf += data
+                        self.recv_next += 1
+            self.cond.notify_all()
+        if resend:
+            self.endpoint._send_packet(self, resend[1][0], resend[0], resend[1][1])
+        if send_ack:
+            self._send_state()
+        self.endpoint._maybe_forget(self)
+
+    def _on_ack(self, packet_type, ack, ts_diff, now):
+        """Process the cumulative ack field. Returns a (seq, entry) to resend or None."""
+        acked_bytes = 0
+        rtt_sample = None
+        while self.unacked:
+            seq = next(iter(self.unacked))
+            if seq > ack:
+                break
+            packet, payload, sent_at, retransmits = self.unacked.pop(seq)
+            acked_bytes += len(payload)
+            if packet == ST_SYN:
+                self.connected.set()
+            if retransmits == 0:
+                rtt_sample = now - sent_at   # Karn: only never-resent packets
+        if acked_bytes or (ack > self.last_ack):
+            self.inflight -= acked_bytes
+            self.last_ack = ack
+            self.dup_acks = 0
+            if rtt_sample is not None:
+                self._update_rto(rtt_sample)
+            self.ledbat.on_ack(max(acked_bytes, 1), self._delay(ts_diff))
+            self.rto_deadline = now + self.rto if self.unacked else None
+            if self.recovery_point is not None:
+                if ack >= self.recovery_point or not self.unacked:
+                    self.recovery_point = None
+                else:
+                    # Partial ack while recovering: the next hole is lost too
+                    return self._retransmit_first(now)
+            return None
+        if packet_type == ST_STATE and self.unacked and ack == self.last_ack:
+            self.dup_acks += 1
+            if self.dup_acks == DUP_ACK_THRESHOLD and self.recovery_point is None:
+                self.ledbat.on_loss()
+                self.recovery_point = self.next_seq - 1
+                return self._retransmit_first(now)
+        return None
+
+    def _delay(self, ts_diff):
+        """One-way delay sample in seconds, relative to the first one we saw."""
+        if not ts_diff:
+            return None
+        if self.delay_origin is None:
+            self.delay_origin = ts_diff
+        return _signed32(ts_diff - self.delay_origin) / 1_000_000
+
+    def _update_rto(self, sample):
+        if self.srtt is None:
+            self.srtt = sample
+            self.rttvar = sample / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - sample)
+            self.srtt = 0.875 * self.srtt + 0.125 * sample
+        self.rto = min(MAX_RTO, max(MIN_RTO, self.srtt + 4 * self.rttvar))
+
+    def _on_tick(self, now):
+        """Retransmission timer, driven by the endpoint thread."""
+        with self.cond:
+            if self.rto_deadline is None or now < self.rto_deadline or self.error:
+                return
+            if not self.unacked:
+                self.rto_deadline = None
+                return
+            seq, entry = self._retransmit_first(now)
+            if entry[3] > MAX_RETRANSMITS:
+                self.error = TimeoutError("udp connection timed out")
+                self.cond.notify_all()
+                resend = None
+            else:
+                self.rto = min(MAX_RTO, self.rto * 2)
+                self.rto_deadline = now + self.rto
+                self.ledbat.on_timeout()
+                self.recovery_point = self.next_seq - 1
+                resend = (seq, entry)
+        if resend:
+            self.endpoint._send_packet(self, entry[0], seq, entry[1])
+        self.endpoint._maybe_forget(self)
+
+    def _finished(self):
+        """Nothing left to do: errored, or closed with everything (FIN included) acked."""
+        return self.error is not None or (self.closed and not self.unacked)
+
+
+class UdpEndpoint:
+    """
+    One UDP socket serving any number of UdpConnections. loss and delay
+    inject packet loss (probability) and extra one-way delay (seconds) on
+    everything this endpoint sends, for testing over loopback.
+    """
+
+    def __init__(self, host='', port=0, loss=0.0, delay=0.0, seed=None, clock=time.monotonic):
+        self.clock = clock
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((host, port))
+        self.sock.settimeout(TICK)
+        self.loss = loss
+        self.delay = delay
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.connections = {}    # (addr, recv_id) -> UdpConnection
+        self.backlog = collections.deque()
+        self.accept_cond = threading.Condition()
+        self.delayed = []        # (due, n, data, addr)
+        self.delay_seq = itertools.count()
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def getsockname(self):
+        return self.sock.getsockname()
+
+    def accept(self):
+        """Wait for an incoming connection. Returns (connection, address) like socket.accept."""
+        with self.accept_cond:
+            self.accept_cond.wait_for(lambda: self.backlog or self.closed)
+            if self.closed:
+                raise OSError("endpoint closed")
+            conn = self.backlog.popleft()
+        return conn, conn.addr
+
+    def connect(self, address, timeout=5.0):
+        """Open a connection to (host, port). Raises TimeoutError if nobody answers."""
+        host, port = address
+        addr = (socket.gethostbyname(host), port)
+        with self.lock:
+            recv_id = self.rng.randrange(0, MASK32)
+            while (addr, recv_id) in self.connections:
+                recv_id = self.rng.randrange(0, MASK32)
+            conn = UdpConnection(self, addr, recv_id, recv_id + 1, recv_next=1)
+            self.connections[(addr, recv_id)] = conn
+        conn._queue(ST_SYN, b'')
+        if not conn.connected.wait(timeout) or conn.error:
+            self._forget(conn)
+            raise TimeoutError(f"no answer from {host}:{port}")
+        return conn
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        with self.lock:
+            conns = list(self.connections.values())
+            self.connections.clear()
+        for conn in conns:
+            # Tell the other side now rather than letting it time out
+            try:
+                self.sock.sendto(self._header(conn, ST_RESET, 0), conn.addr)
+            except OSError:
+                pass
+            with conn.cond:
+                conn.error = ConnectionResetError("endpoint closed")
+                conn.cond.notify_all()
+        with self.accept_cond:
+            self.accept_cond.notify_all()
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+    # ------------------------------------------------------------ internals
+
+    def _header(self, conn, packet_type, seq):
+        now = self.clock()
+        ack = conn.recv_next - 1 if conn.recv_next else 0
+        window = max(0, RECV_WINDOW - len(conn.recv_buf))
+        conn_id = conn.recv_id if packet_type == ST_SYN else conn.send_id
+        return HEADER.pack(packet_type, conn_id, seq, ack, _timestamp_us(now),
+                           conn.reply_ts_diff, window)
+
+    def _send_packet(self, conn, packet_type, seq, payload):
+        data = self._header(conn, packet_type, seq) + payload
+        if self.loss and self.rng.random() < self.loss:
+            return
+        if self.delay:
+            with self.lock:
+                heapq.heappush(self.delayed, (self.clock() + self.delay, next(self.delay_seq),
+                                              data, conn.addr))
+            return
+        try:
+            self.sock.sendto(data, conn.addr)
+        except OSError:
+            pass
+
+    def _forget(self, conn):
+        with self.lock:
+            if self.connections.get((conn.addr, conn.recv_id)) is conn:
+                del self.connections[(conn.addr, conn.recv_id)]
+
+    def _maybe_forget(self, conn):
+        if conn._finished():
+            self._forget(conn)
+
+    def _run(self):
+        next_tick = self.clock() + TICK
+        while not self.closed:
+            try:
+                data, addr = self.sock.recvfrom(65535)
+            except socket.timeout:
+                data = None
+            except OSError:
+                break
+            if data:
+                self._dispatch(data, addr)
+            now = self.clock()
+            if now >= next_tick:
+                next_tick = now + TICK
+                self._tick(now)
+
+    def _tick(self, now):
+        due = []
+        with self.lock:
+            while self.delayed and self.delayed[0][0] <= now:
+                due.append(heapq.heappop(self.delayed))
+            conns = list(self.connections.values())
+        for _, _, data, addr in due:
+            try:
+                self.sock.sendto(data, addr)
+            except OSError:
+                pass
+        for conn in conns:
+            conn._on_tick(now)
+
+    def _dispatch(self, data, addr):
+        if len(data) < HEADER.size:
+            return
+        packet_type, conn_id, seq, ack, ts, ts_diff, window = HEADER.unpack_from(data)
+        payload = data[HEADER.size:]
+        if packet_type == ST_SYN:
+            # Our recv_id is theirs + 1; a repeated SYN finds the connection again
+            key = (addr, (conn_id + 1) & MASK32)
+            with self.lock:
+                conn = self.connections.get(key)
+                if conn is None:
+                    conn = UdpConnection(self, addr, key[1], conn_id, recv_next=seq + 1)
+                    conn.connected.set()
+                    self.connections[key] = conn
+                    new = True
+                else:
+                    new = False
+            if new:
+                with self.accept_cond:
+                    self.backlog.append(conn)
+                    self.accept_cond.notify()
+            conn._on_packet(packet_type, seq, ack, ts, ts_diff, window, payload)
+            return
+        with self.lock:
+            conn = self.connections.get((addr, conn_id))
+        if conn is None:
+            if packet_type not in (ST_RESET, ST_STATE):
+                # Unknown connection (e.g. we already forgot it): reset the
+                # sender, whose recv_id is one off ours depending on who dialed
+                for their_id in ((conn_id - 1) & MASK32, (conn_id + 1) & MASK32):
+                    try:
+                        self.sock.sendto(HEADER.pack(ST_RESET, their_id, 0, 0, 0, 0, 0), addr)
+                    except OSError:
+                        pass
+            return
+        conn._on_packet(packet_type, seq, ack, ts, ts_diff, window, payload)